@@ -1,20 +1,25 @@
 import os
 import asyncio
+import time
 import telebot.async_telebot as async_telebot
+from telebot import asyncio_helper
 from telebot import types
 import logging
 from datetime import datetime, timedelta, timezone
 import re
 import json
+from bisect import insort
+from collections import OrderedDict, deque
+from cachetools import TTLCache
+from functools import lru_cache
 import aiohttp # For async HTTP requests
 import asyncpg # For async PostgreSQL
 from dotenv import load_dotenv
 
-from flask import Flask, request
+from aiohttp import web
 
 # Initial synchronous psycopg2 for DB init
 import psycopg2
-from psycopg2 import sql as pg_sql
 from psycopg2 import extras
 
 load_dotenv()
@@ -49,16 +54,94 @@ def validate_env_vars():
 
 validate_env_vars()
 
-app = Flask(__name__)
-bot = async_telebot.AsyncTeleBot(TOKEN)
+# Telegram Bot API limits: ~30 messages/s overall, ~1/s per private chat, 20/min per group or channel
+TELEGRAM_GLOBAL_LIMIT = (30, 1.0)
+TELEGRAM_PRIVATE_CHAT_LIMIT = (1, 1.05)
+TELEGRAM_GROUP_CHAT_LIMIT = (20, 60.0)
+# Rate-limited method -> position of its chat_id argument (None: only the global limit applies)
+TELEGRAM_LIMITED_METHODS = {
+    'send_message': 0, 'send_photo': 0, 'send_media_group': 0, 'delete_message': 0, 'copy_message': 0,
+    'edit_message_reply_markup': 0, 'edit_message_text': 1, 'edit_message_caption': 1,
+    'answer_callback_query': None,
+}
+
+class RateLimitedBot:
+    """AsyncTeleBot proxy that spaces outgoing calls to stay within Telegram's rate limits."""
+
+    def __init__(self, bot, global_slots=None, chat_slots=None, per_chat=True):
+        self._bot = bot
+        self._global_slots = deque() if global_slots is None else global_slots
+        self._chat_slots = {} if chat_slots is None else chat_slots
+        self._per_chat = per_chat
+
+    def without_chat_limit(self):
+        """Same bot and global bucket, but no per-chat spacing: for listings that answer one tap with several messages."""
+        return RateLimitedBot(self._bot, self._global_slots, self._chat_slots, per_chat=False)
+
+    @staticmethod
+    def _next_slot(slots, limit, now):
+        count, period = limit
+        while slots and slots[0] <= now - period:
+            slots.popleft()
+        return slots[-count] + period if len(slots) >= count else now
+
+    async def _acquire(self, chat_id):
+        # Reserve the earliest slot that fits every bucket, then sleep until it comes
+        now = time.monotonic()
+        buckets = [(self._global_slots, TELEGRAM_GLOBAL_LIMIT)]
+        if chat_id is not None and self._per_chat:
+            chat_limit = TELEGRAM_GROUP_CHAT_LIMIT if str(chat_id).startswith(('-', '@')) else TELEGRAM_PRIVATE_CHAT_LIMIT
+            buckets.append((self._chat_slots.setdefault(chat_id, deque()), chat_limit))
+        slot = max(self._next_slot(slots, limit, now) for slots, limit in buckets)
+        for slots, _ in buckets:
+            insort(slots, slot)
+        if len(self._chat_slots) > 10000:
+            self._chat_slots = {cid: s for cid, s in self._chat_slots.items() if s and s[-1] > now - TELEGRAM_GROUP_CHAT_LIMIT[1]}
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def __getattr__(self, name):
+        method = getattr(self._bot, name)
+        if name not in TELEGRAM_LIMITED_METHODS:
+            return method
+        chat_id_pos = TELEGRAM_LIMITED_METHODS[name]
+
+        async def limited(*args, **kwargs):
+            chat_id = None
+            if chat_id_pos is not None:
+                chat_id = kwargs.get('chat_id', args[chat_id_pos] if len(args) > chat_id_pos else None)
+            await self._acquire(chat_id)
+            try:
+                return await method(*args, **kwargs)
+            except asyncio_helper.ApiTelegramException as e:
+                if e.error_code != 429:
+                    raise
+                retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+                logger.warning(f"Telegram 429 для {name}, повтор через {retry_after} с.")
+                await asyncio.sleep(retry_after)
+                return await method(*args, **kwargs)
+        return limited
+
+bot = RateLimitedBot(async_telebot.AsyncTeleBot(TOKEN))
 
 # Use a global variable for DB pool to manage connections efficiently
+DB_POOL_MIN_CONN = int(os.getenv('DB_POOL_MIN_CONN', '5'))
+DB_POOL_MAX_CONN = int(os.getenv('DB_POOL_MAX_CONN', '50'))
 db_pool = None
+db_pool_lock = asyncio.Lock() # concurrent first requests must not create two pools
+
+async def init_db_connection(conn):
+    # json/jsonb columns come back as Python objects and accept them as parameters
+    for type_name in ('json', 'jsonb'):
+        await conn.set_type_codec(type_name, encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
 
 async def get_db_connection_async():
     global db_pool
     if db_pool is None:
-        db_pool = await asyncpg.create_pool(DATABASE_URL)
+        async with db_pool_lock:
+            if db_pool is None:
+                db_pool = await asyncpg.create_pool(DATABASE_URL, min_size=DB_POOL_MIN_CONN, max_size=DB_POOL_MAX_CONN,
+                                                    init=init_db_connection)
     return db_pool
 
 # Synchronous DB init (runs once at startup)
@@ -67,7 +150,7 @@ def init_db_sync():
     try:
         conn = psycopg2.connect(DATABASE_URL)
         cur = conn.cursor()
-        cur.execute(pg_sql.SQL("""
+        cur.execute("""
             CREATE TABLE IF NOT EXISTS users (
                 chat_id BIGINT PRIMARY KEY,
                 username TEXT,
@@ -89,8 +172,8 @@ def init_db_sync():
                 product_name TEXT NOT NULL,
                 price TEXT NOT NULL,
                 description TEXT NOT NULL,
-                photos TEXT, 
-                geolocation TEXT, 
+                photos JSONB, 
+                geolocation JSONB, 
                 status TEXT DEFAULT 'pending', 
                 commission_rate REAL DEFAULT 0.10,
                 commission_amount REAL DEFAULT 0,
@@ -101,7 +184,7 @@ def init_db_sync():
                 views INTEGER DEFAULT 0,
                 republish_count INTEGER DEFAULT 0,
                 last_republish_date DATE,
-                shipping_options TEXT, 
+                shipping_options JSONB, 
                 hashtags TEXT, 
                 created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
@@ -130,7 +213,7 @@ def init_db_sync():
                 created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
                 paid_at TIMESTAMP WITH TIME ZONE
             );
-            CREATE TABLE IF NOT EXISTS statistics (
+            CREATE UNLOGGED TABLE IF NOT EXISTS statistics (
                 id SERIAL PRIMARY KEY,
                 action TEXT NOT NULL,
                 user_id BIGINT,
@@ -138,29 +221,107 @@ def init_db_sync():
                 details TEXT,
                 timestamp TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
             );
-        """))
+        """)
         
         # Migrations for new columns
         migrations = {
             'products': [
                 "ALTER TABLE products ADD COLUMN IF NOT EXISTS republish_count INTEGER DEFAULT 0;",
                 "ALTER TABLE products ADD COLUMN IF NOT EXISTS last_republish_date DATE;",
-                "ALTER TABLE products ADD COLUMN IF NOT EXISTS shipping_options TEXT;",
+                "ALTER TABLE products ADD COLUMN IF NOT EXISTS shipping_options JSONB;",
                 "ALTER TABLE products ADD COLUMN IF NOT EXISTS hashtags TEXT;",
+                # Pre-rendered "a, b, c" shipping list so readers don't have to decode the JSON
+                "ALTER TABLE products ADD COLUMN IF NOT EXISTS shipping_options_text TEXT;",
+                """UPDATE products SET shipping_options_text = (
+                       SELECT string_agg(value, ', ') FROM json_array_elements_text(shipping_options::json)
+                   ) WHERE shipping_options IS NOT NULL AND shipping_options_text IS NULL;""",
+                # Legacy TEXT columns holding JSON -> JSONB (one-off rewrite, skipped once converted)
+                """DO $$ BEGIN
+                       IF (SELECT data_type FROM information_schema.columns
+                           WHERE table_name = 'products' AND column_name = 'photos') = 'text' THEN
+                           ALTER TABLE products
+                               ALTER COLUMN photos TYPE jsonb USING photos::jsonb,
+                               ALTER COLUMN geolocation TYPE jsonb USING geolocation::jsonb,
+                               ALTER COLUMN shipping_options TYPE jsonb USING shipping_options::jsonb;
+                       END IF;
+                   END $$;""",
+                # Covering partial index: favorites JOIN in send_my_products becomes an index-only scan
+                """CREATE INDEX IF NOT EXISTS idx_products_approved_id ON products (id)
+                   INCLUDE (product_name, price, channel_message_id, created_at) WHERE status = 'approved';""",
+                # Moderation queue: only pending rows are indexed, already in display order
+                """CREATE INDEX IF NOT EXISTS idx_products_pending_created_at ON products (created_at)
+                   WHERE status = 'pending';""",
+                # "My products": a seller's rows newest first, without a sort
+                "CREATE INDEX IF NOT EXISTS idx_products_seller_created ON products (seller_chat_id, created_at DESC);",
+                # Containment filters on shipping (shipping_options @> '["Нова Пошта"]') use the index instead of a scan
+                "CREATE INDEX IF NOT EXISTS idx_products_shipping ON products USING GIN (shipping_options jsonb_path_ops);",
             ],
             'users': [
-                "ALTER TABLE users ADD COLUMN IF NOT EXISTS referrer_id BIGINT;"
-            ]
+                "ALTER TABLE users ADD COLUMN IF NOT EXISTS referrer_id BIGINT;",
+                # @username lookups in the admin block/unblock flow
+                "CREATE INDEX IF NOT EXISTS idx_users_username ON users (username);",
+                # Referral leaderboard and raffle: recent joins grouped by referrer
+                """CREATE INDEX IF NOT EXISTS idx_users_referrer_joined ON users (referrer_id, joined_at)
+                   WHERE referrer_id IS NOT NULL;""",
+            ],
+            'statistics': [
+                # Append-only event log: skipping WAL is worth losing the last events on a crash
+                "ALTER TABLE statistics SET UNLOGGED;",
+            ],
+            'conversations': [
+                # Daily AI load in the admin panel range-scans only recent user messages
+                """CREATE INDEX IF NOT EXISTS idx_conv_user_ts ON conversations (timestamp DESC)
+                   WHERE sender_type = 'user';""",
+                # AI chat context: last N messages of one user read straight off the index
+                "CREATE INDEX IF NOT EXISTS idx_conversations_user_ts ON conversations (user_chat_id, timestamp DESC);",
+            ],
+            # Pre-aggregated admin panel counters, refreshed in the background (see refresh_admin_views_loop).
+            # The constant id column is the unique key REFRESH ... CONCURRENTLY needs.
+            'mv_admin_stats': [
+                """CREATE MATERIALIZED VIEW IF NOT EXISTS mv_admin_stats AS
+                   WITH p AS (
+                       SELECT status, COUNT(*) AS c, COUNT(*) FILTER (WHERE created_at >= CURRENT_DATE) AS today
+                       FROM products GROUP BY status
+                   ), u AS (
+                       SELECT COUNT(*) AS total, COUNT(*) FILTER (WHERE is_blocked) AS blocked FROM users
+                   )
+                   SELECT 1 AS id, u.total AS total_users, u.blocked AS blocked_users,
+                          (SELECT COALESCE(SUM(today), 0) FROM p) AS today_products,
+                          (SELECT json_object_agg(status, c) FROM p) AS status_counts,
+                          now() AS refreshed_at
+                   FROM u;""",
+                "CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_admin_stats_id ON mv_admin_stats (id);",
+            ],
+            'mv_commission_summary': [
+                """CREATE MATERIALIZED VIEW IF NOT EXISTS mv_commission_summary AS
+                   SELECT 1 AS id,
+                          SUM(CASE WHEN status = 'pending_payment' THEN amount ELSE 0 END) AS total_pending,
+                          SUM(CASE WHEN status = 'paid' THEN amount ELSE 0 END) AS total_paid,
+                          now() AS refreshed_at
+                   FROM commission_transactions;""",
+                "CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_commission_summary_id ON mv_commission_summary (id);",
+            ],
         }
-        for table, columns in migrations.items():
-            for column_sql in columns:
-                try:
-                    cur.execute(pg_sql.SQL(column_sql))
-                    conn.commit()
-                    logger.info(f"Міграція для таблиці '{table}' успішно застосована.")
-                except psycopg2.Error as e:
-                    logger.warning(f"Помилка міграції: {e}")
-                    conn.rollback() 
+        # Every migration is idempotent, so they normally go as one statement batch. Tables and migrations
+        # are committed once at the end; savepoints undo only a failed batch or a single failed migration
+        cur.execute("SAVEPOINT migrations;")
+        try:
+            cur.execute("\n".join(sql for columns in migrations.values() for sql in columns))
+            logger.info("Міграції схеми застосовано одним пакетом.")
+        except psycopg2.Error as e:
+            logger.warning(f"Пакетна міграція не вдалася, застосовуємо по одній: {e}")
+            cur.execute("ROLLBACK TO SAVEPOINT migrations;")
+            for table, columns in migrations.items():
+                for column_sql in columns:
+                    cur.execute("SAVEPOINT migration;")
+                    try:
+                        cur.execute(column_sql)
+                        logger.info(f"Міграція для таблиці '{table}' успішно застосована.")
+                    except psycopg2.Error as e:
+                        logger.warning(f"Помилка міграції: {e}")
+                        cur.execute("ROLLBACK TO SAVEPOINT migration;")
+                    else:
+                        cur.execute("RELEASE SAVEPOINT migration;")
         conn.commit() 
         logger.info("Таблиці БД успішно ініціалізовано або оновлено.")
     except Exception as e:
@@ -170,9 +331,32 @@ def init_db_sync():
     finally:
         if conn: conn.close()
 
-user_data = {} # Stores temporary user data
+# Temporary per-user flow state; abandoned flows expire after USER_DATA_TTL instead of living until restart
+USER_DATA_MAXSIZE = 10000
+USER_DATA_TTL = 3600
+user_data = TTLCache(maxsize=USER_DATA_MAXSIZE, ttl=USER_DATA_TTL)
+
+# product_id -> product_name for the latest products shown to the moderator,
+# so moderator actions don't have to query the DB for data the admin already saw
+REVIEW_CACHE_SIZE = 500
+review_product_names = OrderedDict()
 
-async def async_error_handler(func):
+def remember_review_product(product_id, product_name):
+    review_product_names[product_id] = product_name
+    review_product_names.move_to_end(product_id)
+    if len(review_product_names) > REVIEW_CACHE_SIZE:
+        review_product_names.popitem(last=False)
+
+# Error notifications must not hold up the failing handler, and must not hang if Telegram itself is failing
+ERROR_NOTIFY_TIMEOUT = 2
+
+async def notify_error(chat_id, text):
+    try:
+        await asyncio.wait_for(bot.send_message(chat_id, text), ERROR_NOTIFY_TIMEOUT)
+    except Exception as e_notify:
+        logger.error(f"Не вдалося надіслати повідомлення про помилку: {e_notify}")
+
+def async_error_handler(func):
     """Decorator for async error handling."""
     async def wrapper(*args, **kwargs):
         try:
@@ -188,60 +372,62 @@ async def async_error_handler(func):
                 elif isinstance(first_arg, types.CallbackQuery):
                     chat_id_to_notify = first_arg.message.chat.id
             
-            try:
-                await bot.send_message(ADMIN_CHAT_ID, f"🚨 Критична помилка в боті!\nФункція: `{func.__name__}`\nПомилка: `{e}`")
-                if chat_id_to_notify != ADMIN_CHAT_ID:
-                    await bot.send_message(chat_id_to_notify, "😔 Вибачте, сталася внутрішня помилка. Адміністратор вже сповіщений.")
-            except Exception as e_notify:
-                logger.error(f"Не вдалося надіслати повідомлення про помилку: {e_notify}")
+            run_in_background(notify_error(ADMIN_CHAT_ID, f"🚨 Критична помилка в боті!\nФункція: `{func.__name__}`\nПомилка: `{e}`"))
+            if chat_id_to_notify != ADMIN_CHAT_ID:
+                run_in_background(notify_error(chat_id_to_notify, "😔 Вибачте, сталася внутрішня помилка. Адміністратор вже сповіщений."))
     return wrapper
 
 @async_error_handler
 async def save_user(message_or_user, referrer_id=None):
-    pool = await get_db_connection_async()
-    async with pool.acquire() as conn:
-        user = None
-        chat_id = None
-
-        if isinstance(message_or_user, types.Message):
-            user = message_or_user.from_user
-            chat_id = message_or_user.chat.id
-        elif isinstance(message_or_user, types.User):
-            user = message_or_user
-            chat_id = user.id
-        else:
-            logger.warning(f"save_user отримав невідомий тип: {type(message_or_user)}")
-            return
+    user = None
+    chat_id = None
+
+    if isinstance(message_or_user, types.Message):
+        user = message_or_user.from_user
+        chat_id = message_or_user.chat.id
+    elif isinstance(message_or_user, types.User):
+        user = message_or_user
+        chat_id = user.id
+    else:
+        logger.warning(f"save_user отримав невідомий тип: {type(message_or_user)}")
+        return
 
-        if not user or not chat_id: return
+    if not user or not chat_id: return
 
-        try:
-            existing_user = await conn.fetchrow("SELECT chat_id, referrer_id FROM users WHERE chat_id = $1;", chat_id)
+    try:
+        # Single upsert; referrer_id is only ever set by the INSERT branch, so existing users keep theirs
+        pool = await get_db_connection_async()
+        await pool.execute("""
+            INSERT INTO users (chat_id, username, first_name, last_name, referrer_id)
+            VALUES ($1, $2, $3, $4, $5)
+            ON CONFLICT (chat_id) DO UPDATE SET
+                username = EXCLUDED.username, first_name = EXCLUDED.first_name,
+                last_name = EXCLUDED.last_name, last_activity = CURRENT_TIMESTAMP;
+        """, chat_id, user.username, user.first_name, user.last_name, referrer_id)
+    except Exception as e:
+        logger.error(f"Помилка при збереженні користувача {chat_id}: {e}", exc_info=True)
 
-            if existing_user:
-                await conn.execute("""
-                    UPDATE users SET username = $1, first_name = $2, last_name = $3, last_activity = CURRENT_TIMESTAMP
-                    WHERE chat_id = $4;
-                """, user.username, user.first_name, user.last_name, chat_id)
-            else:
-                await conn.execute("""
-                    INSERT INTO users (chat_id, username, first_name, last_name, referrer_id)
-                    VALUES ($1, $2, $3, $4, $5)
-                    ON CONFLICT (chat_id) DO NOTHING; 
-                """, chat_id, user.username, user.first_name, user.last_name, referrer_id)
-        except Exception as e:
-            logger.error(f"Помилка при збереженні користувача {chat_id}: {e}", exc_info=True)
+# Blocked users are few, so the whole set is kept in memory and reloaded at most
+# once per BLOCKED_CACHE_TTL instead of hitting the DB on every incoming message
+BLOCKED_CACHE_TTL = 60
+blocked_users = set()
+blocked_users_loaded_at = None
 
 @async_error_handler
 async def is_user_blocked(chat_id):
-    pool = await get_db_connection_async()
-    async with pool.acquire() as conn:
-        try:
-            result = await conn.fetchval("SELECT is_blocked FROM users WHERE chat_id = $1;", chat_id)
-            return result
-        except Exception as e:
-            logger.error(f"Помилка перевірки блокування для {chat_id}: {e}", exc_info=True)
-            return True
+    global blocked_users, blocked_users_loaded_at
+    if blocked_users_loaded_at is None or time.monotonic() - blocked_users_loaded_at > BLOCKED_CACHE_TTL:
+        pool = await get_db_connection_async()
+        async with pool.acquire() as conn:
+            try:
+                rows = await conn.fetch("SELECT chat_id FROM users WHERE is_blocked = TRUE;")
+                blocked_users = {row['chat_id'] for row in rows}
+                blocked_users_loaded_at = time.monotonic()
+            except Exception as e:
+                logger.error(f"Помилка перевірки блокування для {chat_id}: {e}", exc_info=True)
+                if blocked_users_loaded_at is None:
+                    return True
+    return chat_id in blocked_users
 
 @async_error_handler
 async def set_user_block_status(admin_id, chat_id, status):
@@ -258,38 +444,182 @@ async def set_user_block_status(admin_id, chat_id, status):
                     UPDATE users SET is_blocked = FALSE, blocked_by = NULL, blocked_at = NULL
                     WHERE chat_id = $1;
                 """, chat_id)
+            if status:
+                blocked_users.add(chat_id)
+            else:
+                blocked_users.discard(chat_id)
             return True
         except Exception as e:
             logger.error(f"Помилка при встановленні статусу блокування для користувача {chat_id}: {e}", exc_info=True)
             return False
 
+HASHTAG_WORD_RE = re.compile(r'\b\w+\b')
+HASHTAG_STOPWORDS = frozenset([
+    'я', 'ми', 'ти', 'ви', 'він', 'вона', 'воно', 'вони', 'це', 'що',
+    'як', 'де', 'коли', 'а', 'і', 'та', 'або', 'чи', 'для', 'з', 'на',
+    'у', 'в', 'до', 'від', 'по', 'за', 'при', 'про', 'між', 'під', 'над',
+    'без', 'через', 'дуже', 'цей', 'той', 'мій', 'твій', 'наш', 'ваш',
+    'продам', 'продамся', 'продати', 'продаю', 'продаж', 'купити', 'куплю',
+    'бу', 'новий', 'стан', 'модель', 'см', 'кг', 'грн', 'uah', 'usd', 'eur', 
+    'один', 'два', 'три', 'чотири', 'пять', 'шість', 'сім', 'вісім', 'девять', 'десять'
+])
+
+# Pure function of the description: moderation views and re-publishes reuse earlier results
+@lru_cache(maxsize=4096)
 def generate_hashtags(description, num_hashtags=5):
-    words = re.findall(r'\b\w+\b', description.lower())
-    stopwords = set([
-        'я', 'ми', 'ти', 'ви', 'він', 'вона', 'воно', 'вони', 'це', 'що',
-        'як', 'де', 'коли', 'а', 'і', 'та', 'або', 'чи', 'для', 'з', 'на',
-        'у', 'в', 'до', 'від', 'по', 'за', 'при', 'про', 'між', 'під', 'над',
-        'без', 'через', 'дуже', 'цей', 'той', 'мій', 'твій', 'наш', 'ваш',
-        'продам', 'продамся', 'продати', 'продаю', 'продаж', 'купити', 'куплю',
-        'бу', 'новий', 'стан', 'модель', 'см', 'кг', 'грн', 'uah', 'usd', 'eur', 
-        'один', 'два', 'три', 'чотири', 'пять', 'шість', 'сім', 'вісім', 'девять', 'десять'
-    ])
-    filtered_words = [word for word in words if len(word) > 2 and word not in stopwords]
-    unique_words = list(dict.fromkeys(filtered_words)) 
-    hashtags = ['#' + word for word in unique_words[:num_hashtags]] 
-    return " ".join(hashtags) if hashtags else ""
+    # One pass in text order, stopping as soon as enough distinct words are found
+    hashtags = []
+    seen = set()
+    for word in HASHTAG_WORD_RE.findall(description.lower()):
+        if len(word) > 2 and word not in HASHTAG_STOPWORDS and word not in seen:
+            seen.add(word)
+            hashtags.append('#' + word)
+            if len(hashtags) == num_hashtags:
+                break
+    return " ".join(hashtags)
+
+# Statistics events are queued and written in batches by a background task,
+# so handlers never wait for a stats INSERT
+STATS_QUEUE_MAXSIZE = 10000
+STATS_BATCH_SIZE = 500
+STATS_FLUSH_INTERVAL = 1.0
+stats_queue = None
+stats_flusher_task = None
+
+async def write_statistics_batch(batch):
+    try:
+        pool = await get_db_connection_async()
+        async with pool.acquire() as conn:
+            await conn.executemany('''
+                INSERT INTO statistics (action, user_id, product_id, details, timestamp)
+                VALUES ($1, $2, $3, $4, $5)
+            ''', batch)
+    except Exception as e:
+        logger.error(f"Помилка логування статистики ({len(batch)} подій): {e}", exc_info=True)
+
+async def flush_statistics_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await stats_queue.get()]
+        deadline = loop.time() + STATS_FLUSH_INTERVAL
+        try:
+            while len(batch) < STATS_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(stats_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+        except asyncio.CancelledError:
+            # Shutdown while collecting: these events are already off the queue, write them before stopping
+            await write_statistics_batch(batch)
+            raise
+        # A cancel during the write must not drop the batch halfway
+        await asyncio.shield(write_statistics_batch(batch))
+
+async def drain_statistics_queue():
+    # Shutdown: stop the flusher, then write whatever is still queued while the pool is open
+    if stats_flusher_task is not None:
+        stats_flusher_task.cancel()
+        await asyncio.gather(stats_flusher_task, return_exceptions=True)
+    if stats_queue is None:
+        return
+    batch = []
+    while not stats_queue.empty():
+        batch.append(stats_queue.get_nowait())
+    if batch:
+        await write_statistics_batch(batch)
+
+# Channel sync and other fire-and-forget work; references are kept until each task finishes
+background_tasks = set()
+
+def log_background_failure(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error(f"Помилка фонового завдання: {task.exception()}", exc_info=task.exception())
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(log_background_failure)
+    return task
+
+# chat_id -> (username, fetched_at) for users resolved via bot.get_chat; bounded LRU with TTL
+CHAT_USERNAME_TTL = 3600
+CHAT_USERNAME_CACHE_SIZE = 10000
+chat_username_cache = OrderedDict()
+
+async def get_chat_username(chat_id):
+    cached = chat_username_cache.get(chat_id)
+    if cached and time.monotonic() - cached[1] < CHAT_USERNAME_TTL:
+        chat_username_cache.move_to_end(chat_id)
+        return cached[0]
+    try:
+        user_info = await bot.get_chat(chat_id)
+    except Exception as e:
+        logger.warning(f"Не вдалося отримати інфо про користувача {chat_id}: {e}")
+        return None
+    chat_username_cache[chat_id] = (user_info.username, time.monotonic())
+    chat_username_cache.move_to_end(chat_id)
+    if len(chat_username_cache) > CHAT_USERNAME_CACHE_SIZE:
+        chat_username_cache.popitem(last=False)
+    return user_info.username
 
 @async_error_handler
 async def log_statistics(action, user_id=None, product_id=None, details=None):
-    pool = await get_db_connection_async()
-    async with pool.acquire() as conn:
-        try:
-            await conn.execute('''
-                INSERT INTO statistics (action, user_id, product_id, details)
-                VALUES ($1, $2, $3, $4)
-            ''', action, user_id, product_id, details)
-        except Exception as e:
-            logger.error(f"Помилка логування статистики: {e}", exc_info=True)
+    global stats_queue, stats_flusher_task
+    if stats_flusher_task is None or stats_flusher_task.done():
+        if stats_queue is None:
+            stats_queue = asyncio.Queue(maxsize=STATS_QUEUE_MAXSIZE)
+        stats_flusher_task = asyncio.create_task(flush_statistics_loop())
+    try:
+        stats_queue.put_nowait((action, user_id, product_id, details, datetime.now(timezone.utc)))
+    except asyncio.QueueFull:
+        logger.warning(f"Черга статистики переповнена, подію '{action}' пропущено.")
+
+# chat_id -> last seen time; written in one UPDATE every ACTIVITY_FLUSH_INTERVAL seconds
+# instead of one UPDATE per incoming message
+ACTIVITY_FLUSH_INTERVAL = 5.0
+pending_activity = {}
+activity_flusher_task = None
+
+async def flush_user_activity():
+    global pending_activity
+    if not pending_activity:
+        return
+    batch, pending_activity = pending_activity, {}
+    try:
+        pool = await get_db_connection_async()
+        await pool.execute("""
+            UPDATE users SET last_activity = v.ts
+            FROM unnest($1::bigint[], $2::timestamptz[]) AS v(chat_id, ts)
+            WHERE users.chat_id = v.chat_id
+        """, list(batch.keys()), list(batch.values()))
+    except Exception as e:
+        logger.error(f"Помилка оновлення активності ({len(batch)} користувачів): {e}", exc_info=True)
+
+async def flush_activity_loop():
+    while True:
+        await asyncio.sleep(ACTIVITY_FLUSH_INTERVAL)
+        await flush_user_activity()
+
+def touch_user_activity(chat_id):
+    global activity_flusher_task
+    if activity_flusher_task is None or activity_flusher_task.done():
+        activity_flusher_task = asyncio.create_task(flush_activity_loop())
+    pending_activity[chat_id] = datetime.now(timezone.utc)
+
+# One keep-alive session to Gemini for the whole process instead of a new TCP+TLS handshake per prompt
+GEMINI_TIMEOUT = aiohttp.ClientTimeout(total=30, connect=5)
+gemini_session = None
+
+def get_gemini_session():
+    global gemini_session
+    if gemini_session is None or gemini_session.closed:
+        # API key travels as a session header rather than in the URL (and so never shows up in logged errors)
+        gemini_session = aiohttp.ClientSession(timeout=GEMINI_TIMEOUT, headers={"x-goog-api-key": GEMINI_API_KEY})
+    return gemini_session
 
 @async_error_handler
 async def get_gemini_response(prompt, conversation_history=None):
@@ -314,18 +644,16 @@ async def get_gemini_response(prompt, conversation_history=None):
     payload = { "contents": gemini_messages }
 
     try:
-        async with aiohttp.ClientSession() as session:
-            api_url = f"{GEMINI_API_URL}?key={GEMINI_API_KEY}"
-            async with session.post(api_url, json=payload, timeout=30) as response:
-                response.raise_for_status() 
-                data = await response.json()
-                if data.get("candidates") and len(data["candidates"]) > 0 and \
-                   data["candidates"][0].get("content") and data["candidates"][0]["content"].get("parts"):
-                    content = data["candidates"][0]["content"]["parts"][0]["text"]
-                    return content.strip()
-                else:
-                    logger.error(f"Неочікувана структура відповіді від Gemini: {data}")
-                    return generate_elon_style_response(prompt) 
+        async with get_gemini_session().post(GEMINI_API_URL, json=payload) as response:
+            response.raise_for_status() 
+            data = await response.json()
+            if data.get("candidates") and len(data["candidates"]) > 0 and \
+               data["candidates"][0].get("content") and data["candidates"][0]["content"].get("parts"):
+                content = data["candidates"][0]["content"]["parts"][0]["text"]
+                return content.strip()
+            else:
+                logger.error(f"Неочікувана структура відповіді від Gemini: {data}")
+                return generate_elon_style_response(prompt) 
     except aiohttp.ClientError as e:
         logger.error(f"Помилка HTTP запиту до Gemini API: {e}", exc_info=True)
         return generate_elon_style_response(prompt) 
@@ -372,19 +700,19 @@ async def save_conversation(chat_id, message_text, sender_type, product_id=None)
 @async_error_handler
 async def get_conversation_history(chat_id, limit=5):
     pool = await get_db_connection_async()
-    async with pool.acquire() as conn:
-        try:
-            results = await conn.fetch('''
-                SELECT message_text, sender_type FROM conversations 
+    try:
+        # Last N messages, returned oldest first by the query itself; Records are read by key like dicts
+        return await pool.fetch('''
+            SELECT message_text, sender_type FROM (
+                SELECT message_text, sender_type, timestamp FROM conversations 
                 WHERE user_chat_id = $1 
                 ORDER BY timestamp DESC LIMIT $2
-            ''', chat_id, limit)
-            history = [{"message_text": row['message_text'], "sender_type": row['sender_type']} 
-                       for row in reversed(results)]
-            return history
-        except Exception as e:
-            logger.error(f"Помилка отримання історії розмов: {e}", exc_info=True)
-            return []
+            ) recent
+            ORDER BY timestamp ASC
+        ''', chat_id, limit)
+    except Exception as e:
+        logger.error(f"Помилка отримання історії розмов: {e}", exc_info=True)
+        return []
 
 main_menu_markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
 main_menu_markup.add(types.KeyboardButton("📦 Додати товар"), types.KeyboardButton("📋 Мої товари"))
@@ -402,6 +730,30 @@ ADD_PRODUCT_STEPS = {
     5: {'name': 'waiting_shipping', 'prompt': "🚚 *Крок 5/6: Доставка*\n\nОберіть доступні способи доставки (можна обрати декілька):", 'next_step': 6, 'prev_step': 4}, 
     6: {'name': 'waiting_description', 'prompt': "✍️ *Крок 6/6: Опис*\n\nНапишіть детальний опис товару:", 'next_step': 'confirm', 'prev_step': 5}
 }
+MAX_PRODUCT_PHOTOS = 5
+
+PRODUCT_STATUS_EMOJI = {'pending': '⏳', 'approved': '✅', 'rejected': '❌', 'sold': '💰', 'expired': '🗑️'}
+PRODUCT_STATUS_UKR = {'pending': 'на розгляді', 'approved': 'опубліковано', 'rejected': 'відхилено', 'sold': 'продано', 'expired': 'термін дії закінчився'}
+
+# Channel post links have the form https://t.me/c/<id without -100>/<message_id>
+CHANNEL_LINK_PART = str(CHANNEL_ID).replace("-100", "")
+CHANNEL_URL_PREFIX = f"https://t.me/c/{CHANNEL_LINK_PART}/"
+
+SHIPPING_OPTIONS = ("Наложка Нова Пошта", "Наложка Укрпошта", "Особиста зустріч")
+
+# One keyboard per combination of ticked options (bit i is SHIPPING_OPTIONS[i]), built on first use
+@lru_cache(maxsize=2 ** len(SHIPPING_OPTIONS))
+def shipping_markup(selected_mask):
+    inline_markup = types.InlineKeyboardMarkup(row_width=2)
+    inline_markup.add(*(
+        types.InlineKeyboardButton(f"{'✅ ' if selected_mask & (1 << i) else ''}{opt}", callback_data=f"shipping_{opt}")
+        for i, opt in enumerate(SHIPPING_OPTIONS)
+    ))
+    inline_markup.add(types.InlineKeyboardButton("Далі ➡️", callback_data="shipping_next"))
+    return inline_markup
+
+def shipping_markup_for(selected):
+    return shipping_markup(sum(1 << i for i, opt in enumerate(SHIPPING_OPTIONS) if opt in selected))
 
 @async_error_handler
 async def start_add_product_flow(message):
@@ -410,7 +762,8 @@ async def start_add_product_flow(message):
         'flow': 'add_product', 
         'step_number': 1, 
         'data': {
-            'photos': [], 
+            'photos': [None] * MAX_PRODUCT_PHOTOS, # fixed slots, filled up to photo_count
+            'photo_count': 0,
             'geolocation': None,
             'shipping_options': [], 
             'product_name': '',
@@ -439,18 +792,7 @@ async def send_product_step_message(chat_id):
         markup.add(types.KeyboardButton("📍 Надіслати геолокацію", request_location=True))
         markup.add(types.KeyboardButton(step_config['skip_button']))
     elif step_config['name'] == 'waiting_shipping':
-        inline_markup = types.InlineKeyboardMarkup(row_width=2)
-        shipping_options_list = ["Наложка Нова Пошта", "Наложка Укрпошта", "Особиста зустріч"] 
-        selected_options = user_data[chat_id]['data'].get('shipping_options', [])
-
-        buttons = []
-        for opt in shipping_options_list:
-            emoji = '✅ ' if opt in selected else ''
-            buttons.append(types.InlineKeyboardButton(f"{emoji}{opt}", callback_data=f"shipping_{opt}"))
-        
-        inline_markup.add(*buttons)
-        inline_markup.add(types.InlineKeyboardButton("Далі ➡️", callback_data="shipping_next"))
-        
+        inline_markup = shipping_markup_for(user_data[chat_id]['data'].get('shipping_options', []))
         await bot.send_message(chat_id, step_config['prompt'], parse_mode='Markdown', reply_markup=inline_markup)
         return 
     
@@ -518,7 +860,8 @@ async def process_product_step(message):
     elif step_config['name'] == 'waiting_description':
         if user_text and 10 <= len(user_text) <= 1000:
             user_data[chat_id]['data']['description'] = user_text
-            user_data[chat_id]['data']['hashtags'] = generate_hashtags(user_text) 
+            # Hashtags are computed in a worker thread while confirm_and_send_for_moderation talks to Telegram
+            user_data[chat_id]['data']['hashtags_future'] = asyncio.get_running_loop().run_in_executor(None, generate_hashtags, user_text)
             await confirm_and_send_for_moderation(chat_id) 
         else:
             await bot.send_message(chat_id, "Опис занадто короткий або занадто довгий (10-1000 символів). Напишіть детальніше:")
@@ -538,11 +881,13 @@ async def go_to_next_step(chat_id):
 async def process_product_photo(message):
     chat_id = message.chat.id
     if chat_id in user_data and user_data[chat_id].get('step') == 'waiting_photos':
-        if len(user_data[chat_id]['data']['photos']) < 5:
-            file_id = message.photo[-1].file_id 
-            user_data[chat_id]['data']['photos'].append(file_id)
-            photos_count = len(user_data[chat_id]['data']['photos'])
-            await bot.send_message(chat_id, f"✅ Фото {photos_count}/5 додано. Надішліть ще або натисніть 'Далі'")
+        data = user_data[chat_id]['data']
+        photos_count = data['photo_count']
+        if photos_count < MAX_PRODUCT_PHOTOS:
+            data['photos'][photos_count] = message.photo[-1].file_id 
+            photos_count += 1
+            data['photo_count'] = photos_count
+            await bot.send_message(chat_id, f"✅ Фото {photos_count}/{MAX_PRODUCT_PHOTOS} додано. Надішліть ще або натисніть 'Далі'")
         else:
             await bot.send_message(chat_id, "Максимум 5 фото. Натисніть 'Далі' для продовження.")
     else:
@@ -567,105 +912,143 @@ async def process_product_location(message):
 @async_error_handler
 async def confirm_and_send_for_moderation(chat_id):
     data = user_data[chat_id]['data']
+    photos = data['photos'][:data['photo_count']]
     pool = await get_db_connection_async()
-    async with pool.acquire() as conn:
-        product_id = None
-        try:
-            user_info = await bot.get_chat(chat_id)
-            seller_username = user_info.username if user_info.username else None
+    product_id = None
+    try:
+        if 'hashtags_future' in data:
+            data['hashtags'] = await data.pop('hashtags_future')
+
+        # seller_username comes from the users row save_user keeps current, not from a get_chat round trip
+        product_id = await pool.fetchval("""
+            INSERT INTO products 
+            (seller_chat_id, seller_username, product_name, price, description, photos, geolocation, shipping_options, shipping_options_text, hashtags, status)
+            VALUES ($1, (SELECT username FROM users WHERE chat_id = $1), $2, $3, $4, $5, $6, $7, $8, $9, 'pending')
+            RETURNING id;
+        """,
+            chat_id, data['product_name'], data['price'], data['description'],
+            photos or None, 
+            data['geolocation'] or None, 
+            data['shipping_options'] or None, 
+            ", ".join(data['shipping_options']) if data['shipping_options'] else None,
+            data['hashtags'], 
+        )
+        
+        await bot.send_message(chat_id, 
+            f"✅ Товар '{data['product_name']}' відправлено на модерацію!\nВи отримаєте сповіщення після перевірки.",
+            reply_markup=main_menu_markup)
+        
+        # The admin notification (photos + review card) runs as a background task, off the seller's update
+        run_in_background(send_product_for_admin_review(product_id))
+        
+        del user_data[chat_id]
+        
+        await log_statistics('product_added', chat_id, product_id)
+        
+    except Exception as e:
+        logger.error(f"Помилка збереження товару: {e}", exc_info=True)
+        await bot.send_message(chat_id, "Помилка збереження товару. Спробуйте пізніше.")
+
+# Static admin keyboards are built once; Telegram only reads them when serialising a request
+BACK_TO_ADMIN_BUTTON = types.InlineKeyboardButton("🔙 Назад до Адмін-панелі", callback_data="admin_panel_main")
+BACK_TO_ADMIN_MARKUP = types.InlineKeyboardMarkup()
+BACK_TO_ADMIN_MARKUP.add(BACK_TO_ADMIN_BUTTON)
+ADMIN_PANEL_MARKUP = types.InlineKeyboardMarkup(row_width=2)
+ADMIN_PANEL_MARKUP.add(
+    types.InlineKeyboardButton("📊 Статистика", callback_data="admin_stats"),
+    types.InlineKeyboardButton("⏳ На модерації", callback_data="admin_pending"),
+    types.InlineKeyboardButton("👥 Користувачі", callback_data="admin_users"),
+    types.InlineKeyboardButton("🚫 Блокування", callback_data="admin_block"),
+    types.InlineKeyboardButton("💰 Комісії", callback_data="admin_commissions"),
+    types.InlineKeyboardButton("🤖 AI Статистика", callback_data="admin_ai_stats"),
+    types.InlineKeyboardButton("🏆 Реферали", callback_data="admin_referrals")
+)
 
-            product_id = await conn.fetchval("""
-                INSERT INTO products 
-                (seller_chat_id, seller_username, product_name, price, description, photos, geolocation, shipping_options, hashtags, status)
-                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, 'pending')
-                RETURNING id;
-            """,
-                chat_id, seller_username, data['product_name'], data['price'], data['description'],
-                json.dumps(data['photos']) if data['photos'] else None, 
-                json.dumps(data['geolocation']) if data['geolocation'] else None, 
-                json.dumps(data['shipping_options']) if data['shipping_options'] else None, 
-                data['hashtags'], 
-            )
-            
-            await bot.send_message(chat_id, 
-                f"✅ Товар '{data['product_name']}' відправлено на модерацію!\nВи отримаєте сповіщення після перевірки.",
-                reply_markup=main_menu_markup)
-            
-            await send_product_for_admin_review(product_id) 
-            
-            del user_data[chat_id]
-            
-            await log_statistics('product_added', chat_id, product_id)
-            
-        except Exception as e:
-            logger.error(f"Помилка збереження товару: {e}", exc_info=True)
-            await bot.send_message(chat_id, "Помилка збереження товару. Спробуйте пізніше.")
+def moderation_markup(product_id, seller_chat_id):
+    """Approve/reject/edit-tags/photo-fix keyboard for one product, two buttons per row."""
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.add(
+        types.InlineKeyboardButton("✅ Схвалити", callback_data=f"approve_{product_id}"),
+        types.InlineKeyboardButton("❌ Відхилити", callback_data=f"reject_{product_id}"),
+        types.InlineKeyboardButton("✏️ Редагувати хештеги", callback_data=f"mod_edit_tags_{product_id}"),
+        types.InlineKeyboardButton("🔄 Запит на виправлення фото", callback_data=f"mod_rotate_photo_{product_id}_{seller_chat_id}"),
+    )
+    return markup
+
+REVIEW_TEMPLATE = (
+    "📦 *Новий товар на модерацію*\n\n"
+    "🆔 ID: {product_id}\n"
+    "📝 Назва: {product_name}\n"
+    "💰 Ціна: {price}\n"
+    "📄 Опис: {description}...\n"
+    "📸 Фото: {photos_count} шт.\n"
+    "📍 Геолокація: {geo_yn}\n"
+    "🚚 Доставка: {shipping_text}\n"
+    "🏷️ Хештеги: {hashtags}\n\n"
+    "👤 Продавець: [{seller_display}](tg://user?id={seller_chat_id})"
+)
 
 @async_error_handler
 async def send_product_for_admin_review(product_id):
     pool = await get_db_connection_async()
+    # The connection goes back to the pool before the (slow) Telegram calls
     async with pool.acquire() as conn:
         data = await conn.fetchrow("""
-            SELECT seller_chat_id, seller_username, product_name, price, description, photos, geolocation, shipping_options, hashtags
+            SELECT seller_chat_id, seller_username, product_name, price, description,
+                   photos, COALESCE(jsonb_array_length(photos), 0) AS photo_count, geolocation, shipping_options_text, hashtags
             FROM products WHERE id = $1;
         """, product_id)
 
-        if not data: return
-
-        seller_chat_id = data['seller_chat_id']
-        seller_username = data['seller_username'] if data['seller_username'] else "Не вказано"
-        photos = json.loads(data['photos']) if data['photos'] else []
-        geolocation = json.loads(data['geolocation']) if data['geolocation'] else None
-        shipping_options_text = ", ".join(json.loads(data['shipping_options'])) if data['shipping_options'] else "Не вказано"
-        hashtags = data['hashtags'] if data['hashtags'] else ""
-
-        review_text = (
-            f"📦 *Новий товар на модерацію*\n\n"
-            f"🆔 ID: {product_id}\n"
-            f"📝 Назва: {data['product_name']}\n"
-            f"💰 Ціна: {data['price']}\n"
-            f"📄 Опис: {data['description'][:500]}...\n" 
-            f"📸 Фото: {len(photos)} шт.\n"
-            f"📍 Геолокація: {'Так' if geolocation else 'Ні'}\n"
-            f"🚚 Доставка: {shipping_options_text}\n" 
-            f"🏷️ Хештеги: {hashtags}\n\n"
-            f"👤 Продавець: [{'@' + seller_username if seller_username != 'Не вказано' else 'Користувач'}](tg://user?id={seller_chat_id})"
-        )
-        
-        markup = types.InlineKeyboardMarkup()
-        markup.add(
-            types.InlineKeyboardButton("✅ Схвалити", callback_data=f"approve_{product_id}"),
-            types.InlineKeyboardButton("❌ Відхилити", callback_data=f"reject_{product_id}")
-        )
-        markup.add(
-            types.InlineKeyboardButton("✏️ Редагувати хештеги", callback_data=f"mod_edit_tags_{product_id}"),
-            types.InlineKeyboardButton("🔄 Запит на виправлення фото", callback_data=f"mod_rotate_photo_{product_id}")
-        )
-        
-        try:
-            admin_msg = None
-            if photos:
-                media = [types.InputMediaPhoto(photo_id, caption=review_text if i == 0 else None, parse_mode='Markdown') 
-                         for i, photo_id in enumerate(photos)]
-                sent_messages = await bot.send_media_group(ADMIN_CHAT_ID, media)
-                
-                if sent_messages:
-                    admin_msg = await bot.send_message(ADMIN_CHAT_ID, 
-                                                 f"👆 Деталі товару ID: {product_id} (фото вище)", 
-                                                 reply_markup=markup, 
-                                                 parse_mode='Markdown',
-                                                 reply_to_message_id=sent_messages[0].message_id)
-                else:
-                    admin_msg = await bot.send_message(ADMIN_CHAT_ID, review_text, parse_mode='Markdown', reply_markup=markup)
+    if not data: return
+
+    seller_chat_id = data['seller_chat_id']
+    photos = data['photos'] or []
+
+    review_text = REVIEW_TEMPLATE.format_map({
+        'product_id': product_id,
+        'product_name': data['product_name'],
+        'price': data['price'],
+        'description': data['description'][:500],
+        'photos_count': data['photo_count'],
+        'geo_yn': 'Так' if data['geolocation'] else 'Ні',
+        'shipping_text': data['shipping_options_text'] or "Не вказано",
+        'hashtags': data['hashtags'] or "",
+        'seller_display': '@' + data['seller_username'] if data['seller_username'] else 'Користувач',
+        'seller_chat_id': seller_chat_id,
+    })
+    
+    markup = moderation_markup(product_id, seller_chat_id)
+    remember_review_product(product_id, data['product_name'])
+    
+    try:
+        admin_msg = None
+        if len(photos) == 1:
+            # A single photo can carry both caption and buttons: one API call instead of two
+            admin_msg = await bot.send_photo(ADMIN_CHAT_ID, photos[0], caption=review_text,
+                                             parse_mode='Markdown', reply_markup=markup)
+        elif photos:
+            media = [types.InputMediaPhoto(photo_id, caption=review_text if i == 0 else None, parse_mode='Markdown') 
+                     for i, photo_id in enumerate(photos)]
+            sent_messages = await bot.send_media_group(ADMIN_CHAT_ID, media)
+            
+            if sent_messages:
+                admin_msg = await bot.send_message(ADMIN_CHAT_ID, 
+                                             f"👆 Деталі товару ID: {product_id} (фото вище)", 
+                                             reply_markup=markup, 
+                                             parse_mode='Markdown',
+                                             reply_to_message_id=sent_messages[0].message_id)
             else:
                 admin_msg = await bot.send_message(ADMIN_CHAT_ID, review_text, parse_mode='Markdown', reply_markup=markup)
-            
-            if admin_msg:
+        else:
+            admin_msg = await bot.send_message(ADMIN_CHAT_ID, review_text, parse_mode='Markdown', reply_markup=markup)
+        
+        if admin_msg:
+            async with pool.acquire() as conn:
                 await conn.execute("UPDATE products SET admin_message_id = $1 WHERE id = $2;",
-                               (admin_msg.message_id, product_id))
+                                   admin_msg.message_id, product_id)
 
-        except Exception as e:
-            logger.error(f"Помилка при відправці товару {product_id} адміністратору: {e}", exc_info=True)
+    except Exception as e:
+        logger.error(f"Помилка при відправці товару {product_id} адміністратору: {e}", exc_info=True)
 
 @bot.message_handler(func=lambda message: True, content_types=['text', 'photo', 'location'])
 @async_error_handler
@@ -677,12 +1060,7 @@ async def handle_messages(message):
         await bot.send_message(chat_id, "❌ Ваш акаунт заблоковано.")
         return
     
-    pool = await get_db_connection_async()
-    async with pool.acquire() as conn:
-        try:
-            await conn.execute("UPDATE users SET last_activity = CURRENT_TIMESTAMP WHERE chat_id = $1", chat_id)
-        except Exception as e:
-            logger.error(f"Помилка оновлення активності {chat_id}: {e}")
+    touch_user_activity(chat_id)
 
     if chat_id in user_data and user_data[chat_id].get('flow'):
         current_flow = user_data[chat_id]['flow']
@@ -701,24 +1079,19 @@ async def handle_messages(message):
             await process_new_hashtags_mod(message)
         return 
 
-    if user_text == "📦 Додати товар":
-        await start_add_product_flow(message)
-    elif user_text == "📋 Мої товари":
-        await send_my_products(message)
-    elif user_text == "📜 Правила":
-        await send_rules_message(message)
-    elif user_text == "❓ Допомога":
-        await send_help_message(message)
-    elif user_text == "📺 Наш канал":
-        await send_channel_link(message)
-    elif user_text == "🤖 AI Помічник":
-        await bot.send_message(chat_id, "Привіт! Я ваш AI помічник. Задайте мені будь-яке питання. (Напишіть '❌ Скасувати' для виходу)", reply_markup=types.ReplyKeyboardRemove())
-        bot.register_next_step_handler(message, handle_ai_chat)
+    handler = MAIN_MENU_DISPATCH.get(user_text)
+    if handler:
+        await handler(message)
     elif message.content_type == 'text': 
         await handle_ai_chat(message)
     else:
         await bot.send_message(chat_id, "Я не зрозумів ваш запит. Спробуйте використати кнопки меню.")
 
+@async_error_handler
+async def start_ai_chat(message):
+    await bot.send_message(message.chat.id, "Привіт! Я ваш AI помічник. Задайте мені будь-яке питання. (Напишіть '❌ Скасувати' для виходу)", reply_markup=types.ReplyKeyboardRemove())
+    bot.register_next_step_handler(message, handle_ai_chat)
+
 @async_error_handler
 async def handle_ai_chat(message):
     chat_id = message.chat.id
@@ -751,7 +1124,8 @@ async def send_my_products(message):
     pool = await get_db_connection_async()
     async with pool.acquire() as conn:
         user_products = await conn.fetch("""
-            SELECT id, product_name, status, price, created_at, channel_message_id, views, republish_count, last_republish_date
+            SELECT id, product_name, status, price, to_char(created_at AT TIME ZONE 'UTC', 'DD.MM.YYYY HH24:MI') AS created_at_str,
+                   channel_message_id, views, republish_count, last_republish_date
             FROM products
             WHERE seller_chat_id = $1
             ORDER BY created_at DESC
@@ -765,17 +1139,18 @@ async def send_my_products(message):
             ORDER BY p.created_at DESC;
         """, chat_id)
 
+    # One message per product (each has its own buttons): only the global limit applies within the listing
+    listing_bot = bot.without_chat_limit()
     if user_products:
-        await bot.send_message(chat_id, "📋 *Ваші товари:*\n\n", parse_mode='Markdown')
+        await listing_bot.send_message(chat_id, "📋 *Ваші товари:*\n\n", parse_mode='Markdown')
 
         for i, product in enumerate(user_products, 1):
             product_id = product['id']
-            status_emoji = {'pending': '⏳', 'approved': '✅', 'rejected': '❌', 'sold': '💰', 'expired': '🗑️'}
-            status_ukr = {'pending': 'на розгляді', 'approved': 'опубліковано', 'rejected': 'відхилено', 'sold': 'продано', 'expired': 'термін дії закінчився'}.get(product['status'], product['status'])
+            status_ukr = PRODUCT_STATUS_UKR.get(product['status'], product['status'])
 
-            created_at_local = product['created_at'].astimezone(timezone.utc).strftime('%d.%m.%Y %H:%M')
+            created_at_local = product['created_at_str']
 
-            product_text = f"{i}. {status_emoji.get(product['status'], '❓')} *{product['product_name']}*\n"
+            product_text = f"{i}. {PRODUCT_STATUS_EMOJI.get(product['status'], '❓')} *{product['product_name']}*\n"
             product_text += f"   💰 {product['price']}\n"
             product_text += f"   📅 {created_at_local}\n"
             product_text += f"   📊 Статус: {status_ukr}\n"
@@ -785,8 +1160,7 @@ async def send_my_products(message):
             if product['status'] == 'approved':
                 product_text += f"   👁️ Перегляди: {product['views']}\n"
                 
-                channel_link_part = str(CHANNEL_ID).replace("-100", "") 
-                channel_url = f"https://t.me/c/{channel_link_part}/{product['channel_message_id']}" if product['channel_message_id'] else None
+                channel_url = f"{CHANNEL_URL_PREFIX}{product['channel_message_id']}" if product['channel_message_id'] else None
                 
                 if channel_url:
                     markup.add(types.InlineKeyboardButton("👀 Переглянути в каналі", url=channel_url))
@@ -815,16 +1189,15 @@ async def send_my_products(message):
             elif product['status'] in ['sold', 'pending', 'rejected', 'expired']: 
                 markup.add(types.InlineKeyboardButton("🗑️ Видалити", callback_data=f"delete_my_{product_id}"))
             
-            await bot.send_message(chat_id, product_text, parse_mode='Markdown', reply_markup=markup, disable_web_page_preview=True)
+            await listing_bot.send_message(chat_id, product_text, parse_mode='Markdown', reply_markup=markup, disable_web_page_preview=True)
 
     else:
         await bot.send_message(chat_id, "📭 Ви ще не додавали жодних товарів.\n\nНатисніть '📦 Додати товар' щоб створити своє перше оголошення!")
     
     if favorite_products:
-        await bot.send_message(chat_id, "\n⭐ *Ваші обрані товари:*\n", parse_mode='Markdown')
+        await listing_bot.send_message(chat_id, "\n⭐ *Ваші обрані товари:*\n", parse_mode='Markdown')
         for fav in favorite_products:
-            channel_link_part = str(CHANNEL_ID).replace("-100", "")
-            url = f"https://t.me/c/{channel_link_part}/{fav['channel_message_id']}" if fav['channel_message_id'] else None
+            url = f"{CHANNEL_URL_PREFIX}{fav['channel_message_id']}" if fav['channel_message_id'] else None
 
             text = (
                 f"*{fav['product_name']}*\n"
@@ -835,7 +1208,7 @@ async def send_my_products(message):
                 fav_markup.add(types.InlineKeyboardButton("👀 Переглянути в каналі", url=url))
             
             fav_markup.add(types.InlineKeyboardButton("💔 Видалити з обраного", callback_data=f"toggle_favorite_{fav['id']}")) 
-            await bot.send_message(chat_id, text, parse_mode='Markdown', reply_markup=fav_markup, disable_web_page_preview=True)
+            await listing_bot.send_message(chat_id, text, parse_mode='Markdown', reply_markup=fav_markup, disable_web_page_preview=True)
     else:
         await bot.send_message(chat_id, "📜 Ваш список обраних порожній. Ви можете додати товар, натиснувши ❤️ під ним у каналі.")
 
@@ -855,22 +1228,23 @@ async def send_rules_message(message):
     markup.add(types.InlineKeyboardButton("💰 Детальніше про комісію", callback_data="show_commission_info"))
     await bot.send_message(message.chat.id, rules_text, parse_mode='Markdown', reply_markup=markup)
 
+HELP_TEXT = (
+    "🆘 *Довідка*\n\n"
+    "🤖 Я ваш AI-помічник для купівлі та продажу. Ви можете:\n"
+    "📦 *Додати товар* - створити оголошення.\n"
+    "📋 *Мої товари* - переглянути ваші активні, продані та обрані товари.\n"
+    "📜 *Правила* - ознайомитись з правилами використання бота.\n" 
+    "📺 *Наш канал* - переглянути всі актуальні пропозиції.\n" 
+    "🤖 *AI Помічник* - поспілкуватися з AI.\n\n"
+    "🗣️ *Спілкування:* Просто пишіть мені ваші запитання або пропозиції, і мій вбудований AI спробує вам допомогти!\n\n"
+    "Якщо виникли технічні проблеми, зверніться до адміністратора."
+)
+HELP_MARKUP = types.InlineKeyboardMarkup()
+HELP_MARKUP.add(types.InlineKeyboardButton("💰 Детальніше про комісію", callback_data="show_commission_info"))
+
 @async_error_handler
 async def send_help_message(message):
-    help_text = (
-        "🆘 *Довідка*\n\n"
-        "🤖 Я ваш AI-помічник для купівлі та продажу. Ви можете:\n"
-        "📦 *Додати товар* - створити оголошення.\n"
-        "📋 *Мої товари* - переглянути ваші активні, продані та обрані товари.\n"
-        "📜 *Правила* - ознайомитись з правилами використання бота.\n" 
-        "📺 *Наш канал* - переглянути всі актуальні пропозиції.\n" 
-        "🤖 *AI Помічник* - поспілкуватися з AI.\n\n"
-        "🗣️ *Спілкування:* Просто пишіть мені ваші запитання або пропозиції, і мій вбудований AI спробує вам допомогти!\n\n"
-        f"Якщо виникли технічні проблеми, зверніться до адміністратора."
-    )
-    markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("💰 Детальніше про комісію", callback_data="show_commission_info"))
-    await bot.send_message(message.chat.id, help_text, parse_mode='Markdown', reply_markup=markup)
+    await bot.send_message(message.chat.id, HELP_TEXT, parse_mode='Markdown', reply_markup=HELP_MARKUP)
 
 @async_error_handler
 async def send_commission_info(call):
@@ -901,8 +1275,7 @@ async def send_channel_link(message):
                 channel_link = invite_link_obj.invite_link
             except Exception as e:
                 logger.warning(f"Не вдалося створити посилання на запрошення для каналу {CHANNEL_ID}: {e}")
-                channel_link_part = str(CHANNEL_ID).replace("-100", "") 
-                channel_link = f"https://t.me/c/{channel_link_part}"
+                channel_link = f"https://t.me/c/{CHANNEL_LINK_PART}"
 
         if not channel_link: raise Exception("Не вдалося сформувати посилання на канал.")
 
@@ -929,61 +1302,41 @@ async def send_channel_link(message):
         logger.error(f"Помилка при отриманні або формуванні посилання на канал: {e}", exc_info=True)
         await bot.send_message(chat_id, "❌ Посилання на канал тимчасово недоступне.")
 
+# Main menu buttons -> handler, one dict lookup per message instead of an if/elif chain of string compares
+MAIN_MENU_DISPATCH = {
+    "📦 Додати товар": start_add_product_flow,
+    "📋 Мої товари": send_my_products,
+    "📜 Правила": send_rules_message,
+    "❓ Допомога": send_help_message,
+    "📺 Наш канал": send_channel_link,
+    "🤖 AI Помічник": start_ai_chat,
+}
+
 @bot.callback_query_handler(func=lambda call: True)
 @async_error_handler
 async def callback_inline(call):
-    action, *params = call.data.split('_') 
-
-    if action == 'admin':
-        await handle_admin_callbacks(call)
-    elif action == 'approve' or action == 'reject':
-        await handle_product_moderation_callbacks(call)
-    elif action == 'mod': 
-        await handle_moderator_actions(call)
-    
-    elif action == 'sold' and call.data.startswith('sold_my_'): 
-        await handle_seller_sold_product(call)
-    elif action == 'delete' and call.data.startswith('delete_my_'): 
-        await handle_delete_my_product(call)
-    elif action == 'republish':
-        await handle_republish_product(call)
-    elif call.data == "republish_limit_reached": 
-        await bot.answer_callback_query(call.id, "Ви вже досягли ліміту переопублікацій на сьогодні.")
-    elif action == 'change' and call.data.startswith('change_price_'): 
-        await handle_change_price_init(call)
-
-    elif action == 'toggle' and call.data.startswith('toggle_favorite_'):
-        await handle_toggle_favorite(call)
-
-    elif action == 'shipping':
-        await handle_shipping_choice(call)
-
-    elif call.data == 'show_commission_info':
-        await send_commission_info(call)
-    elif call.data == 'show_winners_menu': 
-        await handle_winners_menu(call)
-    elif action == 'winners': 
-        await handle_show_winners(call)
-    elif action == 'runraffle': 
-        await handle_run_raffle(call)
-    elif action == 'user' and (call.data.startswith('user_block_') or call.data.startswith('user_unblock_')):
-        await handle_user_block_callbacks(call)
-    
-    else:
-        await bot.answer_callback_query(call.id, "Невідома дія.") 
+    # CALLBACK_ROUTES is built after all handlers are defined (see below); the route's capture groups
+    # are the handler's arguments, so callback_data is parsed exactly once
+    for pattern, handler in CALLBACK_ROUTES:
+        match = pattern.match(call.data)
+        if match:
+            await handler(call, *match.groups())
+            return
+
+    await bot.answer_callback_query(call.id, "Невідома дія.") 
 
 @async_error_handler
-async def handle_admin_callbacks(call):
+async def handle_admin_callbacks(call, action, after_id=None):
     if call.message.chat.id != ADMIN_CHAT_ID:
         await bot.answer_callback_query(call.id, "❌ Доступ заборонено.")
         return
 
-    action = call.data.split('_')[1]
 
     if action == "stats":
         await send_admin_statistics(call)
     elif action == "pending": 
-        await send_pending_products_for_moderation(call)
+        # admin_pending_<id>: next page, starting after the last product already shown
+        await send_pending_products_for_moderation(call, int(after_id) if after_id else None)
     elif action == "users": 
         await send_users_list(call)
     elif action == "block": 
@@ -1000,18 +1353,59 @@ async def handle_admin_callbacks(call):
 
     await bot.answer_callback_query(call.id) 
 
+ADMIN_VIEWS = ('mv_admin_stats', 'mv_commission_summary')
+ADMIN_VIEWS_REFRESH_INTERVAL = 300 # seconds
+admin_views_task = None
+
+async def refresh_admin_views_loop():
+    while True:
+        pool = await get_db_connection_async()
+        for view in ADMIN_VIEWS:
+            try:
+                async with pool.acquire() as conn:
+                    await conn.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {view};")
+            except Exception as e:
+                logger.warning(f"Не вдалося оновити {view}: {e}")
+        await asyncio.sleep(ADMIN_VIEWS_REFRESH_INTERVAL)
+
+def ensure_admin_views_refresher():
+    global admin_views_task
+    if admin_views_task is None or admin_views_task.done():
+        admin_views_task = asyncio.create_task(refresh_admin_views_loop())
+
+def format_refreshed_at(refreshed_at):
+    return f"\n🕒 _Оновлено: {refreshed_at.astimezone(timezone.utc).strftime('%d.%m.%Y %H:%M')} UTC_" if refreshed_at else ""
+
 @async_error_handler
 async def send_admin_statistics(call):
+    ensure_admin_views_refresher()
     pool = await get_db_connection_async()
+    today_start_utc = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
     async with pool.acquire() as conn:
-        product_stats_raw = await conn.fetch("SELECT status, COUNT(*) FROM products GROUP BY status;")
-        product_stats = dict(product_stats_raw)
-
-        total_users = await conn.fetchval("SELECT COUNT(*) FROM users;")
-        blocked_users_count = await conn.fetchval("SELECT COUNT(*) FROM users WHERE is_blocked = TRUE;")
-
-        today_utc = datetime.now(timezone.utc).date()
-        today_products = await conn.fetchval("SELECT COUNT(*) FROM products WHERE DATE(created_at) = $1;", today_utc)
+        try:
+            stats = await conn.fetchrow("SELECT * FROM mv_admin_stats;")
+        except asyncpg.UndefinedTableError:
+            stats = None
+        if stats is None:
+            # Live fallback (view not created yet): one round-trip, products and users scanned once
+            stats = await conn.fetchrow("""
+                WITH p AS (
+                    SELECT status, COUNT(*) AS c, COUNT(*) FILTER (WHERE created_at >= $1) AS today
+                    FROM products GROUP BY status
+                ), u AS (
+                    SELECT COUNT(*) AS total, COUNT(*) FILTER (WHERE is_blocked) AS blocked FROM users
+                )
+                SELECT u.total AS total_users, u.blocked AS blocked_users,
+                       (SELECT COALESCE(SUM(today), 0) FROM p) AS today_products,
+                       (SELECT json_object_agg(status, c) FROM p) AS status_counts,
+                       NULL::timestamptz AS refreshed_at
+                FROM u;
+            """, today_start_utc)
+
+    product_stats = stats['status_counts'] or {}
+    total_users = stats['total_users']
+    blocked_users_count = stats['blocked_users']
+    today_products = stats['today_products']
         
     stats_text = (
         f"📊 *Статистика бота*\n\n"
@@ -1026,13 +1420,11 @@ async def send_admin_statistics(call):
         f"• Термін дії закінчився: {product_stats.get('expired', 0)}\n\n"
         f"📅 *Сьогодні додано:* {today_products}\n"
         f"📈 *Всього товарів:* {sum(product_stats.values())}\n"
+        f"{format_refreshed_at(stats['refreshed_at'])}"
     )
 
-    markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("🔙 Назад до Адмін-панелі", callback_data="admin_panel_main"))
-
     await bot.edit_message_text(stats_text, call.message.chat.id, call.message.message_id,
-                         parse_mode='Markdown', reply_markup=markup)
+                         parse_mode='Markdown', reply_markup=BACK_TO_ADMIN_MARKUP)
 
 @async_error_handler
 async def send_users_list(call):
@@ -1043,71 +1435,64 @@ async def send_users_list(call):
     if not users:
         response_text = "🤷‍♂️ Немає зареєстрованих користувачів."
     else:
-        response_text = "👥 *Список останніх користувачів:*\n\n"
+        parts = ["👥 *Список останніх користувачів:*\n\n"]
         for user in users:
             block_status = "🚫 Заблоковано" if user['is_blocked'] else "✅ Активний"
             username = f"@{user['username']}" if user['username'] else "Немає юзернейму"
             first_name = user['first_name'] if user['first_name'] else "Невідоме ім'я"
-            response_text += f"- {first_name} ({username}) [ID: `{user['chat_id']}`] - {block_status}\n"
-
-    markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("🔙 Назад до Адмін-панелі", callback_data="admin_panel_main"))
+            parts.append(f"- {first_name} ({username}) [ID: `{user['chat_id']}`] - {block_status}\n")
+        response_text = "".join(parts)
 
     await bot.edit_message_text(response_text, call.message.chat.id, call.message.message_id,
-                         parse_mode='Markdown', reply_markup=markup)
+                         parse_mode='Markdown', reply_markup=BACK_TO_ADMIN_MARKUP)
 
 @async_error_handler
 async def process_user_for_block_unblock(message):
     admin_chat_id = message.chat.id
     target_identifier = message.text.strip()
-    target_chat_id = None
 
     pool = await get_db_connection_async()
-    async with pool.acquire() as conn:
-        if target_identifier.startswith('@'): 
-            username = target_identifier[1:]
-            result = await conn.fetchrow("SELECT chat_id FROM users WHERE username = $1;", username)
-            if result:
-                target_chat_id = result['chat_id']
-            else:
-                await bot.send_message(admin_chat_id, f"Користувача з юзернеймом `{target_identifier}` не знайдено.")
-                return
-        else: 
-            try:
-                target_chat_id = int(target_identifier)
-                if not await conn.fetchrow("SELECT chat_id FROM users WHERE chat_id = $1;", target_chat_id):
-                    await bot.send_message(admin_chat_id, f"Користувача з ID `{target_chat_id}` не знайдено.")
-                    return
-            except ValueError:
-                await bot.send_message(admin_chat_id, "Введіть дійсний `chat_id` або `@username`.")
-                return
-
-        if target_chat_id == ADMIN_CHAT_ID:
-            await bot.send_message(admin_chat_id, "Ви не можете заблокувати/розблокувати себе.")
+    # One indexed lookup returns both the id and the current block status
+    if target_identifier.startswith('@'): 
+        result = await pool.fetchrow("SELECT chat_id, is_blocked FROM users WHERE username = $1 LIMIT 1;", target_identifier[1:])
+        if not result:
+            await bot.send_message(admin_chat_id, f"Користувача з юзернеймом `{target_identifier}` не знайдено.")
+            return
+    else: 
+        try:
+            target_chat_id = int(target_identifier)
+        except ValueError:
+            await bot.send_message(admin_chat_id, "Введіть дійсний `chat_id` або `@username`.")
+            return
+        result = await pool.fetchrow("SELECT chat_id, is_blocked FROM users WHERE chat_id = $1;", target_chat_id)
+        if not result:
+            await bot.send_message(admin_chat_id, f"Користувача з ID `{target_chat_id}` не знайдено.")
             return
+    target_chat_id = result['chat_id']
 
-        if target_chat_id:
-            current_status = await is_user_blocked(target_chat_id)
-            action_text = "заблокувати" if not current_status else "розблокувати"
-            confirmation_text = f"Ви впевнені, що хочете {action_text} користувача з ID `{target_chat_id}`?\n"
+    if target_chat_id == ADMIN_CHAT_ID:
+        await bot.send_message(admin_chat_id, "Ви не можете заблокувати/розблокувати себе.")
+        return
 
-            markup = types.InlineKeyboardMarkup()
-            if not current_status: 
-                markup.add(types.InlineKeyboardButton("🚫 Заблокувати", callback_data=f"user_block_{target_chat_id}"))
-            else: 
-                markup.add(types.InlineKeyboardButton("✅ Розблокувати", callback_data=f"user_unblock_{target_chat_id}"))
-            markup.add(types.InlineKeyboardButton("Скасувати", callback_data="admin_panel_main")) 
+    current_status = result['is_blocked']
+    action_text = "заблокувати" if not current_status else "розблокувати"
+    confirmation_text = f"Ви впевнені, що хочете {action_text} користувача з ID `{target_chat_id}`?\n"
 
-            await bot.send_message(admin_chat_id, confirmation_text, reply_markup=markup, parse_mode='Markdown')
-        else:
-            await bot.send_message(admin_chat_id, "Користувача не знайдено.")
+    markup = types.InlineKeyboardMarkup()
+    if not current_status: 
+        markup.add(types.InlineKeyboardButton("🚫 Заблокувати", callback_data=f"user_block_{target_chat_id}"))
+    else: 
+        markup.add(types.InlineKeyboardButton("✅ Розблокувати", callback_data=f"user_unblock_{target_chat_id}"))
+    markup.add(types.InlineKeyboardButton("Скасувати", callback_data="admin_panel_main")) 
+
+    await bot.send_message(admin_chat_id, confirmation_text, reply_markup=markup, parse_mode='Markdown')
+
+USER_BLOCK_RE = re.compile(r'^user_(block|unblock)_(\d+)$')
 
 @async_error_handler
-async def handle_user_block_callbacks(call):
+async def handle_user_block_callbacks(call, action, target_chat_id):
     admin_chat_id = call.message.chat.id
-    data_parts = call.data.split('_')
-    action = data_parts[1] 
-    target_chat_id = int(data_parts[2]) 
+    target_chat_id = int(target_chat_id)
 
     if action == 'block':
         success = await set_user_block_status(admin_chat_id, target_chat_id, True)
@@ -1133,394 +1518,401 @@ async def handle_user_block_callbacks(call):
                                   chat_id=admin_chat_id, message_id=call.message.message_id, parse_mode='Markdown')
     await bot.answer_callback_query(call.id)
 
+PENDING_PAGE_SIZE = 5
+
 @async_error_handler
-async def send_pending_products_for_moderation(call):
+async def send_pending_products_for_moderation(call, after_id=None):
     pool = await get_db_connection_async()
     async with pool.acquire() as conn:
+        # Keyset pagination on (created_at, id); one extra row tells whether there is a next page
         pending_products = await conn.fetch("""
-            SELECT id, seller_chat_id, seller_username, product_name, price, description, photos, geolocation, shipping_options, hashtags, created_at
+            SELECT id, seller_chat_id, seller_username, product_name, price, description,
+                   photos, COALESCE(jsonb_array_length(photos), 0) AS photo_count,
+                   geolocation IS NOT NULL AS has_geolocation, shipping_options_text, hashtags,
+                   to_char(created_at AT TIME ZONE 'UTC', 'DD.MM.YYYY HH24:MI') AS created_at_str
             FROM products
             WHERE status = 'pending'
-            ORDER BY created_at ASC
-            LIMIT 5 
-        """)
+              AND ($1::int IS NULL OR (created_at, id) > (SELECT created_at, id FROM products WHERE id = $1))
+            ORDER BY created_at ASC, id ASC
+            LIMIT $2
+        """, after_id, PENDING_PAGE_SIZE + 1)
+    has_next_page = len(pending_products) > PENDING_PAGE_SIZE
+    pending_products = pending_products[:PENDING_PAGE_SIZE]
 
     if not pending_products:
         response_text = "🎉 Немає товарів на модерації."
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("🔙 Назад до Адмін-панелі", callback_data="admin_panel_main"))
-        await bot.edit_message_text(response_text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+        await bot.edit_message_text(response_text, call.message.chat.id, call.message.message_id, reply_markup=BACK_TO_ADMIN_MARKUP)
         return
 
+    # One message (or album) per product: only the global limit applies within the listing
+    listing_bot = bot.without_chat_limit()
     for product in pending_products:
         product_id = product['id']
         seller_chat_id = product['seller_chat_id']
         seller_username = product['seller_username'] if product['seller_username'] else "Немає"
-        photos = json.loads(product['photos']) if product['photos'] else [] 
-        geolocation_data = json.loads(product['geolocation']) if product['geolocation'] else None 
-        shipping_options_text = ", ".join(json.loads(product['shipping_options'])) if product['shipping_options'] else "Не вказано"
+        photos = product['photos'] or []
+        shipping_options_text = product['shipping_options_text'] or "Не вказано"
         hashtags = product['hashtags'] if product['hashtags'] else generate_hashtags(product['description']) 
         
-        created_at_local = product['created_at'].astimezone(timezone.utc).strftime('%d.%m.%Y %H:%M')
+        created_at_local = product['created_at_str']
 
         admin_message_text = (
             f"📩 *Товар на модерацію (ID: {product_id})*\n\n"
             f"📦 *Назва:* {product['product_name']}\n"
             f"💰 *Ціна:* {product['price']}\n"
             f"📝 *Опис:* {product['description'][:500]}...\n"
-            f"📍 Геолокація: {'Так' if geolocation_data else 'Ні'}\n"
+            f"📍 Геолокація: {'Так' if product['has_geolocation'] else 'Ні'}\n"
             f"🚚 Доставка: {shipping_options_text}\n"
             f"🏷️ *Хештеги:* {hashtags}\n\n"
             f"👤 *Продавець:* [{'@' + seller_username if seller_username != 'Немає' else 'Користувач'}](tg://user?id={seller_chat_id})\n"
-            f"📸 *Фото:* {len(photos)} шт.\n"
+            f"📸 *Фото:* {product['photo_count']} шт.\n"
             f"📅 *Додано:* {created_at_local}"
         )
 
-        markup_admin = types.InlineKeyboardMarkup()
-        markup_admin.add(
-            types.InlineKeyboardButton("✅ Опублікувати", callback_data=f"approve_{product_id}"),
-            types.InlineKeyboardButton("❌ Відхилити", callback_data=f"reject_{product_id}")
-        )
-        markup_admin.add(
-            types.InlineKeyboardButton("✏️ Редагувати хештеги", callback_data=f"mod_edit_tags_{product_id}"),
-            types.InlineKeyboardButton("🔄 Запит на виправлення фото", callback_data=f"mod_rotate_photo_{product_id}")
-        )
+        markup_admin = moderation_markup(product_id, seller_chat_id)
+        remember_review_product(product_id, product['product_name'])
         
         try:
             if photos:
                 media = [types.InputMediaPhoto(photo_id, caption=admin_message_text if i == 0 else None, parse_mode='Markdown') 
                          for i, photo_id in enumerate(photos)]
-                await bot.send_media_group(call.message.chat.id, media)
+                await listing_bot.send_media_group(call.message.chat.id, media)
                 
-                await bot.send_message(call.message.chat.id, f"👆 Модерація товару ID: {product_id} (фото вище)", reply_markup=markup_admin, parse_mode='Markdown')
+                await listing_bot.send_message(call.message.chat.id, f"👆 Модерація товару ID: {product_id} (фото вище)", reply_markup=markup_admin, parse_mode='Markdown')
             else:
-                await bot.send_message(call.message.chat.id, admin_message_text, parse_mode='Markdown', reply_markup=markup_admin)
+                await listing_bot.send_message(call.message.chat.id, admin_message_text, parse_mode='Markdown', reply_markup=markup_admin)
         except Exception as e:
             logger.error(f"Помилка відправки товару {product_id} для модерації: {e}", exc_info=True)
-            await bot.send_message(call.message.chat.id, f"❌ Не вдалося відправити товар {product_id} для модерації.")
+            await listing_bot.send_message(call.message.chat.id, f"❌ Не вдалося відправити товар {product_id} для модерації.")
 
-    markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("🔙 Назад до Адмін-панелі", callback_data="admin_panel_main"))
+    if has_next_page:
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton("➡️ Наступні товари", callback_data=f"admin_pending_{pending_products[-1]['id']}"))
+        markup.add(BACK_TO_ADMIN_BUTTON)
+    else:
+        markup = BACK_TO_ADMIN_MARKUP
     await bot.send_message(call.message.chat.id, "⬆️ Перегляньте товари на модерації вище.", reply_markup=markup)
 
+async def fetch_commission_summary(pool):
+    async with pool.acquire() as conn:
+        try:
+            commission_summary = await conn.fetchrow("SELECT * FROM mv_commission_summary;")
+        except asyncpg.UndefinedTableError:
+            commission_summary = None
+        if commission_summary is None:
+            commission_summary = await conn.fetchrow("""
+                SELECT 
+                    SUM(CASE WHEN status = 'pending_payment' THEN amount ELSE 0 END) AS total_pending,
+                    SUM(CASE WHEN status = 'paid' THEN amount ELSE 0 END) AS total_paid,
+                    NULL::timestamptz AS refreshed_at
+                FROM commission_transactions;
+            """)
+        return commission_summary
+
 @async_error_handler
 async def send_admin_commissions_info(call):
+    ensure_admin_views_refresher()
     pool = await get_db_connection_async()
-    async with pool.acquire() as conn:
-        commission_summary = await conn.fetchrow("""
-            SELECT 
-                SUM(CASE WHEN status = 'pending_payment' THEN amount ELSE 0 END) AS total_pending,
-                SUM(CASE WHEN status = 'paid' THEN amount ELSE 0 END) AS total_paid
-            FROM commission_transactions;
-        """)
-
-        recent_transactions = await conn.fetch("""
-            SELECT ct.product_id, p.product_name, p.seller_chat_id, u.username, ct.amount, ct.status, ct.created_at
+    # Independent queries run on separate pool connections at the same time
+    commission_summary, recent_transactions = await asyncio.gather(
+        fetch_commission_summary(pool),
+        pool.fetch("""
+            SELECT ct.product_id, p.product_name, p.seller_chat_id, u.username, ct.amount, ct.status,
+                   to_char(ct.created_at AT TIME ZONE 'UTC', 'DD.MM.YYYY HH24:MI') AS created_at_str
             FROM commission_transactions ct
             JOIN products p ON ct.product_id = p.id
             JOIN users u ON p.seller_chat_id = u.chat_id
             ORDER BY ct.created_at DESC
             LIMIT 10;
-        """)
+        """),
+    )
 
-    text = (
+    parts = [
         f"💰 *Статистика комісій*\n\n"
         f"• Всього очікується: *{commission_summary['total_pending'] or 0:.2f} грн*\n"
         f"• Всього сплачено: *{commission_summary['total_paid'] or 0:.2f} грн*\n\n"
         f"📊 *Останні транзакції:*\n"
-    )
+    ]
 
     if recent_transactions:
         for tx in recent_transactions:
             username = f"@{tx['username']}" if tx['username'] else f"ID: {tx['seller_chat_id']}"
-            created_at_local = tx['created_at'].astimezone(timezone.utc).strftime('%d.%m.%Y %H:%M')
-            text += (
+            created_at_local = tx['created_at_str']
+            parts.append(
                 f"- Товар ID `{tx['product_id']}` ({tx['product_name']})\n"
                 f"  Продавець: {username}\n"
                 f"  Сума: {tx['amount']:.2f} грн, Статус: {tx['status']}\n"
                 f"  Дата: {created_at_local}\n\n"
             )
     else:
-        text += "  Немає транзакцій комісій.\n\n"
+        parts.append("  Немає транзакцій комісій.\n\n")
+    parts.append(format_refreshed_at(commission_summary['refreshed_at']))
+    text = "".join(parts)
 
-    markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("🔙 Назад до Адмін-панелі", callback_data="admin_panel_main"))
-    await bot.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode='Markdown', reply_markup=markup)
+    await bot.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode='Markdown', reply_markup=BACK_TO_ADMIN_MARKUP)
 
 @async_error_handler
 async def send_admin_ai_statistics(call):
     pool = await get_db_connection_async()
-    async with pool.acquire() as conn:
-        total_user_queries = await conn.fetchval("SELECT COUNT(*) FROM conversations WHERE sender_type = 'user';")
-
-        top_ai_users = await conn.fetch("""
-            SELECT user_chat_id, COUNT(*) as query_count
-            FROM conversations
-            WHERE sender_type = 'user'
-            GROUP BY user_chat_id
+    # Independent queries run on separate pool connections at the same time
+    total_user_queries, top_ai_users, daily_ai_queries = await asyncio.gather(
+        pool.fetchval("SELECT COUNT(*) FROM conversations WHERE sender_type = 'user';"),
+        pool.fetch("""
+            SELECT c.user_chat_id, u.username, COUNT(*) as query_count
+            FROM conversations c
+            LEFT JOIN users u ON u.chat_id = c.user_chat_id
+            WHERE c.sender_type = 'user'
+            GROUP BY c.user_chat_id, u.username
             ORDER BY query_count DESC
             LIMIT 5;
-        """)
-
-        daily_ai_queries = await conn.fetch("""
-            SELECT DATE(timestamp) as date, COUNT(*) as query_count
+        """),
+        pool.fetch("""
+            SELECT date_trunc('day', timestamp)::date as date, COUNT(*) as query_count
             FROM conversations
-            WHERE sender_type = 'user'
-            GROUP BY DATE(timestamp)
-            ORDER BY date DESC
-            LIMIT 7;
-        """)
+            WHERE sender_type = 'user' AND timestamp >= CURRENT_DATE - INTERVAL '6 days'
+            GROUP BY 1
+            ORDER BY 1 DESC;
+        """),
+    )
 
-    text = (
+    parts = [
         f"🤖 *Статистика AI Помічника*\n\n"
         f"• Всього запитів користувачів до AI: *{total_user_queries}*\n\n"
         f"📊 *Найактивніші користувачі AI:*\n"
-    )
+    ]
     if top_ai_users:
         for user_data_row in top_ai_users:
             user_id = user_data_row['user_chat_id']
             query_count = user_data_row['query_count']
-            user_info = None
-            try: user_info = await bot.get_chat(user_id) 
-            except Exception as e: logger.warning(f"Не вдалося отримати інфо про користувача {user_id}: {e}")
-
-            username = f"@{user_info.username}" if user_info and user_info.username else f"ID: {user_id}"
-            text += f"- {username}: {query_count} запитів\n"
+            username = f"@{user_data_row['username']}" if user_data_row['username'] else f"ID: {user_id}"
+            parts.append(f"- {username}: {query_count} запитів\n")
     else:
-        text += "  Немає даних.\n"
+        parts.append("  Немає даних.\n")
 
-    text += "\n📅 *Запити за останні 7 днів:*\n"
+    parts.append("\n📅 *Запити за останні 7 днів:*\n")
     if daily_ai_queries:
         for day_data_row in daily_ai_queries:
-            text += f"- {day_data_row['date']}: {day_data_row['query_count']} запитів\n"
+            parts.append(f"- {day_data_row['date']}: {day_data_row['query_count']} запитів\n")
     else:
-        text += "  Немає даних.\n"
+        parts.append("  Немає даних.\n")
+    text = "".join(parts)
 
-    markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("🔙 Назад до Адмін-панелі", callback_data="admin_panel_main"))
-    await bot.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode='Markdown', reply_markup=markup)
+    await bot.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode='Markdown', reply_markup=BACK_TO_ADMIN_MARKUP)
 
 @async_error_handler
 async def send_admin_referral_stats(call):
     pool = await get_db_connection_async()
-    async with pool.acquire() as conn:
-        total_referrals = await conn.fetchval("SELECT COUNT(*) FROM users WHERE referrer_id IS NOT NULL;")
-
-        top_referrers = await conn.fetch("""
-            SELECT referrer_id, COUNT(*) as invited_count
-            FROM users
-            WHERE referrer_id IS NOT NULL
-            GROUP BY referrer_id
+    total_referrals, top_referrers = await asyncio.gather(
+        pool.fetchval("SELECT COUNT(*) FROM users WHERE referrer_id IS NOT NULL;"),
+        pool.fetch("""
+            SELECT ref.referrer_id, u.username, COUNT(*) as invited_count
+            FROM users ref
+            LEFT JOIN users u ON u.chat_id = ref.referrer_id
+            WHERE ref.referrer_id IS NOT NULL
+            GROUP BY ref.referrer_id, u.username
             ORDER BY invited_count DESC
             LIMIT 5;
-        """)
+        """),
+    )
 
-    text = (
+    parts = [
         f"🏆 *Статистика рефералів*\n\n"
         f"• Всього запрошених користувачів: *{total_referrals}*\n\n"
         f"📊 *Топ-5 реферерів:*\n"
-    )
+    ]
     if top_referrers:
         for referrer_row in top_referrers:
             referrer_id = referrer_row['referrer_id']
             invited_count = referrer_row['invited_count']
-            referrer_info = None
-            try: referrer_info = await bot.get_chat(referrer_id)
-            except Exception as e: logger.warning(f"Не вдалося отримати інфо про реферера {referrer_id}: {e}")
-            username = f"@{referrer_info.username}" if referrer_info and referrer_info.username else f"ID: {referrer_id}"
-            text += f"- {username}: {invited_count} запрошень\n"
+            username = f"@{referrer_row['username']}" if referrer_row['username'] else f"ID: {referrer_id}"
+            parts.append(f"- {username}: {invited_count} запрошень\n")
     else:
-        text += "  Немає даних.\n"
+        parts.append("  Немає даних.\n")
+    text = "".join(parts)
 
     markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("🔙 Назад до Адмін-панелі", callback_data="admin_panel_main"))
+    markup.add(BACK_TO_ADMIN_BUTTON)
     markup.add(types.InlineKeyboardButton("🎲 Провести розіграш", callback_data="runraffle_week")) 
 
     await bot.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode='Markdown', reply_markup=markup)
 
+PRODUCT_MODERATION_RE = re.compile(r'^(approve|reject|sold)_(\d+)$')
+
 @async_error_handler
-async def handle_product_moderation_callbacks(call):
+async def handle_product_moderation_callbacks(call, action, product_id):
     if call.message.chat.id != ADMIN_CHAT_ID:
         await bot.answer_callback_query(call.id, "❌ Доступ заборонено.")
         return
 
-    action = call.data.split('_')[0] 
-    product_id = int(call.data.split('_')[1])
+    product_id = int(product_id)
 
     pool = await get_db_connection_async()
-    async with pool.acquire() as conn:
-        product_info = await conn.fetchrow("""
-            SELECT seller_chat_id, product_name, price, description, photos, geolocation, admin_message_id, channel_message_id, status
-            FROM products WHERE id = $1;
-        """, product_id)
+    product_info = await pool.fetchrow("""
+        SELECT seller_chat_id, product_name, price, description, photos, geolocation, admin_message_id, channel_message_id, status,
+               shipping_options_text, hashtags
+        FROM products WHERE id = $1;
+    """, product_id)
     
-        if not product_info:
-            await bot.answer_callback_query(call.id, "Товар не знайдено.")
-            return
+    if not product_info:
+        await bot.answer_callback_query(call.id, "Товар не знайдено.")
+        return
 
-        seller_chat_id = product_info['seller_chat_id']
-        product_name = product_info['product_name']
-        price_str = product_info['price'] 
-        description = product_info['description']
-        photos_str = product_info['photos']
-        geolocation_str = product_info['geolocation']
-        admin_message_id = product_info['admin_message_id']
-        channel_message_id = product_info['channel_message_id']
-        current_status = product_info['status']
+    seller_chat_id = product_info['seller_chat_id']
+    product_name = product_info['product_name']
+    price_str = product_info['price'] 
+    description = product_info['description']
+    photos = product_info['photos'] or []
+    geolocation = product_info['geolocation']
+    admin_message_id = product_info['admin_message_id']
+    channel_message_id = product_info['channel_message_id']
+    current_status = product_info['status']
+
+    if action == 'approve':
+        if current_status != 'pending':
+            await bot.answer_callback_query(call.id, f"Товар вже має статус '{current_status}'.")
+            return
 
-        photos = json.loads(photos_str) if photos_str else []
-        geolocation = json.loads(geolocation_str) if geolocation_str else None
-        hashtags = generate_hashtags(description) 
+        shipping_options_text = product_info['shipping_options_text'] or "Не вказано"
+        hashtags = product_info['hashtags'] or generate_hashtags(description)
+        
+        channel_text = format_channel_text(product_name, price_str, shipping_options_text, description,
+                                           geolocation, hashtags, seller_chat_id)
+        
+        published_message = await send_channel_post(channel_text, photos)
 
-        if action == 'approve':
-            if current_status != 'pending':
-                await bot.answer_callback_query(call.id, f"Товар вже має статус '{current_status}'.")
-                return
+        if published_message:
+            new_channel_message_id = published_message.message_id 
+            await pool.execute("""
+                UPDATE products SET status = 'approved', moderator_id = $1, moderated_at = CURRENT_TIMESTAMP,
+                channel_message_id = $2, views = 0, republish_count = 0, last_republish_date = NULL,
+                hashtags = COALESCE(hashtags, $4)
+                WHERE id = $3;
+            """, call.message.chat.id, new_channel_message_id, product_id, hashtags)
+            await log_statistics('product_approved', call.message.chat.id, product_id)
 
-            shipping_options_text = "Не вказано"
-            product_details_for_publish = await conn.fetchrow("SELECT shipping_options, hashtags FROM products WHERE id = $1;", product_id)
-            if product_details_for_publish:
-                if product_details_for_publish['shipping_options']:
-                    shipping_options_text = ", ".join(json.loads(product_details_for_publish['shipping_options']))
-                if product_details_for_publish['hashtags']:
-                    hashtags = product_details_for_publish['hashtags']
-            
-            channel_text = (
-                f"📦 *Новий товар: {product_name}*\n\n"
-                f"💰 *Ціна:* {price_str}\n"
-                f"🚚 *Доставка:* {shipping_options_text}\n" 
-                f"📝 *Опис:*\n{description}\n\n"
-                f"📍 Геолокація: {'Присутня' if geolocation else 'Відсутня'}\n"
-                f"🏷️ *Хештеги:* {hashtags}\n\n"
-                f"👤 *Продавець:* [Написати продавцю](tg://user?id={seller_chat_id})"
-            )
+            notify_seller = bot.send_message(seller_chat_id,
+                             f"✅ Ваш товар '{product_name}' успішно опубліковано в каналі! [Переглянути]({CHANNEL_URL_PREFIX}{published_message.message_id})", 
+                             parse_mode='Markdown', disable_web_page_preview=True)
             
-            published_message = None
-            if photos:
-                media = [types.InputMediaPhoto(photo_id, caption=channel_text if i == 0 else None, parse_mode='Markdown') 
-                         for i, photo_id in enumerate(photos)]
-                sent_messages = await bot.send_media_group(CHANNEL_ID, media)
-                published_message = sent_messages[0] if sent_messages else None
+            if admin_message_id:
+                markup_sold = types.InlineKeyboardMarkup()
+                markup_sold.add(types.InlineKeyboardButton("💰 Відмітити як продано", callback_data=f"sold_{product_id}"))
+                admin_updates = [
+                    bot.edit_message_text(f"✅ Товар *'{product_name}'* (ID: {product_id}) опубліковано.",
+                                          chat_id=call.message.chat.id, message_id=admin_message_id, parse_mode='Markdown',
+                                          reply_markup=markup_sold),
+                ]
             else:
-                published_message = await bot.send_message(CHANNEL_ID, channel_text, parse_mode='Markdown')
+                admin_updates = [bot.send_message(call.message.chat.id, f"✅ Товар *'{product_name}'* (ID: {product_id}) опубліковано.")]
 
-            if published_message:
-                new_channel_message_id = published_message.message_id 
-                await conn.execute("""
-                    UPDATE products SET status = 'approved', moderator_id = $1, moderated_at = CURRENT_TIMESTAMP,
-                    channel_message_id = $2, views = 0, republish_count = 0, last_republish_date = NULL
-                    WHERE id = $3;
-                """, call.message.chat.id, new_channel_message_id, product_id)
-                await log_statistics('product_approved', call.message.chat.id, product_id)
-
-                await bot.send_message(seller_chat_id,
-                                 f"✅ Ваш товар '{product_name}' успішно опубліковано в каналі! [Переглянути](https://t.me/c/{str(CHANNEL_ID).replace('-100', '')}/{published_message.message_id})", 
-                                 parse_mode='Markdown', disable_web_page_preview=True)
-                
-                if admin_message_id:
-                    await bot.edit_message_text(f"✅ Товар *'{product_name}'* (ID: {product_id}) опубліковано.",
-                                          chat_id=call.message.chat.id, message_id=admin_message_id, parse_mode='Markdown')
-                    markup_sold = types.InlineKeyboardMarkup()
-                    markup_sold.add(types.InlineKeyboardButton("💰 Відмітити як продано", callback_data=f"sold_{product_id}"))
-                    await bot.edit_message_reply_markup(chat_id=call.message.chat.id, message_id=admin_message_id, reply_markup=markup_sold)
-                else:
-                    await bot.send_message(call.message.chat.id, f"✅ Товар *'{product_name}'* (ID: {product_id}) опубліковано.")
+            # Independent Telegram calls: wait for all of them at once instead of one after another
+            await asyncio.gather(notify_seller, *admin_updates)
 
-            else:
-                raise Exception("Не вдалося опублікувати повідомлення в канал.")
+        else:
+            raise Exception("Не вдалося опублікувати повідомлення в канал.")
 
-        elif action == 'reject':
-            if current_status != 'pending':
-                await bot.answer_callback_query(call.id, f"Товар вже має статус '{current_status}'.")
-                return
+    elif action == 'reject':
+        if current_status != 'pending':
+            await bot.answer_callback_query(call.id, f"Товар вже має статус '{current_status}'.")
+            return
 
-            await conn.execute("""
-                UPDATE products SET status = 'rejected', moderator_id = $1, moderated_at = CURRENT_TIMESTAMP
-                WHERE id = $2;
-            """, call.message.chat.id, product_id)
-            await log_statistics('product_rejected', call.message.chat.id, product_id)
-
-            await bot.send_message(seller_chat_id,
-                             f"❌ Ваш товар '{product_name}' було відхилено адміністратором.\n"
-                             "Можливі причини: невідповідність правилам, низька якість фото, неточний опис.\n"
-                             "Будь ласка, перевірте оголошення та спробуйте додати знову.",
-                             parse_mode='Markdown')
-            
-            if admin_message_id:
-                await bot.edit_message_text(f"❌ Товар *'{product_name}'* (ID: {product_id}) відхилено.",
-                                      chat_id=call.message.chat.id, message_id=admin_message_id, parse_mode='Markdown')
-                await bot.edit_message_reply_markup(chat_id=call.message.chat.id, message_id=admin_message_id, reply_markup=None) 
-            else:
-                await bot.send_message(call.message.chat.id, f"❌ Товар *'{product_name}'* (ID: {product_id}) відхилено.")
+        await pool.execute("""
+            UPDATE products SET status = 'rejected', moderator_id = $1, moderated_at = CURRENT_TIMESTAMP
+            WHERE id = $2;
+        """, call.message.chat.id, product_id)
+        await log_statistics('product_rejected', call.message.chat.id, product_id)
+
+        await bot.send_message(seller_chat_id,
+                         f"❌ Ваш товар '{product_name}' було відхилено адміністратором.\n"
+                         "Можливі причини: невідповідність правилам, низька якість фото, неточний опис.\n"
+                         "Будь ласка, перевірте оголошення та спробуйте додати знову.",
+                         parse_mode='Markdown')
+        
+        if admin_message_id:
+            # No reply_markup: editing the text drops the moderation buttons in the same call
+            await bot.edit_message_text(f"❌ Товар *'{product_name}'* (ID: {product_id}) відхилено.",
+                                  chat_id=call.message.chat.id, message_id=admin_message_id, parse_mode='Markdown')
+        else:
+            await bot.send_message(call.message.chat.id, f"❌ Товар *'{product_name}'* (ID: {product_id}) відхилено.")
 
 
-        elif action == 'sold': 
-            if current_status != 'approved':
-                await bot.answer_callback_query(call.id, f"Товар не опублікований або вже проданий (поточний статус: '{current_status}').")
-                return
+    elif action == 'sold': 
+        if current_status != 'approved':
+            await bot.answer_callback_query(call.id, f"Товар не опублікований або вже проданий (поточний статус: '{current_status}').")
+            return
 
-            if channel_message_id: 
-                try:
-                    await conn.execute("""
-                        UPDATE products SET status = 'sold', moderator_id = $1, moderated_at = CURRENT_TIMESTAMP
-                        WHERE id = $2;
-                    """, call.message.chat.id, product_id)
-                    await log_statistics('product_sold', call.message.chat.id, product_id)
+        if channel_message_id: 
+            try:
+                await pool.execute("""
+                    UPDATE products SET status = 'sold', moderator_id = $1, moderated_at = CURRENT_TIMESTAMP
+                    WHERE id = $2;
+                """, call.message.chat.id, product_id)
+                await log_statistics('product_sold', call.message.chat.id, product_id)
 
-                    original_message_for_edit = None
-                    try:
-                        original_message_for_edit = await bot.forward_message(from_chat_id=CHANNEL_ID, chat_id=CHANNEL_ID, message_id=channel_message_id)
-                        if original_message_for_edit and (original_message_for_edit.text or original_message_for_edit.caption):
-                            original_text = original_message_for_edit.text or original_message_for_edit.caption
-                            sold_text = f"📦 *ПРОДАНО!* {product_name}\n\n" + original_text.replace(f"📦 *Новий товар: {product_name}*", "").strip() + "\n\n*Цей товар вже продано.*"
-                        else:
-                            sold_text = (
-                                f"📦 *ПРОДАНО!* {product_name}\n\n"
-                                f"💰 *Ціна:* {price_str}\n"
-                                f"📝 *Опис:*\n{description}\n\n"
-                                f"*Цей товар вже продано.*"
-                            )
-                        await bot.delete_message(CHANNEL_ID, original_message_for_edit.message_id) 
-                    except Exception as e_fetch_original:
-                        logger.warning(f"Не вдалося отримати оригінальний текст оголошення для товару {product_id} з каналу: {e_fetch_original}. Використовуємо стандартний текст.")
-                        sold_text = (
-                            f"📦 *ПРОДАНО!* {product_name}\n\n"
-                            f"💰 *Ціна:* {price_str}\n"
-                            f"📝 *Опис:*\n{description}\n\n"
-                            f"*Цей товар вже продано.*"
-                        )
-
-
-                    if photos:
-                        await bot.edit_message_caption(chat_id=CHANNEL_ID, message_id=channel_message_id,
-                                                 caption=sold_text, parse_mode='Markdown', reply_markup=None) 
-                    else:
-                        await bot.edit_message_text(chat_id=CHANNEL_ID, message_id=channel_message_id,
-                                              text=sold_text, parse_mode='Markdown', reply_markup=None) 
-                    
-                    await bot.send_message(seller_chat_id, f"✅ Ваш товар '{product_name}' відмічено як *'ПРОДАНО'*. Дякуємо!", parse_mode='Markdown')
-                    
-                    if admin_message_id:
-                        await bot.edit_message_text(f"💰 Товар *'{product_name}'* (ID: {product_id}) відмічено як проданий.",
-                                              chat_id=call.message.chat.id, message_id=admin_message_id, parse_mode='Markdown')
-                        await bot.edit_message_reply_markup(chat_id=call.message.chat.id, message_id=admin_message_id, reply_markup=None) 
+                original_message_for_edit = None
+                try:
+                    original_message_for_edit = await bot.forward_message(from_chat_id=CHANNEL_ID, chat_id=CHANNEL_ID, message_id=channel_message_id)
+                    if original_message_for_edit and (original_message_for_edit.text or original_message_for_edit.caption):
+                        original_text = original_message_for_edit.text or original_message_for_edit.caption
+                        sold_text = f"📦 *ПРОДАНО!* {escape_markdown(product_name)}\n\n" + escape_markdown(original_text.replace(f"📦 Новий товар: {product_name}", "").strip()) + SOLD_SUFFIX
                     else:
-                        await bot.send_message(call.message.chat.id, f"💰 Товар *'{product_name}'* (ID: {product_id}) відмічено як проданий.")
+                        sold_text = sold_fallback_text(product_name, price_str, description)
+                    await bot.delete_message(CHANNEL_ID, original_message_for_edit.message_id) 
+                except Exception as e_fetch_original:
+                    logger.warning(f"Не вдалося отримати оригінальний текст оголошення для товару {product_id} з каналу: {e_fetch_original}. Використовуємо стандартний текст.")
+                    sold_text = sold_fallback_text(product_name, price_str, description)
 
-                except async_telebot.apihelper.ApiTelegramException as e:
-                    logger.error(f"Помилка при відмітці товару {product_id} як проданого: {e}", exc_info=True)
-                    await bot.send_message(call.message.chat.id, f"❌ Не вдалося оновити статус продажу в каналі для товару {product_id}. Можливо, повідомлення було видалено.")
-                    await bot.answer_callback_query(call.id, "❌ Помилка оновлення в каналі.")
-                    return
-            else:
-                await bot.send_message(call.message.chat.id, "Цей товар ще не опубліковано в каналі, або повідомлення в каналі відсутнє. Не можна відмітити як проданий.")
-                await bot.answer_callback_query(call.id, "Товар не опубліковано в каналі.")
+
+                if photos:
+                    await bot.edit_message_caption(chat_id=CHANNEL_ID, message_id=channel_message_id,
+                                             caption=sold_text, parse_mode='Markdown', reply_markup=None) 
+                else:
+                    await bot.edit_message_text(chat_id=CHANNEL_ID, message_id=channel_message_id,
+                                          text=sold_text, parse_mode='Markdown', reply_markup=None) 
+                
+                await bot.send_message(seller_chat_id, f"✅ Ваш товар '{product_name}' відмічено як *'ПРОДАНО'*. Дякуємо!", parse_mode='Markdown')
+                
+                if admin_message_id:
+                    await bot.edit_message_text(f"💰 Товар *'{product_name}'* (ID: {product_id}) відмічено як проданий.",
+                                          chat_id=call.message.chat.id, message_id=admin_message_id, parse_mode='Markdown')
+                else:
+                    await bot.send_message(call.message.chat.id, f"💰 Товар *'{product_name}'* (ID: {product_id}) відмічено як проданий.")
+
+            except asyncio_helper.ApiTelegramException as e:
+                logger.error(f"Помилка при відмітці товару {product_id} як проданого: {e}", exc_info=True)
+                await bot.send_message(call.message.chat.id, f"❌ Не вдалося оновити статус продажу в каналі для товару {product_id}. Можливо, повідомлення було видалено.")
+                await bot.answer_callback_query(call.id, "❌ Помилка оновлення в каналі.")
+                return
+        else:
+            await bot.send_message(call.message.chat.id, "Цей товар ще не опубліковано в каналі, або повідомлення в каналі відсутнє. Не можна відмітити як проданий.")
+            await bot.answer_callback_query(call.id, "Товар не опубліковано в каналі.")
     await bot.answer_callback_query(call.id) 
 
+PRICE_CLEAN_RE = re.compile(r'[^\d.]') # everything except digits and the decimal point
+MARKDOWN_SPECIAL_RE = re.compile(r'([_*`\[])')
+SOLD_SUFFIX = "\n\n*Цей товар вже продано.*"
+
+def escape_markdown(text):
+    # A stray _ or * in user text makes Telegram reject the whole Markdown message
+    return MARKDOWN_SPECIAL_RE.sub(r'\\\1', str(text))
+
+def sold_fallback_text(product_name, price_str, description):
+    return (
+        f"📦 *ПРОДАНО!* {escape_markdown(product_name)}\n\n"
+        f"💰 *Ціна:* {escape_markdown(price_str)}\n"
+        f"📝 *Опис:*\n{escape_markdown(description)}"
+        f"{SOLD_SUFFIX}"
+    )
+
+# "My products" card lines that no longer apply once the product is sold
+SOLD_STRIP_RE = re.compile(r'^.*(?:👁️ Перегляди:|🔁 Переопублікувати|❌ Переопублікувати|✏️ Змінити ціну).*(?:\n|$)', re.MULTILINE)
+# Card lines rewritten in place after a republish
+REPUBLISH_LINE_RE = re.compile(r'^.*(?:🔁|❌) Переопублікувати.*$', re.MULTILINE)
+VIEWS_LINE_RE = re.compile(r'^.*👁️ Перегляди:.*$', re.MULTILINE)
+
 @async_error_handler
-async def handle_seller_sold_product(call):
+async def handle_seller_sold_product(call, product_id):
     seller_chat_id = call.message.chat.id
-    product_id = int(call.data.split('_')[2]) 
 
     pool = await get_db_connection_async()
     async with pool.acquire() as conn:
@@ -1536,20 +1928,18 @@ async def handle_seller_sold_product(call):
         product_name = product_info['product_name']
         price_str = product_info['price']
         description = product_info['description']
-        photos_str = product_info['photos']
+        photos = product_info['photos'] or []
         channel_message_id = product_info['channel_message_id']
         current_status = product_info['status']
         commission_rate = product_info['commission_rate']
 
-        photos = json.loads(photos_str) if photos_str else []
-
         if current_status != 'approved':
             await bot.answer_callback_query(call.id, f"Товар має статус '{current_status}'. Відмітити як продано можна лише опублікований товар.")
             return
 
         commission_amount = 0.0
         try:
-            cleaned_price_str = re.sub(r'[^\d.]', '', price_str)
+            cleaned_price_str = PRICE_CLEAN_RE.sub('', price_str)
             if cleaned_price_str:
                 numeric_price = float(cleaned_price_str)
                 commission_amount = numeric_price * commission_rate
@@ -1559,225 +1949,195 @@ async def handle_seller_sold_product(call):
             logger.warning(f"Не вдалося конвертувати ціну '{price_str}' товару {product_id} в число. Комісія не розрахована.")
             await bot.send_message(seller_chat_id, f"⚠️ Увага: Не вдалося розрахувати комісію для товару '{product_name}' з ціною '{price_str}'. Зв'яжіться з адміністратором.")
             
-        await conn.execute("""
-            UPDATE products SET status = 'sold', commission_amount = $1, updated_at = CURRENT_TIMESTAMP
-            WHERE id = $2;
-        """, commission_amount, product_id)
-
-        if commission_amount > 0:
-            await conn.execute("""
-                INSERT INTO commission_transactions (product_id, seller_chat_id, amount, status)
-                VALUES ($1, $2, $3, 'pending_payment');
-            """, product_id, seller_chat_id, commission_amount)
-            await bot.send_message(seller_chat_id, 
-                             f"💰 Ваш товар '{product_name}' (ID: {product_id}) відмічено як *'ПРОДАНО'*! 🎉\n\n"
-                             f"Комісія: *{commission_amount:.2f} грн*.\n"
-                             f"Сплатіть комісію на картку Monobank:\n`{MONOBANK_CARD_NUMBER}`\n\n"
-                             f"Дякуємо за співпрацю!", parse_mode='Markdown')
-        else:
-            await bot.send_message(seller_chat_id, f"✅ Ваш товар '{product_name}' (ID: {product_id}) відмічено як *'ПРОДАНО'*! 🎉\n\n"
-                             f"Комісія не розрахована автоматично. Якщо комісія є, зв'яжіться з адміністратором.", parse_mode='Markdown')
+        # Status and commission row commit together, so a sold product never lacks its commission entry.
+        # The status guard makes a double tap a no-op: only the first call gets the row back.
+        async with conn.transaction():
+            sold_id = await conn.fetchval("""
+                UPDATE products SET status = 'sold', commission_amount = $1, updated_at = CURRENT_TIMESTAMP
+                WHERE id = $2 AND status = 'approved'
+                RETURNING id;
+            """, commission_amount, product_id)
+
+            if sold_id is not None and commission_amount > 0:
+                await conn.execute("""
+                    INSERT INTO commission_transactions (product_id, seller_chat_id, amount, status)
+                    VALUES ($1, $2, $3, 'pending_payment');
+                """, product_id, seller_chat_id, commission_amount)
 
-        await log_statistics('product_sold_by_seller', seller_chat_id, product_id, f"Комісія: {commission_amount}")
+    if sold_id is None:
+        await bot.answer_callback_query(call.id, "Товар вже позначено як проданий.")
+        return
 
-        if channel_message_id:
-            original_message_for_edit = None
-            try:
-                original_message_for_edit = await bot.forward_message(from_chat_id=CHANNEL_ID, chat_id=CHANNEL_ID, message_id=channel_message_id)
-                if original_message_for_edit and (original_message_for_edit.text or original_message_for_edit.caption):
-                    original_text = original_message_for_edit.text or original_message_for_edit.caption
-                    sold_text = f"📦 *ПРОДАНО!* {product_name}\n\n" + original_text.replace(f"📦 *Новий товар: {product_name}*", "").strip() + "\n\n*Цей товар вже продано.*"
-                else:
-                    sold_text = (
-                        f"📦 *ПРОДАНО!* {product_name}\n\n"
-                        f"💰 *Ціна:* {price_str}\n"
-                        f"📝 *Опис:*\n{description}\n\n"
-                        f"*Цей товар вже продано.*"
-                    )
-                await bot.delete_message(CHANNEL_ID, original_message_for_edit.message_id) 
-            except Exception as e_fetch_original:
-                logger.warning(f"Не вдалося отримати оригінальний текст оголошення для товару {product_id} з каналу: {e_fetch_original}.")
-                sold_text = (
-                    f"📦 *ПРОДАНО!* {product_name}\n\n"
-                    f"💰 *Ціна:* {price_str}\n"
-                    f"📝 *Опис:*\n{description}\n\n"
-                    f"*Цей товар вже продано.*"
-                )
+    # The seller's UI is updated right away; the channel post is rewritten in the background
+    await bot.answer_callback_query(call.id)
+    if channel_message_id:
+        run_in_background(update_channel_post_sold(product_id, product_name, price_str, description, photos,
+                                                   channel_message_id, seller_chat_id))
+
+    if commission_amount > 0:
+        await bot.send_message(seller_chat_id, 
+                         f"💰 Ваш товар '{product_name}' (ID: {product_id}) відмічено як *'ПРОДАНО'*! 🎉\n\n"
+                         f"Комісія: *{commission_amount:.2f} грн*.\n"
+                         f"Сплатіть комісію на картку Monobank:\n`{MONOBANK_CARD_NUMBER}`\n\n"
+                         f"Дякуємо за співпрацю!", parse_mode='Markdown')
+    else:
+        await bot.send_message(seller_chat_id, f"✅ Ваш товар '{product_name}' (ID: {product_id}) відмічено як *'ПРОДАНО'*! 🎉\n\n"
+                         f"Комісія не розрахована автоматично. Якщо комісія є, зв'яжіться з адміністратором.", parse_mode='Markdown')
 
-            try:
-                if photos:
-                    await bot.edit_message_caption(chat_id=CHANNEL_ID, message_id=channel_message_id,
-                                                 caption=sold_text, parse_mode='Markdown', reply_markup=None)
-                else:
-                    await bot.edit_message_text(chat_id=CHANNEL_ID, message_id=channel_message_id,
-                                          text=sold_text, parse_mode='Markdown', reply_markup=None)
-            except async_telebot.apihelper.ApiTelegramException as e:
-                logger.error(f"Помилка оновлення повідомлення в каналі для товару {product_id}: {e}", exc_info=True)
-                await bot.send_message(seller_chat_id, f"⚠️ Не вдалося оновити повідомлення в каналі для товару '{product_name}'.")
-        
-        current_message_text = call.message.text
-        updated_message_text = current_message_text.replace("📊 Статус: опубліковано", "📊 Статус: продано")
-        updated_message_text_lines = updated_message_text.splitlines()
-        filtered_lines = [line for line in updated_message_text_lines if not ("👁️ Перегляди:" in line or "🔁 Переопублікувати" in line or "❌ Переопублікувати" in line or "✏️ Змінити ціну" in line)]
-        updated_message_text = "\n".join(filtered_lines)
+    await log_statistics('product_sold_by_seller', seller_chat_id, product_id, f"Комісія: {commission_amount}")
 
-        await bot.edit_message_text(updated_message_text, call.message.chat.id, call.message.message_id, parse_mode='Markdown', disable_web_page_preview=True)
-        await bot.edit_message_reply_markup(chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=None)
+    updated_message_text = SOLD_STRIP_RE.sub('', call.message.text).rstrip('\n').replace("📊 Статус: опубліковано", "📊 Статус: продано")
 
-    await bot.answer_callback_query(call.id)
+    # Without reply_markup the edit also removes the inline keyboard
+    await bot.edit_message_text(updated_message_text, call.message.chat.id, call.message.message_id, parse_mode='Markdown', disable_web_page_preview=True)
+
+async def update_channel_post_sold(product_id, product_name, price_str, description, photos, channel_message_id, seller_chat_id):
+    original_message_for_edit = None
+    try:
+        original_message_for_edit = await bot.forward_message(from_chat_id=CHANNEL_ID, chat_id=CHANNEL_ID, message_id=channel_message_id)
+        if original_message_for_edit and (original_message_for_edit.text or original_message_for_edit.caption):
+            original_text = original_message_for_edit.text or original_message_for_edit.caption
+            sold_text = f"📦 *ПРОДАНО!* {escape_markdown(product_name)}\n\n" + escape_markdown(original_text.replace(f"📦 Новий товар: {product_name}", "").strip()) + SOLD_SUFFIX
+        else:
+            sold_text = sold_fallback_text(product_name, price_str, description)
+        await bot.delete_message(CHANNEL_ID, original_message_for_edit.message_id) 
+    except Exception as e_fetch_original:
+        logger.warning(f"Не вдалося отримати оригінальний текст оголошення для товару {product_id} з каналу: {e_fetch_original}.")
+        sold_text = sold_fallback_text(product_name, price_str, description)
+
+    try:
+        if photos:
+            await bot.edit_message_caption(chat_id=CHANNEL_ID, message_id=channel_message_id,
+                                         caption=sold_text, parse_mode='Markdown', reply_markup=None)
+        else:
+            await bot.edit_message_text(chat_id=CHANNEL_ID, message_id=channel_message_id,
+                                  text=sold_text, parse_mode='Markdown', reply_markup=None)
+    except asyncio_helper.ApiTelegramException as e:
+        logger.error(f"Помилка оновлення повідомлення в каналі для товару {product_id}: {e}", exc_info=True)
+        await bot.send_message(seller_chat_id, f"⚠️ Не вдалося оновити повідомлення в каналі для товару '{product_name}'.")
 
 @async_error_handler
-async def handle_republish_product(call):
+async def handle_republish_product(call, product_id):
     seller_chat_id = call.message.chat.id
-    product_id = int(call.data.split('_')[1])
     republish_limit = 3 
 
     pool = await get_db_connection_async()
-    async with pool.acquire() as conn:
-        product_info = await conn.fetchrow("""
-            SELECT product_name, price, description, photos, channel_message_id, status, republish_count, last_republish_date, geolocation, shipping_options, hashtags
-            FROM products WHERE id = $1 AND seller_chat_id = $2;
-        """, product_id, seller_chat_id)
+    product_info = await pool.fetchrow("""
+        SELECT product_name, price, description, photos, channel_message_id, status, republish_count, last_republish_date, geolocation, shipping_options, hashtags
+        FROM products WHERE id = $1 AND seller_chat_id = $2;
+    """, product_id, seller_chat_id)
 
-        if not product_info:
-            await bot.answer_callback_query(call.id, "Товар не знайдено або ви не є його продавцем.")
-            return
+    if not product_info:
+        await bot.answer_callback_query(call.id, "Товар не знайдено або ви не є його продавцем.")
+        return
 
-        if product_info['status'] != 'approved':
-            await bot.answer_callback_query(call.id, "Переопублікувати можна лише опублікований товар.")
-            return
+    if product_info['status'] != 'approved':
+        await bot.answer_callback_query(call.id, "Переопублікувати можна лише опублікований товар.")
+        return
 
-        today = datetime.now(timezone.utc).date()
-        current_republish_count = product_info['republish_count']
-        last_republish_date = product_info['last_republish_date']
+    today = datetime.now(timezone.utc).date()
+    current_republish_count = product_info['republish_count']
+    last_republish_date = product_info['last_republish_date']
 
-        if last_republish_date == today and current_republish_count >= republish_limit:
-            await bot.answer_callback_query(call.id, "Ви вже досягли ліміту переопублікацій на сьогодні.")
-            return
+    if last_republish_date == today and current_republish_count >= republish_limit:
+        await bot.answer_callback_query(call.id, "Ви вже досягли ліміту переопублікацій на сьогодні.")
+        return
 
+    photos = product_info['photos'] or []
+    shipping_options_text = ", ".join(product_info['shipping_options'] or []) or "Не вказано"
+    hashtags = product_info['hashtags'] if product_info['hashtags'] else generate_hashtags(product_info['description'])
+
+    channel_text = format_channel_text(product_info['product_name'], product_info['price'], shipping_options_text,
+                                       product_info['description'], product_info['geolocation'], hashtags, seller_chat_id)
+    
+    published_message = await send_channel_post(channel_text, photos)
+
+    if published_message:
+        new_channel_message_id = published_message.message_id 
+        
+        new_republish_count = 1 if last_republish_date != today else current_republish_count + 1
+
+        await pool.execute("""
+            UPDATE products SET 
+                channel_message_id = $1, 
+                views = 0, 
+                republish_count = $2, 
+                last_republish_date = $3,
+                hashtags = COALESCE(hashtags, $5),
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = $4;
+        """, new_channel_message_id, new_republish_count, today, product_id, hashtags)
+        # The old post goes only once the new one is stored; a failed send leaves the live post and its stats untouched
         if product_info['channel_message_id']:
-            try:
-                await bot.delete_message(CHANNEL_ID, product_info['channel_message_id'])
-            except async_telebot.apihelper.ApiTelegramException as e:
-                logger.warning(f"Не вдалося видалити старе повідомлення {product_info['channel_message_id']} з каналу: {e}")
+            run_in_background(delete_channel_message(product_info['channel_message_id']))
+        await log_statistics('product_republished', seller_chat_id, product_id)
+
+        await bot.answer_callback_query(call.id, f"Товар '{product_info['product_name']}' успішно переопубліковано!")
+        await bot.send_message(seller_chat_id,
+                         f"✅ Ваш товар '{product_info['product_name']}' успішно переопубліковано! [Переглянути]({CHANNEL_URL_PREFIX}{published_message.message_id})", 
+                         parse_mode='Markdown', disable_web_page_preview=True)
         
-        photos = json.loads(product_info['photos']) if product_info['photos'] else []
-        shipping_options_text = ", ".join(json.loads(product_info['shipping_options'])) if product_info['shipping_options'] else "Не вказано"
-        hashtags = product_info['hashtags'] if product_info['hashtags'] else generate_hashtags(product_info['description'])
-
-        channel_text = (
-            f"📦 *Новий товар: {product_info['product_name']}*\n\n"
-            f"💰 *Ціна:* {product_info['price']}\n"
-            f"🚚 *Доставка:* {shipping_options_text}\n" 
-            f"📝 *Опис:*\n{product_info['description']}\n\n"
-            f"📍 Геолокація: {'Присутня' if json.loads(product_info['geolocation']) else 'Відсутня'}\n"
-            f"🏷️ *Хештеги:* {hashtags}\n\n"
-            f"👤 *Продавець:* [Написати продавцю](tg://user?id={seller_chat_id})"
-        )
+        current_message_text = call.message.text
+        if new_republish_count < republish_limit:
+            republish_line = f"   🔁 Переопублікувати ({new_republish_count}/{republish_limit})"
+        else:
+            republish_line = f"   ❌ Переопублікувати (ліміт {new_republish_count}/{republish_limit})"
+        updated_message_text = REPUBLISH_LINE_RE.sub(lambda m: republish_line, current_message_text)
+        updated_message_text = VIEWS_LINE_RE.sub("   👁️ Перегляди: 0", updated_message_text)
         
-        published_message = None
-        if photos:
-            media = [types.InputMediaPhoto(photo_id, caption=channel_text if i == 0 else None, parse_mode='Markdown') 
-                     for i, photo_id in enumerate(photos)]
-            sent_messages = await bot.send_media_group(CHANNEL_ID, media)
-            published_message = sent_messages[0] if sent_messages else None
+        markup = types.InlineKeyboardMarkup(row_width=2)
+        channel_url = f"{CHANNEL_URL_PREFIX}{published_message.message_id}"
+        markup.add(types.InlineKeyboardButton("👀 Переглянути в каналі", url=channel_url))
+        
+        if new_republish_count < republish_limit:
+            markup.add(types.InlineKeyboardButton(f"🔁 Переопублікувати ({new_republish_count}/{republish_limit})", callback_data=f"republish_{product_id}"))
         else:
-            published_message = await bot.send_message(CHANNEL_ID, channel_text, parse_mode='Markdown')
+            markup.add(types.InlineKeyboardButton(f"❌ Переопублікувати (ліміт {new_republish_count}/{republish_limit})", callback_data="republish_limit_reached"))
 
-        if published_message:
-            new_channel_message_id = published_message.message_id 
-            
-            new_republish_count = 1 if last_republish_date != today else current_republish_count + 1
-
-            await conn.execute("""
-                UPDATE products SET 
-                    channel_message_id = $1, 
-                    views = 0, 
-                    republish_count = $2, 
-                    last_republish_date = $3,
-                    updated_at = CURRENT_TIMESTAMP
-                WHERE id = $4;
-            """, new_channel_message_id, new_republish_count, today, product_id)
-            await log_statistics('product_republished', seller_chat_id, product_id)
-
-            await bot.answer_callback_query(call.id, f"Товар '{product_info['product_name']}' успішно переопубліковано!")
-            await bot.send_message(seller_chat_id,
-                             f"✅ Ваш товар '{product_info['product_name']}' успішно переопубліковано! [Переглянути](https://t.me/c/{str(CHANNEL_ID).replace('-100', '')}/{published_message.message_id})", 
-                             parse_mode='Markdown', disable_web_page_preview=True)
-            
-            current_message_text = call.message.text
-            updated_message_text_lines = current_message_text.splitlines()
-            
-            new_lines = []
-            for line in updated_message_text_lines:
-                if "🔁 Переопублікувати" in line or "❌ Переопублікувати" in line:
-                    if new_republish_count < republish_limit:
-                        new_lines.append(f"   🔁 Переопублікувати ({new_republish_count}/{republish_limit})")
-                    else:
-                        new_lines.append(f"   ❌ Переопублікувати (ліміт {new_republish_count}/{republish_limit})")
-                elif "👁️ Перегляди:" in line:
-                    new_lines.append(f"   👁️ Перегляди: 0") 
-                else:
-                    new_lines.append(line)
-            updated_message_text = "\n".join(new_lines)
-            
-            markup = types.InlineKeyboardMarkup(row_width=2)
-            channel_link_part = str(CHANNEL_ID).replace("-100", "") 
-            channel_url = f"https://t.me/c/{channel_link_part}/{published_message.message_id}"
-            markup.add(types.InlineKeyboardButton("👀 Переглянути в каналі", url=channel_url))
-            
-            if new_republish_count < republish_limit:
-                markup.add(types.InlineKeyboardButton(f"🔁 Переопублікувати ({new_republish_count}/{republish_limit})", callback_data=f"republish_{product_id}"))
-            else:
-                markup.add(types.InlineKeyboardButton(f"❌ Переопублікувати (ліміт {new_republish_count}/{republish_limit})", callback_data="republish_limit_reached"))
+        markup.add(types.InlineKeyboardButton("✅ Продано", callback_data=f"sold_my_{product_id}"))
+        markup.add(types.InlineKeyboardButton("✏️ Змінити ціну", callback_data=f"change_price_{product_id}"))
+        markup.add(types.InlineKeyboardButton("🗑️ Видалити", callback_data=f"delete_my_{product_id}"))
 
-            markup.add(types.InlineKeyboardButton("✅ Продано", callback_data=f"sold_my_{product_id}"))
-            markup.add(types.InlineKeyboardButton("✏️ Змінити ціну", callback_data=f"change_price_{product_id}"))
-            markup.add(types.InlineKeyboardButton("🗑️ Видалити", callback_data=f"delete_my_{product_id}"))
+        await bot.edit_message_text(updated_message_text, call.message.chat.id, call.message.message_id, parse_mode='Markdown', reply_markup=markup, disable_web_page_preview=True)
 
-            await bot.edit_message_text(updated_message_text, call.message.chat.id, call.message.message_id, parse_mode='Markdown', reply_markup=markup, disable_web_page_preview=True)
-
-        else:
-            await bot.answer_callback_query(call.id, "❌ Не вдалося переопублікувати товар.")
-            raise Exception("Не вдалося опублікувати повідомлення в канал при переопублікації.")
+    else:
+        await bot.answer_callback_query(call.id, "❌ Не вдалося переопублікувати товар.")
+        raise Exception("Не вдалося опублікувати повідомлення в канал при переопублікації.")
 
 @async_error_handler
-async def handle_delete_my_product(call):
+async def handle_delete_my_product(call, product_id):
     seller_chat_id = call.message.chat.id
-    product_id = int(call.data.split('_')[3]) 
 
     pool = await get_db_connection_async()
-    async with pool.acquire() as conn:
-        product_info = await conn.fetchrow("""
-            SELECT product_name, channel_message_id, status FROM products
-            WHERE id = $1 AND seller_chat_id = $2;
-        """, product_id, seller_chat_id)
-
-        if not product_info:
-            await bot.answer_callback_query(call.id, "Товар не знайдено або ви не є його продавцем.")
-            return
+    # Ownership check, fetch and delete in one statement; favorites and commissions go via ON DELETE CASCADE
+    product_info = await pool.fetchrow("""
+        DELETE FROM products WHERE id = $1 AND seller_chat_id = $2
+        RETURNING product_name, channel_message_id;
+    """, product_id, seller_chat_id)
+
+    if not product_info:
+        await bot.answer_callback_query(call.id, "Товар не знайдено або ви не є його продавцем.")
+        return
 
-        product_name = product_info['product_name']
-        channel_message_id = product_info['channel_message_id']
-        
-        if channel_message_id:
-            try:
-                await bot.delete_message(CHANNEL_ID, channel_message_id) 
-            except async_telebot.apihelper.ApiTelegramException as e:
-                logger.warning(f"Не вдалося видалити повідомлення {channel_message_id} з каналу: {e}")
-        
-        await conn.execute("DELETE FROM products WHERE id = $1;", product_id)
-        await log_statistics('product_deleted', seller_chat_id, product_id)
+    product_name = product_info['product_name']
+    channel_message_id = product_info['channel_message_id']
+    
+    if channel_message_id:
+        try:
+            await bot.delete_message(CHANNEL_ID, channel_message_id) 
+        except asyncio_helper.ApiTelegramException as e:
+            logger.warning(f"Не вдалося видалити повідомлення {channel_message_id} з каналу: {e}")
+    
+    await log_statistics('product_deleted', seller_chat_id, product_id)
 
-        await bot.answer_callback_query(call.id, f"Товар '{product_name}' успішно видалено.")
-        await bot.send_message(seller_chat_id, f"🗑️ Ваш товар '{product_name}' (ID: {product_id}) було видалено.", reply_markup=main_menu_markup)
-        
-        await bot.delete_message(call.message.chat.id, call.message.message_id) 
+    await bot.answer_callback_query(call.id, f"Товар '{product_name}' успішно видалено.")
+    await bot.send_message(seller_chat_id, f"🗑️ Ваш товар '{product_name}' (ID: {product_id}) було видалено.", reply_markup=main_menu_markup)
+    
+    await bot.delete_message(call.message.chat.id, call.message.message_id) 
 
 @async_error_handler
-async def handle_change_price_init(call):
+async def handle_change_price_init(call, product_id):
     chat_id = call.message.chat.id
-    product_id = int(call.data.split('_')[2]) 
 
     user_data[chat_id] = {
         'flow': 'change_price',
@@ -1799,93 +2159,112 @@ async def process_new_price(message):
     new_price = message.text.strip()
 
     pool = await get_db_connection_async()
-    async with pool.acquire() as conn:
-        product_info = await conn.fetchrow("SELECT seller_chat_id, product_name, channel_message_id FROM products WHERE id = $1;", product_id)
-
-        if not product_info or product_info['seller_chat_id'] != chat_id:
-            await bot.send_message(chat_id, "❌ Ви не є власником цього товару.")
-            return
-
-        await conn.execute("""
-            UPDATE products SET price = $1, updated_at = CURRENT_TIMESTAMP
-            WHERE id = $2;
-        """, new_price, product_id)
+    # Ownership check, update and the post-update snapshot for the channel in one round-trip;
+    # no row means not the owner
+    product_info = await pool.fetchrow("""
+        UPDATE products SET price = $1, updated_at = CURRENT_TIMESTAMP
+        WHERE id = $2 AND seller_chat_id = $3
+        RETURNING *;
+    """, new_price, product_id, chat_id)
+
+    if not product_info:
+        await bot.send_message(chat_id, "❌ Ви не є власником цього товару.")
+        return
 
-        await bot.send_message(chat_id, f"✅ Ціну для товару '{product_info['product_name']}' (ID: {product_id}) оновлено.", reply_markup=main_menu_markup)
-        await log_statistics('price_changed', chat_id, product_id, f"Нова ціна: {new_price}")
+    await bot.send_message(chat_id, f"✅ Ціну для товару '{product_info['product_name']}' (ID: {product_id}) оновлено.", reply_markup=main_menu_markup)
+    await log_statistics('price_changed', chat_id, product_id, f"Нова ціна: {new_price}")
 
-        if product_info['channel_message_id']:
-            await publish_product_to_channel(product_id) 
-            await bot.send_message(chat_id, "Оголошення в каналі оновлено з новою ціною.")
+    if product_info['channel_message_id']:
+        run_in_background(republish_with_notice(product_id, chat_id, "Оголошення в каналі оновлено з новою ціною.", product_info))
     
     if chat_id in user_data: del user_data[chat_id] 
 
+async def republish_with_notice(product_id, chat_id, notice_text, product=None):
+    await publish_product_to_channel(product_id, product)
+    await bot.send_message(chat_id, notice_text)
+
+CHANNEL_POST_TEMPLATE = (
+    "📦 *Новий товар: {product_name}*\n\n"
+    "💰 *Ціна:* {price}\n"
+    "🚚 *Доставка:* {shipping_text}\n"
+    "📝 *Опис:*\n{description}\n\n"
+    "📍 Геолокація: {geo_text}\n"
+    "🏷️ *Хештеги:* {hashtags}\n\n"
+    "👤 *Продавець:* [Написати продавцю](tg://user?id={seller_chat_id})"
+)
+
+def format_channel_text(product_name, price, shipping_text, description, geolocation, hashtags, seller_chat_id):
+    return CHANNEL_POST_TEMPLATE.format_map({
+        'product_name': escape_markdown(product_name),
+        'price': escape_markdown(price),
+        'shipping_text': escape_markdown(shipping_text),
+        'description': escape_markdown(description),
+        'geo_text': 'Присутня' if geolocation else 'Відсутня',
+        'hashtags': escape_markdown(hashtags),
+        'seller_chat_id': seller_chat_id,
+    })
+
+async def send_channel_post(channel_text, photos):
+    """Posts a product to the channel; returns the message whose id is stored as channel_message_id."""
+    if len(photos) == 1:
+        # A single photo with its caption is one plain message, not a one-item album
+        return await bot.send_photo(CHANNEL_ID, photos[0], caption=channel_text, parse_mode='Markdown')
+    if photos:
+        media = [types.InputMediaPhoto(photo_id, caption=channel_text if i == 0 else None, parse_mode='Markdown')
+                 for i, photo_id in enumerate(photos)]
+        sent_messages = await bot.send_media_group(CHANNEL_ID, media)
+        return sent_messages[0] if sent_messages else None
+    return await bot.send_message(CHANNEL_ID, channel_text, parse_mode='Markdown')
+
+async def delete_channel_message(message_id):
+    try:
+        await bot.delete_message(CHANNEL_ID, message_id)
+    except Exception as e:
+        logger.warning(f"Не вдалося видалити старе повідомлення {message_id} з каналу: {e}")
+
 @async_error_handler
-async def publish_product_to_channel(product_id):
+async def publish_product_to_channel(product_id, product=None):
+    # Callers that have just written the row (e.g. UPDATE ... RETURNING *) pass it in to skip the re-read
     pool = await get_db_connection_async()
-    async with pool.acquire() as conn:
-        product = await conn.fetchrow("SELECT * FROM products WHERE id = $1", product_id)
-        if not product: return
+    if product is None:
+        product = await pool.fetchrow("SELECT * FROM products WHERE id = $1", product_id)
+    if not product: return
 
-        photos = json.loads(product['photos'] or '[]')
-        shipping = ", ".join(json.loads(product['shipping_options'] or '[]')) or 'Не вказано'
-        
-        product_hashtags = product['hashtags'] if product['hashtags'] else generate_hashtags(product['description'])
+    photos = product['photos'] or []
+    shipping = ", ".join(product['shipping_options'] or []) or 'Не вказано'
+    
+    product_hashtags = product['hashtags'] if product['hashtags'] else generate_hashtags(product['description'])
 
-        channel_text = (
-            f"📦 *{product['product_name']}*\n\n"
-            f"💰 *Ціна:* {product['price']}\n"
-            f"🚚 *Доставка:* {shipping}\n"
-            f"📍 *Геолокація:* {'Присутня' if product['geolocation'] else 'Відсутня'}\n\n"
-            f"📝 *Опис:*\n{product['description']}\n\n"
-            f"#{product['seller_username'] if product['seller_username'] else 'Продавець'} {product_hashtags}\n\n"
-            f"👤 *Продавець:* [Написати](tg://user?id={product['seller_chat_id']})"
-        )
-        
-        if product['channel_message_id']:
-            try: 
-                await bot.delete_message(CHANNEL_ID, product['channel_message_id'])
-            except Exception as e:
-                logger.warning(f"Не вдалося видалити старе повідомлення {product['channel_message_id']} з каналу: {e}")
+    # Same layout as approve and republish, so the post looks the same after a price or hashtag edit
+    channel_text = format_channel_text(product['product_name'], product['price'], shipping, product['description'],
+                                       product['geolocation'], product_hashtags, product['seller_chat_id'])
 
-        published_message = None
-        if photos:
-            media = [types.InputMediaPhoto(p, caption=channel_text if i == 0 else '', parse_mode='Markdown') for i, p in enumerate(photos)]
-            sent_messages = await bot.send_media_group(CHANNEL_ID, media)
-            published_message = sent_messages[0] 
-        else:
-            published_message = await bot.send_message(CHANNEL_ID, channel_text, parse_mode='Markdown')
+    # No pooled connection is held while Telegram uploads the post; the UPDATE takes its own afterwards
+    published_message = await send_channel_post(channel_text, photos)
+    
+    if published_message:
+        await pool.execute("""
+            UPDATE products SET status = 'approved', moderator_id = $1, moderated_at = CURRENT_TIMESTAMP,
+            channel_message_id = $2, hashtags = COALESCE(hashtags, $4)
+            WHERE id = $3;
+        """, ADMIN_CHAT_ID, published_message.message_id, product_id, product_hashtags)
+        if product['channel_message_id']:
+            run_in_background(delete_channel_message(product['channel_message_id']))
         
-        if published_message:
-            await conn.execute("""
-                UPDATE products SET status = 'approved', moderator_id = $1, moderated_at = CURRENT_TIMESTAMP,
-                channel_message_id = $2 
-                WHERE id = $3;
-            """, ADMIN_CHAT_ID, published_message.message_id, product_id)
-            
-            if product['status'] == 'pending':
-                await bot.send_message(product['seller_chat_id'], f"✅ Ваш товар '{product['product_name']}' успішно опубліковано!")
+        if product['status'] == 'pending':
+            await bot.send_message(product['seller_chat_id'], f"✅ Ваш товар '{product['product_name']}' успішно опубліковано!")
+
+MOD_ACTION_RE = re.compile(r'^(mod_edit_tags|mod_rotate_photo)_(\d+)(?:_(\d+))?$')
 
 @async_error_handler
-async def handle_moderator_actions(call):
+async def handle_moderator_actions(call, action_prefix, product_id, seller_chat_id=None):
     if call.message.chat.id != ADMIN_CHAT_ID:
         await bot.answer_callback_query(call.id, "❌ Доступ заборонено.")
         return
     
-    parts = call.data.rsplit('_', 1)
-    if len(parts) < 2:
-        logger.error(f"Некоректний формат callback_data: {call.data}")
-        await bot.answer_callback_query(call.id, "❌ Некоректний запит.")
-        return
-
-    action_prefix = parts[0]
-    product_id_str = parts[1]
-
-    try: product_id = int(product_id_str)
-    except ValueError:
-        logger.error(f"Помилка конвертації product_id: {product_id_str}: {call.data}", exc_info=True)
-        await bot.answer_callback_query(call.id, "❌ Помилка в ID товару.")
-        return
+    # mod_<action>_<product_id>[_<seller_chat_id>]; older messages carry no seller id
+    product_id = int(product_id)
+    seller_chat_id = int(seller_chat_id) if seller_chat_id else None
 
     if action_prefix == 'mod_edit_tags':
         user_data[ADMIN_CHAT_ID] = {'flow': 'mod_edit_tags', 'product_id': product_id}
@@ -1893,17 +2272,21 @@ async def handle_moderator_actions(call):
         await bot.send_message(ADMIN_CHAT_ID, f"Введіть нові хештеги для товару ID {product_id} (через пробіл, без #):",
                          reply_markup=types.ForceReply(selective=True))
     elif action_prefix == 'mod_rotate_photo':
-        pool = await get_db_connection_async()
-        async with pool.acquire() as conn:
-            product = await conn.fetchrow("SELECT seller_chat_id, product_name FROM products WHERE id = $1", product_id)
-            if product:
-                await bot.send_message(product['seller_chat_id'], 
-                                 f"❗️ *Модератор просить вас виправити фото для товару '{product['product_name']}'* (ID: {product_id}).\n"
-                                 "Видаліть оголошення та додайте заново з коректними фото.",
-                                 parse_mode='Markdown')
-                await bot.answer_callback_query(call.id, "Запит на виправлення фото відправлено продавцю.")
-            else:
+        product_name = review_product_names.get(product_id)
+        if seller_chat_id is None or product_name is None:
+            pool = await get_db_connection_async()
+            async with pool.acquire() as conn:
+                product = await conn.fetchrow("SELECT seller_chat_id, product_name FROM products WHERE id = $1", product_id)
+            if not product:
                 await bot.answer_callback_query(call.id, "Товар не знайдено.")
+                return
+            seller_chat_id, product_name = product['seller_chat_id'], product['product_name']
+
+        await bot.send_message(seller_chat_id, 
+                         f"❗️ *Модератор просить вас виправити фото для товару '{product_name}'* (ID: {product_id}).\n"
+                         "Видаліть оголошення та додайте заново з коректними фото.",
+                         parse_mode='Markdown')
+        await bot.answer_callback_query(call.id, "Запит на виправлення фото відправлено продавцю.")
     else:
         await bot.answer_callback_query(call.id, "Невідома дія модератора.")
 
@@ -1915,49 +2298,55 @@ async def process_new_hashtags_mod(message):
     product_id = user_data[chat_id]['product_id']
     new_hashtags_raw = message.text.strip()
     
-    cleaned_hashtags = [f"#{word.lower()}" for word in re.findall(r'\b\w+\b', new_hashtags_raw) if len(word) > 0]
-    final_hashtags_str = " ".join(cleaned_hashtags)
+    final_hashtags_str = " ".join('#' + m.group(0).lower() for m in HASHTAG_WORD_RE.finditer(new_hashtags_raw))
 
+    # pool.execute returns the connection at once; holding it here while publish_product_to_channel
+    # acquires its own would take two pool slots per edit
     pool = await get_db_connection_async()
-    async with pool.acquire() as conn:
-        await conn.execute("""
-            UPDATE products SET hashtags = $1, updated_at = CURRENT_TIMESTAMP
-            WHERE id = $2;
-        """, final_hashtags_str, product_id)
+    await pool.execute("""
+        UPDATE products SET hashtags = $1, updated_at = CURRENT_TIMESTAMP
+        WHERE id = $2;
+    """, final_hashtags_str, product_id)
 
-        await bot.send_message(chat_id, f"✅ Хештеги для товару ID {product_id} оновлено на: `{final_hashtags_str}`", parse_mode='Markdown')
-        await log_statistics('moderator_edited_hashtags', chat_id, product_id, f"Нові хештеги: {final_hashtags_str}")
-        
-        await publish_product_to_channel(product_id)
-        await bot.send_message(chat_id, "Оголошення в каналі оновлено з новими хештегами.")
+    await bot.send_message(chat_id, f"✅ Хештеги для товару ID {product_id} оновлено на: `{final_hashtags_str}`", parse_mode='Markdown')
+    await log_statistics('moderator_edited_hashtags', chat_id, product_id, f"Нові хештеги: {final_hashtags_str}")
+    
+    # The channel re-post (several API calls) runs in the background and confirms on its own
+    run_in_background(republish_with_notice(product_id, chat_id, "Оголошення в каналі оновлено з новими хештегами."))
     
     if chat_id in user_data: del user_data[chat_id]
 
 @async_error_handler
-async def handle_toggle_favorite(call):
+async def handle_toggle_favorite(call, product_id):
     user_chat_id = call.from_user.id
-    _, _, product_id_str = call.data.split('_') 
-    product_id = int(product_id_str)
+    product_id = int(product_id)
 
+    # Delete-or-insert in one round trip: the INSERT only runs when the DELETE found nothing
     pool = await get_db_connection_async()
-    async with pool.acquire() as conn:
-        is_favorited = await conn.fetchrow("SELECT id FROM favorites WHERE user_chat_id = $1 AND product_id = $2;", user_chat_id, product_id)
+    removed = await pool.fetchval("""
+        WITH del AS (
+            DELETE FROM favorites WHERE user_chat_id = $1 AND product_id = $2 RETURNING 1
+        ), ins AS (
+            INSERT INTO favorites (user_chat_id, product_id)
+            SELECT $1, $2 WHERE NOT EXISTS (SELECT 1 FROM del)
+            ON CONFLICT (user_chat_id, product_id) DO NOTHING
+        )
+        SELECT EXISTS (SELECT 1 FROM del);
+    """, user_chat_id, product_id)
 
-        if is_favorited:
-            await conn.execute("DELETE FROM favorites WHERE id = $1;", is_favorited['id'])
-            await bot.answer_callback_query(call.id, "💔 Видалено з обраного")
-        else:
-            await conn.execute("INSERT INTO favorites (user_chat_id, product_id) VALUES ($1, $2);", user_chat_id, product_id)
-            await bot.answer_callback_query(call.id, "❤️ Додано до обраного!")
+    if removed:
+        await bot.answer_callback_query(call.id, "💔 Видалено з обраного")
+    else:
+        await bot.answer_callback_query(call.id, "❤️ Додано до обраного!")
 
 @async_error_handler
-async def handle_shipping_choice(call):
+async def handle_shipping_choice(call, option):
     chat_id = call.message.chat.id
     if chat_id not in user_data or user_data[chat_id].get('step') != 'waiting_shipping':
         await bot.answer_callback_query(call.id, "Некоректний запит.")
         return
 
-    if call.data == 'shipping_next':
+    if option == 'next':
         if not user_data[chat_id]['data']['shipping_options']:
             await bot.answer_callback_query(call.id, "Оберіть хоча б один спосіб доставки.", show_alert=True)
             return
@@ -1965,75 +2354,73 @@ async def handle_shipping_choice(call):
         await go_to_next_step(chat_id)
         return
 
-    option = call.data.replace('shipping_', '') 
     selected = user_data[chat_id]['data'].get('shipping_options', [])
 
     if option in selected: selected.remove(option)
     else: selected.append(option)
     user_data[chat_id]['data']['shipping_options'] = selected 
 
-    inline_markup = types.InlineKeyboardMarkup(row_width=2)
-    shipping_options_list = ["Наложка Нова Пошта", "Наложка Укрпошта", "Особиста зустріч"]
-
-    buttons = []
-    for opt in shipping_options_list:
-        emoji = '✅ ' if opt in selected else ''
-        buttons.append(types.InlineKeyboardButton(f"{emoji}{opt}", callback_data=f"shipping_{opt}"))
-    
-    inline_markup.add(*buttons)
-    inline_markup.add(types.InlineKeyboardButton("Далі ➡️", callback_data="shipping_next"))
-    
     try:
-        await bot.edit_message_reply_markup(chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=inline_markup)
-    except async_telebot.apihelper.ApiTelegramException as e:
+        await bot.edit_message_reply_markup(chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=shipping_markup_for(selected))
+    except asyncio_helper.ApiTelegramException as e:
         logger.warning(f"Не вдалося оновити кнопки доставки: {e}")
     
     await bot.answer_callback_query(call.id) 
 
+WINNERS_PERIOD_BUTTONS = (
+    types.InlineKeyboardButton("За тиждень", callback_data="winners_week"),
+    types.InlineKeyboardButton("За місяць", callback_data="winners_month"),
+    types.InlineKeyboardButton("За рік", callback_data="winners_year"),
+)
+WINNERS_MENU_MARKUP = types.InlineKeyboardMarkup(row_width=1)
+WINNERS_MENU_MARKUP.add(*WINNERS_PERIOD_BUTTONS)
+# The admin variant only adds the raffle button
+WINNERS_MENU_ADMIN_MARKUP = types.InlineKeyboardMarkup(row_width=1)
+WINNERS_MENU_ADMIN_MARKUP.add(*WINNERS_PERIOD_BUTTONS)
+WINNERS_MENU_ADMIN_MARKUP.add(types.InlineKeyboardButton("🎲 Провести розіграш (Admin)", callback_data="runraffle_week"))
+
 @async_error_handler
 async def handle_winners_menu(call):
     text = "🏆 *Переможці розіграшів*\n\nОберіть період для перегляду топ-реферерів:"
-    markup = types.InlineKeyboardMarkup(row_width=1)
-    markup.add(
-        types.InlineKeyboardButton("За тиждень", callback_data="winners_week"),
-        types.InlineKeyboardButton("За місяць", callback_data="winners_month"),
-        types.InlineKeyboardButton("За рік", callback_data="winners_year")
-    )
-    if call.from_user.id == ADMIN_CHAT_ID:
-        markup.add(types.InlineKeyboardButton("🎲 Провести розіграш (Admin)", callback_data="runraffle_week"))
+    markup = WINNERS_MENU_ADMIN_MARKUP if call.from_user.id == ADMIN_CHAT_ID else WINNERS_MENU_MARKUP
     
     await bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode='Markdown')
     await bot.answer_callback_query(call.id)
 
+# interval_days -> (top referrers, fetched_at); the leaderboard only moves by minutes
+LEADERBOARD_CACHE_TTL = 120
+leaderboard_cache = {}
+
 @async_error_handler
-async def handle_show_winners(call):
-    period = call.data.split('_')[1] 
+async def handle_show_winners(call, period):
     intervals = {'week': 7, 'month': 30, 'year': 365}
     interval_days = intervals.get(period, 7) 
+    # Clear the button spinner before the query; the result arrives as a separate message
+    await bot.answer_callback_query(call.id)
 
-    pool = await get_db_connection_async()
-    async with pool.acquire() as conn:
-        top_referrers = await conn.fetch("""
-            SELECT referrer_id, COUNT(*) as referrals_count
-            FROM users
-            WHERE referrer_id IS NOT NULL AND joined_at >= NOW() - INTERVAL '%s days'
-            GROUP BY referrer_id ORDER BY referrals_count DESC LIMIT 10;
+    cached = leaderboard_cache.get(interval_days)
+    if cached and time.monotonic() - cached[1] < LEADERBOARD_CACHE_TTL:
+        top_referrers = cached[0]
+    else:
+        pool = await get_db_connection_async()
+        # Usernames come from our own users table, so rendering needs no get_chat calls
+        top_referrers = await pool.fetch("""
+            SELECT ref.referrer_id, r.username, COUNT(*) AS referrals_count
+            FROM users ref
+            LEFT JOIN users r ON r.chat_id = ref.referrer_id
+            WHERE ref.referrer_id IS NOT NULL AND ref.joined_at >= NOW() - make_interval(days => $1)
+            GROUP BY ref.referrer_id, r.username ORDER BY referrals_count DESC LIMIT 10;
         """, interval_days)
+        leaderboard_cache[interval_days] = (top_referrers, time.monotonic())
             
     text = f"🏆 *Топ реферерів за останній {'тиждень' if period == 'week' else 'місяць' if period == 'month' else 'рік'}:*\n\n"
     if top_referrers:
         for i, r in enumerate(top_referrers, 1):
-            try: 
-                user_info = await bot.get_chat(r['referrer_id'])
-                username = f"@{user_info.username}" if user_info and user_info.username else f"ID: {r['referrer_id']}"
-            except Exception as e:
-                logger.warning(f"Не вдалося отримати інфо про реферера {r['referrer_id']}: {e}")
-                username = f"ID: {r['referrer_id']}"
+            username = f"@{escape_markdown(r['username'])}" if r['username'] else f"ID: {r['referrer_id']}"
             text += f"{i}. {username} - {r['referrals_count']} запрошень\n"
     else:
         text += "_Немає даних за цей період._\n"
             
-    await bot.answer_callback_query(call.id)
     await bot.send_message(call.message.chat.id, text, parse_mode='Markdown')
 
 @async_error_handler
@@ -2042,76 +2429,128 @@ async def handle_run_raffle(call):
         await bot.answer_callback_query(call.id, "❌ Доступ заборонено.")
         return
         
+    await bot.answer_callback_query(call.id)
     pool = await get_db_connection_async()
-    async with pool.acquire() as conn:
-        participants = [row['referrer_id'] for row in await conn.fetch("""
+    # The draw happens in SQL: one id comes back instead of the whole participant list
+    winner_id = await pool.fetchval("""
+        SELECT referrer_id FROM (
             SELECT DISTINCT referrer_id FROM users
-            WHERE referrer_id IS NOT NULL AND joined_at >= NOW() - INTERVAL '7 days';
-        """)]
-        
-        if not participants:
-            await bot.answer_callback_query(call.id, "Немає учасників для розіграшу.")
-            return
-
-        winner_id = random.choice(participants) 
-        
-        winner_info = None
-        try: winner_info = await bot.get_chat(winner_id)
-        except Exception as e: logger.warning(f"Не вдалося отримати інфо про переможця {winner_id}: {e}")
-
-        winner_username = f"@{winner_info.username}" if winner_info and winner_info.username else f"ID: {winner_id}"
-        
-        text = f"🎉 *Переможець щотижневого розіграшу:*\n\n {winner_username} \n\nВітаємо!"
-        
-        await bot.answer_callback_query(call.id)
-        await bot.send_message(call.message.chat.id, text, parse_mode='Markdown') 
-        await bot.send_message(CHANNEL_ID, text, parse_mode='Markdown') 
-        await log_statistics('raffle_conducted', ADMIN_CHAT_ID, details=f"winner: {winner_id}")
+            WHERE referrer_id IS NOT NULL AND joined_at >= NOW() - INTERVAL '7 days'
+        ) participants
+        ORDER BY random() LIMIT 1;
+    """)
+    
+    if winner_id is None:
+        await bot.send_message(call.message.chat.id, "Немає учасників для розіграшу.")
+        return
+    
+    winner_username = await get_chat_username(winner_id)
+    winner_username = f"@{escape_markdown(winner_username)}" if winner_username else f"ID: {winner_id}"
+    
+    text = f"🎉 *Переможець щотижневого розіграшу:*\n\n {winner_username} \n\nВітаємо!"
+    
+    sent = await bot.send_message(call.message.chat.id, text, parse_mode='Markdown') 
+    # The channel gets a copy of the admin's message; Telegram reuses the already parsed entities
+    await bot.copy_message(CHANNEL_ID, call.message.chat.id, sent.message_id)
+    await log_statistics('raffle_conducted', ADMIN_CHAT_ID, details=f"winner: {winner_id}")
 
-@bot.callback_query_handler(func=lambda call: call.data == "admin_panel_main")
 @async_error_handler
 async def back_to_admin_panel(call):
     if call.message.chat.id != ADMIN_CHAT_ID:
         await bot.answer_callback_query(call.id, "❌ Доступ заборонено.")
         return
     
-    markup = types.InlineKeyboardMarkup(row_width=2)
-    markup.add(
-        types.InlineKeyboardButton("📊 Статистика", callback_data="admin_stats"),
-        types.InlineKeyboardButton("⏳ На модерації", callback_data="admin_pending"),
-        types.InlineKeyboardButton("👥 Користувачі", callback_data="admin_users"),
-        types.InlineKeyboardButton("🚫 Блокування", callback_data="admin_block"),
-        types.InlineKeyboardButton("💰 Комісії", callback_data="admin_commissions"),
-        types.InlineKeyboardButton("🤖 AI Статистика", callback_data="admin_ai_stats"),
-        types.InlineKeyboardButton("🏆 Реферали", callback_data="admin_referrals")
-    )
-
     await bot.edit_message_text("🔧 *Адмін-панель*\n\nОберіть дію:",
                           chat_id=call.message.chat.id, message_id=call.message.message_id,
-                          reply_markup=markup, parse_mode='Markdown')
+                          reply_markup=ADMIN_PANEL_MARKUP, parse_mode='Markdown')
     await bot.answer_callback_query(call.id)
 
-# Flask webhook handler
-@app.route(f'/{TOKEN}', methods=['POST'])
-async def webhook_handler():
-    if request.headers.get('content-type') == 'application/json':
-        json_string = await request.get_data(as_text=True)
-        update = telebot.types.Update.de_json(json_string)
-        await bot.process_new_updates([update]) 
-        return '!', 200 
+@async_error_handler
+async def handle_republish_limit_reached(call):
+    await bot.answer_callback_query(call.id, "Ви вже досягли ліміту переопублікацій на сьогодні.")
+
+# Callback dispatch table: patterns are compiled once and checked in order, first match wins.
+# More specific patterns must precede the generic ones (admin_panel_main before admin_*, etc.).
+# Capture groups are passed to the handler as positional arguments after call.
+# Seller actions on their own product: <action>_<product_id>, parsed once and passed to the handler
+SELLER_PRODUCT_CALLBACK_RE = re.compile(r'^(sold_my|delete_my|republish|change_price)_(\d+)$')
+SELLER_PRODUCT_HANDLERS = {
+    'sold_my': handle_seller_sold_product,
+    'delete_my': handle_delete_my_product,
+    'republish': handle_republish_product,
+    'change_price': handle_change_price_init,
+}
+
+async def dispatch_seller_product_callback(call, action, product_id):
+    await SELLER_PRODUCT_HANDLERS[action](call, int(product_id))
+
+CALLBACK_ROUTES = [
+    (re.compile(r'^admin_panel_main$'), back_to_admin_panel),
+    # admin_<action>[_<after_id>]; the lazy \w+? keeps multi-word actions like ai_stats whole
+    (re.compile(r'^admin_(\w+?)(?:_(\d+))?$'), handle_admin_callbacks),
+    (PRODUCT_MODERATION_RE, handle_product_moderation_callbacks),
+    (MOD_ACTION_RE, handle_moderator_actions),
+    (SELLER_PRODUCT_CALLBACK_RE, dispatch_seller_product_callback),
+    (re.compile(r'^republish_limit_reached$'), handle_republish_limit_reached),
+    (re.compile(r'^toggle_favorite_(\d+)$'), handle_toggle_favorite),
+    (re.compile(r'^shipping_(.+)$'), handle_shipping_choice),
+    (re.compile(r'^show_commission_info$'), send_commission_info),
+    (re.compile(r'^show_winners_menu$'), handle_winners_menu),
+    (re.compile(r'^winners_(week|month|year)$'), handle_show_winners),
+    (re.compile(r'^runraffle_\w+$'), handle_run_raffle),
+    (USER_BLOCK_RE, handle_user_block_callbacks),
+]
+
+# Updates are acknowledged as soon as they are queued; workers run the handlers (Gemini calls included)
+UPDATE_WORKERS = 16
+UPDATE_QUEUE_MAXSIZE = 1000
+# On shutdown, queued updates (already acknowledged with 200) get this long to finish before workers are cancelled
+UPDATE_DRAIN_TIMEOUT = 25
+update_queue = None
+accepting_updates = True
+
+async def process_updates_worker():
+    while True:
+        update = await update_queue.get()
+        try:
+            await bot.process_new_updates([update])
+        except Exception as e:
+            logger.error(f"Помилка обробки оновлення {update.update_id}: {e}", exc_info=True)
+        finally:
+            update_queue.task_done()
+
+async def webhook_handler(request):
+    if not accepting_updates:
+        # Shutting down: a non-2xx answer makes Telegram redeliver the update to the next instance
+        return web.Response(text='Service Unavailable', status=503)
+    if request.content_type == 'application/json':
+        update = types.Update.de_json(await request.json())
+        try:
+            update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Telegram redelivers on a non-2xx answer, so shedding here loses nothing
+            logger.warning("Черга оновлень переповнена, апдейт відхилено з 503.")
+            return web.Response(text='Service Unavailable', status=503)
+        return web.Response(text='!') 
     else:
         logger.warning("Отримано запит до вебхука без правильного Content-Type (application/json).")
-        return 'Content-Type must be application/json', 403 
+        return web.Response(text='Content-Type must be application/json', status=403) 
 
-async def main():
+async def on_startup(app):
+    global update_queue
     logger.info("Бот запускається...")
-    init_db_sync() # Run synchronous DB initialization once
+    update_queue = asyncio.Queue(maxsize=UPDATE_QUEUE_MAXSIZE)
+    app['update_workers'] = [asyncio.create_task(process_updates_worker()) for _ in range(UPDATE_WORKERS)]
+    # Schema setup is synchronous psycopg2; run it off the event loop once
+    await asyncio.get_running_loop().run_in_executor(None, init_db_sync)
 
     if WEBHOOK_URL and TOKEN:
         try:
             await bot.remove_webhook()
             full_webhook_url = f"{WEBHOOK_URL}/{TOKEN}"
-            await bot.set_webhook(url=full_webhook_url)
+            # Only the update types the bot handles; Telegram may open up to 100 parallel webhook connections
+            await bot.set_webhook(url=full_webhook_url, max_connections=100,
+                                  allowed_updates=["message", "callback_query"])
             logger.info(f"Webhook встановлено на: {full_webhook_url}")
         except Exception as e:
             logger.critical(f"Критична помилка встановлення webhook: {e}", exc_info=True)
@@ -2119,24 +2558,36 @@ async def main():
     else:
         logger.critical("WEBHOOK_URL або TELEGRAM_BOT_TOKEN не встановлено. Бот не може працювати в режимі webhook. Перевірте змінні оточення.")
         exit(1) 
-    
-    # This is a placeholder for running Flask directly in an async context.
-    # For production, you'd typically use a WSGI server like Gunicorn or uWSGI
-    # to serve the Flask app, and they handle the async integration.
-    # The `webhook_handler` above is already async.
-    # To run Flask in an async manner for dev/testing:
-    # app.run() is synchronous, so you'd use something like hypercorn or aiohttp.web
-    # For this example, we assume the hosting environment (e.g., Render) will run Flask via Gunicorn.
-    # No explicit `app.run()` here in async main.
+
+async def on_cleanup(app):
+    global accepting_updates
+    # Updates in the queue were already acknowledged, so Telegram won't resend them: process them before stopping
+    accepting_updates = False
+    try:
+        await asyncio.wait_for(update_queue.join(), UPDATE_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"Не вдалося обробити {update_queue.qsize()} апдейтів з черги за {UPDATE_DRAIN_TIMEOUT} с, вони будуть втрачені.")
+    for task in app['update_workers']:
+        task.cancel()
+    if gemini_session is not None:
+        await gemini_session.close()
+    await drain_statistics_queue()
+    # Write out the last few seconds of last_activity updates while the pool is still open
+    if activity_flusher_task is not None:
+        activity_flusher_task.cancel()
+    await flush_user_activity()
+    if db_pool is not None:
+        await db_pool.close()
+
+def create_app():
+    # One aiohttp server and one event loop for everything: the webhook, the asyncpg pool and background tasks
+    app = web.Application()
+    app.router.add_post(f'/{TOKEN}', webhook_handler)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
 
 if __name__ == '__main__':
-    # Run the main async function
-    asyncio.run(main())
-    
-    # If using Gunicorn, it will handle running the Flask app directly.
-    # The `app` object is imported by Gunicorn.
-    # No direct `app.run()` here as it's assumed Gunicorn will start it.
     port = int(os.environ.get("PORT", 8443))
-    logger.info(f"Flask-додаток готовий для запуску Gunicorn на порту {port}...")
-    # Gunicorn will be invoked externally, e.g.: gunicorn bot:app -w 4 -b 0.0.0.0:$PORT
-    # So, `app.run` is intentionally omitted here to avoid conflicting with Gunicorn.
+    logger.info(f"aiohttp-сервер запускається на порту {port}...")
+    web.run_app(create_app(), host="0.0.0.0", port=port)
@@ -4,18 +4,27 @@ from telebot import types
 import logging
 from datetime import datetime, timedelta, timezone, date # Додано date
 import re
-import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 import random # Додано для переможців розіграшу
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import atexit
+import queue
+import time
+from functools import lru_cache
+import threading
+from cachetools import TTLCache
 
 # Імпорти для Webhook (Flask)
 from flask import Flask, request
 
 # Імпорти для PostgreSQL
 import psycopg2
-from psycopg2 import sql as pg_sql
 from psycopg2 import extras
+from psycopg2 import pool as pg_pool
 
 # Завантажуємо змінні оточення з файлу .env. Це для локальної розробки.
 load_dotenv()
@@ -70,30 +79,68 @@ validate_env_vars()
 
 # --- 4. Ініціалізація TeleBot та Flask ---
 app = Flask(__name__)
-bot = telebot.TeleBot(TOKEN)
+# threaded=False: обробники виконуються в потоці, що викликав process_new_updates, тобто в пулі update_executor
+# (див. submit_update). Власний пул telebot не обмежений і зробив би ліміт апдейтів у роботі фіктивним.
+bot = telebot.TeleBot(TOKEN, threaded=False)
 
 # --- 4.1. НАЛАШТУВАННЯ МЕРЕЖЕВИХ ЗАПИТІВ (RETRY-МЕХАНІЗМ) ---
-# Додано для підвищення стабільності бота. Цей блок автоматично
-# повторює запити до Telegram API у випадку тимчасових мережевих проблем.
-try:
-    from requests.adapters import HTTPAdapter
-    from urllib3.util.retry import Retry
-
-    retry_strategy = Retry(
-        total=3,  # Загальна кількість спроб
-        status_forcelist=[429, 500, 502, 503, 504],  # HTTP коди, при яких повторювати
-        allowed_methods=frozenset(['HEAD', 'GET', 'POST', 'PUT', 'DELETE', 'OPTIONS', 'TRACE']), # Методи для повторення
-        backoff_factor=1,  # Затримка між спробами (1с, 2с, 4с)
-    )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-    session = telebot.apihelper._get_req_session()
-    session.mount("https://", adapter)
-    logger.info("Мережевий адаптер з механізмом повторних спроб успішно налаштовано.")
-except ImportError:
-    logger.warning("Не вдалося імпортувати 'requests' або 'urllib3'. Механізм повторних спроб не активовано.")
+# Додано для підвищення стабільності бота. Адаптер автоматично
+# повторює запити у випадку тимчасових мережевих проблем.
+# Повтори короткі (паузи не довші за 0.4с): запит виконується в робочому потоці, і довгі паузи блокували б обробку інших апдейтів.
+# Якщо сервер повідомив Retry-After (наприклад, при 429), чекаємо саме стільки.
+HTTP_POOL_SIZE = 50
+HTTP_RETRY = Retry(
+    total=2,  # Загальна кількість повторів
+    status_forcelist=[429, 500, 502, 503, 504],  # HTTP коди, при яких повторювати
+    allowed_methods=frozenset(['HEAD', 'GET', 'POST', 'PUT', 'DELETE', 'OPTIONS', 'TRACE']), # Методи для повторення
+    backoff_factor=0.2,
+    respect_retry_after_header=True,
+)
+
+def make_http_session():
+    """Створює сесію requests з пулом keep-alive з'єднань та механізмом повторних спроб."""
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(max_retries=HTTP_RETRY,
+                                          pool_connections=HTTP_POOL_SIZE,
+                                          pool_maxsize=HTTP_POOL_SIZE))
+    return session
+
+# Одна спільна сесія для всіх робочих потоків:
+# без неї telebot створює окрему сесію на кожен потік і щоразу робить TLS-рукостискання.
+telebot.apihelper.session = make_http_session()
+telebot.apihelper.CONNECT_TIMEOUT = 10
 
 
 # --- 5. Декоратор для обробки помилок ---
+# Сповіщення про помилки надсилає окремий потік через власну сесію без повторних спроб і з коротким таймаутом:
+# якщо збоїть сам Telegram, робочий потік не чекає ще й на доставку сповіщень.
+ERROR_NOTIFY_QUEUE_MAXSIZE = 100
+ERROR_NOTIFY_TIMEOUT = 2 # секунди
+error_notify_queue = queue.Queue(maxsize=ERROR_NOTIFY_QUEUE_MAXSIZE)
+error_notify_session = requests.Session()
+
+def notify_error(chat_id, text):
+    """Ставить повідомлення про помилку в чергу на відправку; не блокує виклик."""
+    try:
+        error_notify_queue.put_nowait((chat_id, text))
+    except queue.Full:
+        logger.warning(f"Черга сповіщень про помилки переповнена, повідомлення для {chat_id} пропущено.")
+
+def error_notifier():
+    """Фоновий потік: надсилає повідомлення з черги сповіщень про помилки."""
+    while True:
+        chat_id, text = error_notify_queue.get()
+        try:
+            response = error_notify_session.post(telebot.apihelper.API_URL.format(TOKEN, 'sendMessage'),
+                                                 json={'chat_id': chat_id, 'text': text},
+                                                 timeout=ERROR_NOTIFY_TIMEOUT)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            # Текст винятку містить URL з токеном бота, тому логуємо лише тип помилки
+            logger.error(f"Не вдалося надіслати повідомлення про помилку до {chat_id}: {type(e).__name__}")
+
+threading.Thread(target=error_notifier, name='error-notifier', daemon=True).start()
+
 def error_handler(func):
     """
     Декоратор для централізованої обробки помилок у функціях бота.
@@ -114,31 +161,70 @@ def error_handler(func):
                 elif isinstance(first_arg, types.CallbackQuery):
                     chat_id_to_notify = first_arg.message.chat.id
             
-            try:
-                # Надсилаємо детальне сповіщення адміну
-                bot.send_message(ADMIN_CHAT_ID, f"🚨 Критична помилка в боті!\nФункція: `{func.__name__}`\nПомилка: `{e}`\nДивіться деталі в логах Render.")
-                # Сповіщаємо користувача про внутрішню помилку (якщо це не адмін)
-                if chat_id_to_notify != ADMIN_CHAT_ID:
-                    bot.send_message(chat_id_to_notify, "😔 Вибачте, сталася внутрішня помилка. Адміністратор вже сповіщений.")
-            except Exception as e_notify:
-                logger.error(f"Не вдалося надіслати повідомлення про помилку: {e_notify}")
+            # Надсилаємо детальне сповіщення адміну (через чергу, без очікування)
+            notify_error(ADMIN_CHAT_ID, f"🚨 Критична помилка в боті!\nФункція: `{func.__name__}`\nПомилка: `{e}`\nДивіться деталі в логах Render.")
+            # Сповіщаємо користувача про внутрішню помилку (якщо це не адмін)
+            if chat_id_to_notify != ADMIN_CHAT_ID:
+                notify_error(chat_id_to_notify, "😔 Вибачте, сталася внутрішня помилка. Адміністратор вже сповіщений.")
     return wrapper
 
 # --- 6. Підключення та ініціалізація Бази Даних (PostgreSQL) ---
+# Пул з'єднань: TCP/TLS-підключення та автентифікація виконуються один раз,
+# а не на кожен запит. Пул створюється при першому зверненні.
+DB_POOL_MIN_CONN = int(os.getenv('DB_POOL_MIN_CONN', '4'))
+DB_POOL_MAX_CONN = int(os.getenv('DB_POOL_MAX_CONN', '20'))
+db_pool = None
+db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    """Повертає пул з'єднань, створюючи його при першому виклику."""
+    global db_pool
+    if db_pool is None:
+        with db_pool_lock:
+            if db_pool is None:
+                # DictConnection: кожен conn.cursor() одразу повертає DictCursor, тож результати
+                # доступні і за назвами колонок, і за індексом, без налаштування курсора в обробниках.
+                db_pool = pg_pool.ThreadedConnectionPool(
+                    DB_POOL_MIN_CONN, DB_POOL_MAX_CONN, DATABASE_URL,
+                    connection_factory=extras.DictConnection
+                )
+    return db_pool
+
 def get_db_connection():
     """
-    Встановлює з'єднання з базою даних PostgreSQL.
-    Використовує DATABASE_URL зі змінних оточення.
+    Бере з'єднання з пулу PostgreSQL.
+    Кожне отримане з'єднання потрібно повернути через put_db_connection().
     """
     try:
-        # Використання DictCursor для отримання результатів у вигляді словників,
-        # що зручніше для доступу до даних за назвами колонок.
-        conn = psycopg2.connect(DATABASE_URL, cursor_factory=psycopg2.extras.DictCursor)
-        return conn
+        return get_db_pool().getconn()
     except Exception as e:
         logger.error(f"Помилка підключення до бази даних: {e}", exc_info=True)
         return None
 
+def put_db_connection(conn):
+    """Повертає з'єднання в пул. Незавершену транзакцію пул відкочує сам."""
+    try:
+        get_db_pool().putconn(conn)
+    except Exception as e:
+        logger.error(f"Помилка повернення з'єднання в пул: {e}", exc_info=True)
+
+@contextmanager
+def db_conn():
+    """
+    Контекстний менеджер для роботи з БД:
+    коміт при успіху, відкат при винятку, повернення з'єднання в пул у будь-якому разі.
+    """
+    conn = get_db_pool().getconn()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        put_db_connection(conn)
+
 @error_handler
 def init_db():
     """
@@ -154,7 +240,7 @@ def init_db():
     try:
         with conn.cursor() as cur:
             # Таблиця users для зберігання інформації про користувачів бота
-            cur.execute(pg_sql.SQL("""
+            cur.execute("""
                 CREATE TABLE IF NOT EXISTS users (
                     chat_id BIGINT PRIMARY KEY,
                     username TEXT,
@@ -169,9 +255,9 @@ def init_db():
                     joined_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
                     referrer_id BIGINT -- Додано для реферальної системи
                 );
-            """))
+            """)
             # Таблиця products для зберігання інформації про товари
-            cur.execute(pg_sql.SQL("""
+            cur.execute("""
                 CREATE TABLE IF NOT EXISTS products (
                     id SERIAL PRIMARY KEY,
                     seller_chat_id BIGINT NOT NULL REFERENCES users(chat_id) ON DELETE CASCADE,
@@ -179,8 +265,8 @@ def init_db():
                     product_name TEXT NOT NULL,
                     price TEXT NOT NULL,
                     description TEXT NOT NULL,
-                    photos TEXT, -- Зберігатиметься як JSON рядок з file_id фотографій
-                    geolocation TEXT, -- Зберігатиметься як JSON рядок {latitude: ..., longitude: ...}
+                    photos JSONB, -- Масив file_id фотографій
+                    geolocation JSONB, -- {latitude: ..., longitude: ...}
                     status TEXT DEFAULT 'pending', -- pending, approved, rejected, sold, expired
                     commission_rate REAL DEFAULT 0.10,
                     commission_amount REAL DEFAULT 0,
@@ -192,23 +278,23 @@ def init_db():
                     likes_count INTEGER DEFAULT 0, -- Додано для функціоналу "Обране" / лайків
                     republish_count INTEGER DEFAULT 0,
                     last_republish_date DATE,
-                    shipping_options TEXT, -- Додано для варіантів доставки (JSON array)
+                    shipping_options JSONB, -- Додано для варіантів доставки (JSON array)
                     hashtags TEXT, -- Додано для збереження згенерованих хештегів
                     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
                     updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
                 );
-            """))
+            """)
             # Таблиця favorites для зберігання обраних товарів користувачів
-            cur.execute(pg_sql.SQL("""
+            cur.execute("""
                 CREATE TABLE IF NOT EXISTS favorites (
                     id SERIAL PRIMARY KEY,
                     user_chat_id BIGINT NOT NULL REFERENCES users(chat_id) ON DELETE CASCADE,
                     product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
                     UNIQUE(user_chat_id, product_id) -- Забезпечує, що користувач може додати товар в обране лише один раз
                 );
-            """))
+            """)
             # Таблиця conversations для зберігання історії чату з AI
-            cur.execute(pg_sql.SQL("""
+            cur.execute("""
                 CREATE TABLE IF NOT EXISTS conversations (
                     id SERIAL PRIMARY KEY,
                     user_chat_id BIGINT NOT NULL REFERENCES users(chat_id) ON DELETE CASCADE,
@@ -217,9 +303,9 @@ def init_db():
                     sender_type TEXT, -- 'user' або 'ai' (для Gemini API це 'model')
                     timestamp TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
                 );
-            """))
+            """)
             # Таблиця commission_transactions для обліку комісій
-            cur.execute(pg_sql.SQL("""
+            cur.execute("""
                 CREATE TABLE IF NOT EXISTS commission_transactions (
                     id SERIAL PRIMARY KEY,
                     product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
@@ -230,9 +316,9 @@ def init_db():
                     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
                     paid_at TIMESTAMP WITH TIME ZONE
                 );
-            """))
+            """)
             # Таблиця statistics для збору різних даних про використання бота
-            cur.execute(pg_sql.SQL("""
+            cur.execute("""
                 CREATE TABLE IF NOT EXISTS statistics (
                     id SERIAL PRIMARY KEY,
                     action TEXT NOT NULL,
@@ -241,32 +327,76 @@ def init_db():
                     details TEXT,
                     timestamp TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
                 );
-            """))
+            """)
             
             # --- Міграція схеми для існуючих таблиць (додавання нових стовпців) ---
             migrations = {
                 'products': [
                     "ALTER TABLE products ADD COLUMN IF NOT EXISTS republish_count INTEGER DEFAULT 0;",
                     "ALTER TABLE products ADD COLUMN IF NOT EXISTS last_republish_date DATE;",
-                    "ALTER TABLE products ADD COLUMN IF NOT EXISTS shipping_options TEXT;",
+                    "ALTER TABLE products ADD COLUMN IF NOT EXISTS shipping_options JSONB;",
                     "ALTER TABLE products ADD COLUMN IF NOT EXISTS hashtags TEXT;",
-                    "ALTER TABLE products ADD COLUMN IF NOT EXISTS likes_count INTEGER DEFAULT 0;"
+                    "ALTER TABLE products ADD COLUMN IF NOT EXISTS likes_count INTEGER DEFAULT 0;",
+                    # Готовий рядок "a, b, c" зі способами доставки, щоб не декодувати JSON при кожному читанні
+                    "ALTER TABLE products ADD COLUMN IF NOT EXISTS shipping_options_text TEXT;",
+                    """UPDATE products SET shipping_options_text = (
+                           SELECT string_agg(value, ', ') FROM json_array_elements_text(shipping_options::json)
+                       ) WHERE shipping_options IS NOT NULL AND shipping_options_text IS NULL;""",
+                    # Старі TEXT-стовпці з JSON -> JSONB; psycopg2 повертає їх уже розібраними у list/dict
+                    """DO $$ BEGIN
+                           IF (SELECT data_type FROM information_schema.columns
+                               WHERE table_name = 'products' AND column_name = 'photos') = 'text' THEN
+                               ALTER TABLE products
+                                   ALTER COLUMN photos TYPE jsonb USING photos::jsonb,
+                                   ALTER COLUMN geolocation TYPE jsonb USING geolocation::jsonb,
+                                   ALTER COLUMN shipping_options TYPE jsonb USING shipping_options::jsonb;
+                           END IF;
+                       END $$;""",
+                    # Покриваючий частковий індекс для JOIN обраних товарів (send_favorites)
+                    """CREATE INDEX IF NOT EXISTS idx_products_approved_id ON products (id)
+                       INCLUDE (product_name, price, channel_message_id, likes_count) WHERE status = 'approved';""",
+                    # Черга модерації: індексуються лише товари 'pending', одразу в порядку показу
+                    """CREATE INDEX IF NOT EXISTS idx_products_pending_created_at ON products (created_at)
+                       WHERE status = 'pending';""",
+                    # "Мої товари": товари продавця від найновіших без сортування
+                    "CREATE INDEX IF NOT EXISTS idx_products_seller_created ON products (seller_chat_id, created_at DESC);",
+                    # Фільтр за способом доставки (shipping_options @> '["Нова Пошта"]') через індекс, а не повний перегляд
+                    "CREATE INDEX IF NOT EXISTS idx_products_shipping ON products USING GIN (shipping_options jsonb_path_ops);"
                 ],
                 'users': [
-                    "ALTER TABLE users ADD COLUMN IF NOT EXISTS referrer_id BIGINT;"
+                    "ALTER TABLE users ADD COLUMN IF NOT EXISTS referrer_id BIGINT;",
+                    # Частковий індекс для реферальної статистики: лише користувачі, що прийшли за запрошенням
+                    """CREATE INDEX IF NOT EXISTS idx_users_referrer_joined ON users (referrer_id, joined_at)
+                       WHERE referrer_id IS NOT NULL;"""
+                ],
+                'conversations': [
+                    # Контекст AI чату: останні N повідомлень користувача читаються прямо з індексу
+                    "CREATE INDEX IF NOT EXISTS idx_conversations_user_ts ON conversations (user_chat_id, timestamp DESC);"
                 ]
             }
-            for table, columns in migrations.items():
-                for column_sql in columns:
-                    try:
-                        cur.execute(pg_sql.SQL(column_sql))
-                        conn.commit()
-                        logger.info(f"Міграція для таблиці '{table}' успішно застосована: {column_sql}")
-                    except psycopg2.Error as e:
-                        # Якщо стовпець вже існує або інша помилка, просто логуємо
-                        logger.warning(f"Помилка міграції '{column_sql}': {e}")
-                        conn.rollback() # Відкат у разі помилки міграції
-            conn.commit() # Фінальний коміт після всіх операцій
+            # Усі міграції ідемпотентні, тож зазвичай вони йдуть одним запитом (DDL у PostgreSQL транзакційний).
+            # Таблиці й міграції фіксуються одним комітом наприкінці; точки збереження (SAVEPOINT) дозволяють
+            # відкотити лише невдалий пакет чи окрему міграцію, не зачіпаючи створені таблиці.
+            cur.execute("SAVEPOINT migrations;")
+            try:
+                cur.execute("\n".join(sql for columns in migrations.values() for sql in columns))
+                logger.info("Міграції схеми застосовано одним пакетом.")
+            except psycopg2.Error as e:
+                logger.warning(f"Пакетна міграція не вдалася, застосовуємо по одній: {e}")
+                cur.execute("ROLLBACK TO SAVEPOINT migrations;")
+                for table, columns in migrations.items():
+                    for column_sql in columns:
+                        cur.execute("SAVEPOINT migration;")
+                        try:
+                            cur.execute(column_sql)
+                            logger.info(f"Міграція для таблиці '{table}' успішно застосована: {column_sql}")
+                        except psycopg2.Error as e:
+                            # Якщо стовпець вже існує або інша помилка, просто логуємо
+                            logger.warning(f"Помилка міграції '{column_sql}': {e}")
+                            cur.execute("ROLLBACK TO SAVEPOINT migration;") # Відкат лише цієї міграції
+                        else:
+                            cur.execute("RELEASE SAVEPOINT migration;")
+            conn.commit() # Єдиний коміт після всіх операцій
             logger.info("Таблиці бази даних успішно ініціалізовано або оновлено.")
     except Exception as e:
         logger.critical(f"Критична помилка ініціалізації бази даних: {e}", exc_info=True)
@@ -274,12 +404,87 @@ def init_db():
         exit(1) # Завершуємо роботу, якщо БД не може бути ініціалізована
     finally:
         if conn:
-            conn.close()
+            put_db_connection(conn)
 
 # --- 7. Зберігання даних користувача для багатошагових процесів ---
 # Це словник, що тимчасово зберігає стан користувача під час багатошагових операцій (наприклад, додавання товару).
 # Дані зберігаються в пам'яті сервера і втрачаються при перезапуску.
-user_data = {}
+# Покинуті на півдорозі процеси видаляються через USER_DATA_TTL секунд, а кількість записів обмежена USER_DATA_MAXSIZE.
+USER_DATA_MAXSIZE = 10000
+USER_DATA_TTL = 3600
+
+class LockedTTLCache(TTLCache):
+    """TTLCache, доступ до якого серіалізується замком: стан змінюють кілька потоків обробки апдейтів."""
+    def __init__(self, maxsize, ttl):
+        super().__init__(maxsize, ttl)
+        self._lock = threading.RLock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            super().__delitem__(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return super().__contains__(key)
+
+# Апдейти обробляються в кількох потоках, тож зміни стану одного користувача серіалізуються замком
+# user_data[chat_id]['lock']: він живе в самому записі і зникає разом із ним, коли процес завершено або запис застарів.
+user_data = LockedTTLCache(maxsize=USER_DATA_MAXSIZE, ttl=USER_DATA_TTL)
+
+# Пул для фонових обчислень (генерація хештегів), щоб не блокувати потік обробки апдейту
+background_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='bg')
+
+# Пул обробки оновлень Telegram: вебхук лише ставить апдейт у чергу і одразу відповідає 200.
+# Обробники виконуються саме в цих потоках, тож слот звільняється лише після завершення обробки апдейту.
+# Кількість апдейтів у роботі обмежена; понад ліміт вебхук відповідає 503, і Telegram повторить запит пізніше.
+UPDATE_WORKERS = int(os.getenv('TELEGRAM_WORKER_THREADS', '16'))
+UPDATE_BACKLOG_LIMIT = 500
+update_executor = ThreadPoolExecutor(max_workers=UPDATE_WORKERS, thread_name_prefix='upd')
+update_slots = threading.BoundedSemaphore(UPDATE_BACKLOG_LIMIT)
+
+def submit_update(update):
+    """Передає апдейт у пул обробки. Повертає False, якщо черга заповнена."""
+    if not update_slots.acquire(blocking=False):
+        return False
+    future = update_executor.submit(bot.process_new_updates, [update])
+    future.add_done_callback(lambda _: update_slots.release())
+    return True
+
+# Відкладені оновлення лічильника лайків у каналі: channel_message_id -> остання клавіатура.
+# Telegram дозволяє редагувати одне повідомлення приблизно раз на секунду, тож натискання
+# протягом LIKE_EDIT_INTERVAL зливаються в одне редагування з актуальним лічильником.
+LIKE_EDIT_INTERVAL = 1.0
+pending_like_edits = {}
+pending_like_edits_lock = threading.Lock()
+
+def schedule_like_markup_edit(channel_message_id, markup):
+    """Запам'ятовує нову клавіатуру повідомлення в каналі і планує її відправку, якщо вона ще не запланована."""
+    with pending_like_edits_lock:
+        already_scheduled = channel_message_id in pending_like_edits
+        pending_like_edits[channel_message_id] = markup
+    if not already_scheduled:
+        timer = threading.Timer(LIKE_EDIT_INTERVAL, flush_like_markup_edit, args=(channel_message_id,))
+        timer.daemon = True
+        timer.start()
+
+def flush_like_markup_edit(channel_message_id):
+    """Відправляє в канал останню заплановану клавіатуру повідомлення."""
+    with pending_like_edits_lock:
+        markup = pending_like_edits.pop(channel_message_id, None)
+    if markup is None:
+        return
+    try:
+        bot.edit_message_reply_markup(CHANNEL_ID, channel_message_id, reply_markup=markup)
+    except Exception as e:
+        logger.warning(f"Не вдалося оновити лічильник лайків у повідомленні {channel_message_id}: {e}")
 
 # --- 8. Функції роботи з користувачами та загальні допоміжні функції ---
 @error_handler
@@ -306,124 +511,207 @@ def save_user(message_or_user, referrer_id=None):
         logger.warning("save_user: user або chat_id не визначено.")
         return
 
-    conn = get_db_connection()
-    if not conn: return
     try:
-        cur = conn.cursor()
-        # Перевіряємо, чи користувач вже існує
-        cur.execute(pg_sql.SQL("SELECT chat_id, referrer_id FROM users WHERE chat_id = %s;"), (chat_id,))
-        existing_user = cur.fetchone()
-
-        if existing_user:
-            # Оновлюємо існуючого користувача
-            cur.execute(pg_sql.SQL("""
-                UPDATE users SET username = %s, first_name = %s, last_name = %s, last_activity = CURRENT_TIMESTAMP
-                WHERE chat_id = %s;
-            """), (user.username, user.first_name, user.last_name, chat_id))
-            logger.info(f"Користувача {chat_id} оновлено.")
-        else:
-            # Додаємо нового користувача
-            cur.execute(pg_sql.SQL("""
+        with db_conn() as conn:
+            cur = conn.cursor()
+            # Один upsert замість SELECT + UPDATE/INSERT. referrer_id записується лише при вставці,
+            # тож реферер існуючого користувача не змінюється; (xmax = 0) істинне для нового рядка
+            cur.execute("""
                 INSERT INTO users (chat_id, username, first_name, last_name, referrer_id)
                 VALUES (%s, %s, %s, %s, %s)
-                ON CONFLICT (chat_id) DO NOTHING; -- Запобігає помилкам, якщо раптом race condition
-            """), (chat_id, user.username, user.first_name, user.last_name, referrer_id))
+                ON CONFLICT (chat_id) DO UPDATE SET
+                    username = EXCLUDED.username, first_name = EXCLUDED.first_name,
+                    last_name = EXCLUDED.last_name, last_activity = CURRENT_TIMESTAMP
+                RETURNING (xmax = 0) AS inserted;
+            """, (chat_id, user.username, user.first_name, user.last_name, referrer_id))
+            inserted = cur.fetchone()['inserted']
+        if inserted:
             logger.info(f"Нового користувача {chat_id} додано. Реферер: {referrer_id}")
-        conn.commit()
+        else:
+            logger.info(f"Користувача {chat_id} оновлено.")
     except Exception as e:
         logger.error(f"Помилка при збереженні користувача {chat_id}: {e}", exc_info=True)
-        conn.rollback() # Відкат змін у випадку помилки
-    finally:
-        if conn:
-            conn.close()
+
+# Кеш статусу блокування: chat_id -> (is_blocked, час перевірки)
+BLOCKED_CACHE_TTL = 60
+blocked_cache = {}
 
 @error_handler
 def is_user_blocked(chat_id):
-    """Перевіряє, чи заблокований користувач у базі даних."""
-    conn = get_db_connection()
-    if not conn: return True # У випадку помилки з'єднання, вважаємо заблокованим для безпеки
+    """
+    Перевіряє, чи заблокований користувач у базі даних.
+    Відповідь кешується на BLOCKED_CACHE_TTL секунд, щоб не звертатися до БД на кожне оновлення.
+    """
+    cached = blocked_cache.get(chat_id)
+    if cached is not None and time.monotonic() - cached[1] < BLOCKED_CACHE_TTL:
+        return cached[0]
     try:
-        cur = conn.cursor()
-        cur.execute(pg_sql.SQL("SELECT is_blocked FROM users WHERE chat_id = %s;"), (chat_id,))
-        result = cur.fetchone()
-        return result and result['is_blocked'] # Повертає True, якщо користувач заблокований
+        with db_conn() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT is_blocked FROM users WHERE chat_id = %s;", (chat_id,))
+            result = cur.fetchone()
+        blocked = bool(result and result['is_blocked']) # True, якщо користувач заблокований
+        blocked_cache[chat_id] = (blocked, time.monotonic())
+        return blocked
     except Exception as e:
+        # У випадку помилки БД (зокрема з'єднання) вважаємо заблокованим для безпеки
         logger.error(f"Помилка перевірки блокування для {chat_id}: {e}", exc_info=True)
         return True
-    finally:
-        if conn:
-            conn.close()
 
 @error_handler
 def set_user_block_status(admin_id, chat_id, status):
     """Встановлює статус блокування (True/False) для користувача."""
-    conn = get_db_connection()
-    if not conn: return False
     try:
-        cur = conn.cursor()
-        if status: # Блокування користувача
-            cur.execute(pg_sql.SQL("""
-                UPDATE users SET is_blocked = TRUE, blocked_by = %s, blocked_at = CURRENT_TIMESTAMP
-                WHERE chat_id = %s;
-            """), (admin_id, chat_id))
-        else: # Розблокування користувача
-            cur.execute(pg_sql.SQL("""
-                UPDATE users SET is_blocked = FALSE, blocked_by = NULL, blocked_at = NULL
-                WHERE chat_id = %s;
-            """), (chat_id,))
-        conn.commit()
+        with db_conn() as conn:
+            cur = conn.cursor()
+            if status: # Блокування користувача
+                cur.execute("""
+                    UPDATE users SET is_blocked = TRUE, blocked_by = %s, blocked_at = CURRENT_TIMESTAMP
+                    WHERE chat_id = %s;
+                """, (admin_id, chat_id))
+            else: # Розблокування користувача
+                cur.execute("""
+                    UPDATE users SET is_blocked = FALSE, blocked_by = NULL, blocked_at = NULL
+                    WHERE chat_id = %s;
+                """, (chat_id,))
+        blocked_cache[chat_id] = (bool(status), time.monotonic()) # Новий статус діє одразу, без очікування TTL
         return True
     except Exception as e:
         logger.error(f"Помилка при встановленні статусу блокування для користувача {chat_id}: {e}", exc_info=True)
-        conn.rollback()
         return False
-    finally:
-        if conn:
-            conn.close()
+
+# Регулярний вираз і стоп-слова для хештегів створюються один раз при завантаженні модуля
+HASHTAG_WORD_RE = re.compile(r'\b\w+\b')
+HASHTAG_STOPWORDS = frozenset([
+    'я', 'ми', 'ти', 'ви', 'він', 'вона', 'воно', 'вони', 'це', 'що',
+    'як', 'де', 'коли', 'а', 'і', 'та', 'або', 'чи', 'для', 'з', 'на',
+    'у', 'в', 'до', 'від', 'по', 'за', 'при', 'про', 'між', 'під', 'над',
+    'без', 'через', 'дуже', 'цей', 'той', 'мій', 'твій', 'наш', 'ваш',
+    'продам', 'продамся', 'продати', 'продаю', 'продаж', 'купити', 'куплю',
+    'бу', 'новий', 'стан', 'модель', 'см', 'кг', 'грн', 'uah', 'usd', 'eur', 
+    'один', 'два', 'три', 'чотири', 'пять', 'шість', 'сім', 'вісім', 'девять', 'десять'
+])
 
 @error_handler
 def generate_hashtags(description, num_hashtags=5):
     """
     Генерує хештеги з опису товару.
     Видаляє стоп-слова та повторення, обмежує кількість хештегів.
+    Слова перебираються один раз у порядку тексту; перебір зупиняється, щойно набрано N унікальних.
     """
-    words = re.findall(r'\b\w+\b', description.lower())
-    stopwords = set([
-        'я', 'ми', 'ти', 'ви', 'він', 'вона', 'воно', 'вони', 'це', 'що',
-        'як', 'де', 'коли', 'а', 'і', 'та', 'або', 'чи', 'для', 'з', 'на',
-        'у', 'в', 'до', 'від', 'по', 'за', 'при', 'про', 'між', 'під', 'над',
-        'без', 'через', 'дуже', 'цей', 'той', 'мій', 'твій', 'наш', 'ваш',
-        'продам', 'продамся', 'продати', 'продаю', 'продаж', 'купити', 'куплю',
-        'бу', 'новий', 'стан', 'модель', 'см', 'кг', 'грн', 'uah', 'usd', 'eur', 
-        'один', 'два', 'три', 'чотири', 'пять', 'шість', 'сім', 'вісім', 'девять', 'десять'
-    ])
-    filtered_words = [word for word in words if len(word) > 2 and word not in stopwords]
-    unique_words = list(dict.fromkeys(filtered_words)) # Зберігаємо порядок, але тільки унікальні
-    hashtags = ['#' + word for word in unique_words[:num_hashtags]] # Беремо перші N унікальних слів
-    return " ".join(hashtags) if hashtags else ""
+    hashtags = []
+    seen = set()
+    for word in HASHTAG_WORD_RE.findall(description.lower()):
+        if len(word) > 2 and word not in HASHTAG_STOPWORDS and word not in seen:
+            seen.add(word)
+            hashtags.append('#' + word)
+            if len(hashtags) == num_hashtags:
+                break
+    return " ".join(hashtags)
+
+# Події статистики пишуться у БД фоновим потоком пачками: до STATS_BATCH_SIZE подій
+# або раз на STATS_FLUSH_INTERVAL секунд одним INSERT, а не окремим запитом на кожну дію.
+STATS_QUEUE_MAXSIZE = 10000
+STATS_BATCH_SIZE = 500
+STATS_FLUSH_INTERVAL = 1.0
+stats_queue = queue.Queue(maxsize=STATS_QUEUE_MAXSIZE)
 
 @error_handler
 def log_statistics(action, user_id=None, product_id=None, details=None):
     """
     Логує дії користувачів та адміністраторів для збору статистики.
+    Лише ставить подію в чергу, тому не затримує обробку апдейту.
     """
-    conn = get_db_connection()
-    if not conn: return
     try:
-        cur = conn.cursor()
-        cur.execute(pg_sql.SQL('''
-            INSERT INTO statistics (action, user_id, product_id, details)
-            VALUES (%s, %s, %s, %s)
-        '''), (action, user_id, product_id, details))
-        conn.commit()
+        stats_queue.put_nowait((action, user_id, product_id, details, datetime.now(timezone.utc)))
+    except queue.Full:
+        logger.warning(f"Черга статистики переповнена, подію '{action}' пропущено.")
+
+def write_statistics_batch(batch):
+    """Записує пачку подій одним INSERT ... VALUES."""
+    try:
+        with db_conn() as conn:
+            extras.execute_values(conn.cursor(), '''
+                INSERT INTO statistics (action, user_id, product_id, details, timestamp) VALUES %s
+            ''', batch, page_size=STATS_BATCH_SIZE)
     except Exception as e:
-        logger.error(f"Помилка логування статистики: {e}", exc_info=True)
-        conn.rollback()
-    finally:
-        if conn:
-            conn.close()
+        logger.error(f"Помилка логування статистики ({len(batch)} подій): {e}", exc_info=True)
+
+def statistics_writer():
+    """Фоновий потік: чекає першу подію, добирає решту до ліміту пачки або інтервалу і записує."""
+    while True:
+        batch = [stats_queue.get()]
+        deadline = time.monotonic() + STATS_FLUSH_INTERVAL
+        while len(batch) < STATS_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(stats_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        write_statistics_batch(batch)
+
+def flush_pending_statistics():
+    """При завершенні процесу дописує події, що ще лишилися в черзі."""
+    batch = []
+    while True:
+        try:
+            batch.append(stats_queue.get_nowait())
+        except queue.Empty:
+            break
+    if batch:
+        write_statistics_batch(batch)
+
+threading.Thread(target=statistics_writer, name='stats-writer', daemon=True).start()
+atexit.register(flush_pending_statistics)
+
+# Остання активність користувачів: chat_id -> час. Замість UPDATE на кожне повідомлення
+# накопичується в пам'яті і раз на ACTIVITY_FLUSH_INTERVAL секунд пишеться одним запитом.
+ACTIVITY_FLUSH_INTERVAL = 5.0
+pending_activity = {}
+pending_activity_lock = threading.Lock()
+
+def touch_user_activity(chat_id):
+    """Запам'ятовує час останньої активності користувача для наступного пакетного запису."""
+    with pending_activity_lock:
+        pending_activity[chat_id] = datetime.now(timezone.utc)
+
+def flush_user_activity():
+    """Записує накопичені часи активності одним UPDATE ... FROM (VALUES ...)."""
+    global pending_activity
+    with pending_activity_lock:
+        batch, pending_activity = pending_activity, {}
+    if not batch:
+        return
+    try:
+        with db_conn() as conn:
+            extras.execute_values(conn.cursor(), """
+                UPDATE users SET last_activity = v.ts
+                FROM (VALUES %s) AS v(chat_id, ts)
+                WHERE users.chat_id = v.chat_id
+            """, list(batch.items()), page_size=1000)
+    except Exception as e:
+        logger.error(f"Помилка оновлення останньої активності ({len(batch)} користувачів): {e}", exc_info=True)
+
+def activity_writer():
+    """Фоновий потік, що періодично скидає накопичену активність у БД."""
+    while True:
+        time.sleep(ACTIVITY_FLUSH_INTERVAL)
+        flush_user_activity()
+
+threading.Thread(target=activity_writer, name='activity-writer', daemon=True).start()
+atexit.register(flush_user_activity)
 
 # --- 9. Gemini AI інтеграція ---
+# Спільна сесія до Gemini: keep-alive з'єднання перевикористовується між запитами,
+# тож TCP+TLS-рукостискання відбувається раз на процес, а не на кожен промпт. Повтори — як і для Telegram.
+GEMINI_TIMEOUT = (5, 30) # (з'єднання, читання відповіді), секунди
+gemini_session = make_http_session()
+# Ключ API передається заголовком сесії, а не в URL: рядок запиту не збирається щоразу і ключ не потрапляє в логи помилок
+if GEMINI_API_KEY:
+    gemini_session.headers["x-goog-api-key"] = GEMINI_API_KEY
+
 @error_handler
 def get_gemini_response(prompt, conversation_history=None):
     """
@@ -434,10 +722,6 @@ def get_gemini_response(prompt, conversation_history=None):
         logger.warning("Gemini API ключ не налаштований. Використовується заглушка.")
         return generate_elon_style_response(prompt)
 
-    headers = {
-        "Content-Type": "application/json"
-    }
-
     # Системний промпт для налаштування стилю відповіді AI
     system_prompt = """Ти - AI помічник для Telegram бота продажу товарів. 
     Відповідай в стилі Ілона Маска: прямолінійно, з гумором, іноді саркастично, 
@@ -462,9 +746,7 @@ def get_gemini_response(prompt, conversation_history=None):
     }
 
     try:
-        api_url = f"{GEMINI_API_URL}?key={GEMINI_API_KEY}"
-
-        response = requests.post(api_url, headers=headers, json=payload, timeout=30)
+        response = gemini_session.post(GEMINI_API_URL, json=payload, timeout=GEMINI_TIMEOUT)
         response.raise_for_status() # Викличе HTTPError для 4xx/5xx відповідей (помилки HTTP)
         
         data = response.json()
@@ -522,21 +804,14 @@ def save_conversation(chat_id, message_text, sender_type, product_id=None):
     Зберігає повідомлення (від користувача або AI) в історії розмов у БД
     для підтримки контексту AI.
     """
-    conn = get_db_connection()
-    if not conn: return
     try:
-        cur = conn.cursor()
-        cur.execute(pg_sql.SQL('''
-            INSERT INTO conversations (user_chat_id, product_id, message_text, sender_type)
-            VALUES (%s, %s, %s, %s)
-        '''), (chat_id, product_id, message_text, sender_type))
-        conn.commit()
+        with db_conn() as conn:
+            conn.cursor().execute('''
+                INSERT INTO conversations (user_chat_id, product_id, message_text, sender_type)
+                VALUES (%s, %s, %s, %s)
+            ''', (chat_id, product_id, message_text, sender_type))
     except Exception as e:
         logger.error(f"Помилка збереження розмови: {e}", exc_info=True)
-        conn.rollback()
-    finally:
-        if conn:
-            conn.close()
 
 @error_handler
 def get_conversation_history(chat_id, limit=5):
@@ -544,28 +819,23 @@ def get_conversation_history(chat_id, limit=5):
     Отримує історію розмов для конкретного користувача з БД.
     Використовується для надання контексту AI.
     """
-    conn = get_db_connection()
-    if not conn: return []
     try:
-        cur = conn.cursor()
-        cur.execute(pg_sql.SQL('''
-            SELECT message_text, sender_type FROM conversations 
-            WHERE user_chat_id = %s 
-            ORDER BY timestamp DESC LIMIT %s
-        '''), (chat_id, limit))
-        results = cur.fetchall()
-        
-        # Повертаємо історію у зворотному порядку, щоб найстаріші повідомлення були першими
-        history = [{"message_text": row['message_text'], "sender_type": row['sender_type']} 
-                   for row in reversed(results)]
-        
-        return history
+        with db_conn() as conn:
+            cur = conn.cursor()
+            # Останні N повідомлень вибираються підзапитом і повертаються вже від найстаріших до найновіших
+            cur.execute('''
+                SELECT message_text, sender_type FROM (
+                    SELECT message_text, sender_type, timestamp FROM conversations 
+                    WHERE user_chat_id = %s 
+                    ORDER BY timestamp DESC LIMIT %s
+                ) recent
+                ORDER BY timestamp ASC
+            ''', (chat_id, limit))
+            # DictRow вже підтримує доступ за ключем, тож рядки повертаються без перетворення
+            return cur.fetchall()
     except Exception as e:
         logger.error(f"Помилка отримання історії розмов: {e}", exc_info=True)
         return []
-    finally:
-        if conn:
-            conn.close()
 
 # --- 10. Клавіатури ---
 # Головна клавіатура бота з кнопками швидкого доступу.
@@ -625,6 +895,18 @@ def send_welcome(message):
     # Надсилаємо вітальне повідомлення з головним меню
     bot.send_message(chat_id, welcome_text, reply_markup=main_menu_markup, parse_mode='Markdown')
 
+# Клавіатура адмін-панелі незмінна, тому будується один раз при завантаженні модуля
+ADMIN_PANEL_MARKUP = types.InlineKeyboardMarkup(row_width=2)
+ADMIN_PANEL_MARKUP.add(
+    types.InlineKeyboardButton("📊 Статистика", callback_data="admin_stats"),
+    types.InlineKeyboardButton("⏳ На модерації", callback_data="admin_pending"),
+    types.InlineKeyboardButton("👥 Користувачі", callback_data="admin_users"),
+    types.InlineKeyboardButton("🚫 Блокування", callback_data="admin_block"),
+    types.InlineKeyboardButton("💰 Комісії", callback_data="admin_commissions"),
+    types.InlineKeyboardButton("🤖 AI Статистика", callback_data="admin_ai_stats"),
+    types.InlineKeyboardButton("🏆 Реферали", callback_data="admin_referrals") # Додано
+)
+
 @bot.message_handler(commands=['admin'])
 @error_handler
 def admin_panel(message):
@@ -636,18 +918,7 @@ def admin_panel(message):
         bot.send_message(message.chat.id, "❌ У вас немає прав доступу.")
         return
 
-    # Створюємо інлайн-клавіатуру для адмін-панелі
-    markup = types.InlineKeyboardMarkup(row_width=2)
-    markup.add(
-        types.InlineKeyboardButton("📊 Статистика", callback_data="admin_stats"),
-        types.InlineKeyboardButton("⏳ На модерації", callback_data="admin_pending"),
-        types.InlineKeyboardButton("👥 Користувачі", callback_data="admin_users"),
-        types.InlineKeyboardButton("🚫 Блокування", callback_data="admin_block"),
-        types.InlineKeyboardButton("💰 Комісії", callback_data="admin_commissions"),
-        types.InlineKeyboardButton("🤖 AI Статистика", callback_data="admin_ai_stats"),
-        types.InlineKeyboardButton("🏆 Реферали", callback_data="admin_referrals") # Додано
-    )
-    bot.send_message(message.chat.id, "🔧 *Адмін-панель*", reply_markup=markup, parse_mode='Markdown')
+    bot.send_message(message.chat.id, "🔧 *Адмін-панель*", reply_markup=ADMIN_PANEL_MARKUP, parse_mode='Markdown')
 
 
 # --- 12. Потік додавання товару ---
@@ -663,6 +934,27 @@ ADD_PRODUCT_STEPS = {
     5: {'name': 'waiting_shipping', 'prompt': "🚚 *Крок 5/6: Доставка*\n\nОберіть доступні способи доставки (можна обрати декілька):", 'next_step': 6, 'prev_step': 4}, # Новий крок
     6: {'name': 'waiting_description', 'prompt': "✍️ *Крок 6/6: Опис*\n\nНапишіть детальний опис товару:", 'next_step': 'confirm', 'prev_step': 5}
 }
+MAX_PRODUCT_PHOTOS = 5 # Максимальна кількість фото в оголошенні
+
+SHIPPING_OPTIONS = ("Наложка Нова Пошта", "Наложка Укрпошта", "Особиста зустріч")
+
+@lru_cache(maxsize=2 ** len(SHIPPING_OPTIONS))
+def shipping_markup(selected_mask):
+    """
+    Інлайн-клавіатура вибору доставки для комбінації обраних опцій
+    (біт i відповідає SHIPPING_OPTIONS[i]). Кожна з 8 комбінацій будується один раз.
+    """
+    inline_markup = types.InlineKeyboardMarkup(row_width=2)
+    inline_markup.add(*(
+        types.InlineKeyboardButton(f"{'✅ ' if selected_mask & (1 << i) else ''}{opt}", callback_data=f"shipping_{opt}")
+        for i, opt in enumerate(SHIPPING_OPTIONS)
+    ))
+    inline_markup.add(types.InlineKeyboardButton("Далі ➡️", callback_data="shipping_next"))
+    return inline_markup
+
+def shipping_markup_for(selected):
+    """Клавіатура доставки для списку обраних опцій."""
+    return shipping_markup(sum(1 << i for i, opt in enumerate(SHIPPING_OPTIONS) if opt in selected))
 
 @error_handler
 def start_add_product_flow(message):
@@ -670,9 +962,11 @@ def start_add_product_flow(message):
     chat_id = message.chat.id
     user_data[chat_id] = {
         'flow': 'add_product', # Додано для розрізнення потоків
+        'lock': threading.Lock(), # Серіалізує паралельні зміни стану цього процесу
         'step_number': 1, 
         'data': {
-            'photos': [], 
+            'photos': [None] * MAX_PRODUCT_PHOTOS, # Фіксовані слоти, заповнені до photo_count
+            'photo_count': 0,
             'geolocation': None,
             'shipping_options': [], # Додано для доставки
             'product_name': '',
@@ -705,18 +999,7 @@ def send_product_step_message(chat_id):
         markup.add(types.KeyboardButton(step_config['skip_button']))
     elif step_config['name'] == 'waiting_shipping':
         # Для кроку доставки використовуємо інлайн-клавіатуру
-        inline_markup = types.InlineKeyboardMarkup(row_width=2)
-        shipping_options_list = ["Наложка Нова Пошта", "Наложка Укрпошта", "Особиста зустріч"] # Додано варіанти
-        selected_options = user_data[chat_id]['data'].get('shipping_options', [])
-
-        buttons = []
-        for opt in shipping_options_list:
-            emoji = '✅ ' if opt in selected_options else ''
-            buttons.append(types.InlineKeyboardButton(f"{emoji}{opt}", callback_data=f"shipping_{opt}"))
-        
-        inline_markup.add(*buttons)
-        inline_markup.add(types.InlineKeyboardButton("Далі ➡️", callback_data="shipping_next"))
-        
+        inline_markup = shipping_markup_for(user_data[chat_id]['data'].get('shipping_options', []))
         bot.send_message(chat_id, step_config['prompt'], parse_mode='Markdown', reply_markup=inline_markup)
         return # Важливо вийти, оскільки ми вже надіслали інлайн-клавіатуру
     
@@ -798,7 +1081,8 @@ def process_product_step(message):
     elif step_config['name'] == 'waiting_description':
         if user_text and 10 <= len(user_text) <= 1000:
             user_data[chat_id]['data']['description'] = user_text
-            user_data[chat_id]['data']['hashtags'] = generate_hashtags(user_text) # Генеруємо хештеги
+            # Хештеги генеруються у фоні, поки confirm_and_send_for_moderation звертається до Telegram
+            user_data[chat_id]['data']['hashtags_future'] = background_executor.submit(generate_hashtags, user_text)
             confirm_and_send_for_moderation(chat_id) # Останній крок - відправка на модерацію
         else:
             bot.send_message(chat_id, "Опис занадто короткий або занадто довгий (10-1000 символів). Напишіть детальніше:")
@@ -820,11 +1104,13 @@ def process_product_photo(message):
     """Обробляє завантаження фотографій товару під час відповідного кроку."""
     chat_id = message.chat.id
     if chat_id in user_data and user_data[chat_id].get('step') == 'waiting_photos':
-        if len(user_data[chat_id]['data']['photos']) < 5:
-            file_id = message.photo[-1].file_id # Беремо фото найвищої якості
-            user_data[chat_id]['data']['photos'].append(file_id)
-            photos_count = len(user_data[chat_id]['data']['photos'])
-            bot.send_message(chat_id, f"✅ Фото {photos_count}/5 додано. Надішліть ще або натисніть 'Далі'")
+        data = user_data[chat_id]['data']
+        photos_count = data['photo_count']
+        if photos_count < MAX_PRODUCT_PHOTOS:
+            data['photos'][photos_count] = message.photo[-1].file_id # Беремо фото найвищої якості
+            photos_count += 1
+            data['photo_count'] = photos_count
+            bot.send_message(chat_id, f"✅ Фото {photos_count}/{MAX_PRODUCT_PHOTOS} додано. Надішліть ще або натисніть 'Далі'")
         else:
             bot.send_message(chat_id, "Максимум 5 фото. Натисніть 'Далі' для продовження.")
     else:
@@ -854,36 +1140,34 @@ def confirm_and_send_for_moderation(chat_id):
     сповіщає користувача та адміністратора про новий товар на модерації.
     """
     data = user_data[chat_id]['data']
+    photos = data['photos'][:data['photo_count']]
     
-    conn = get_db_connection()
-    if not conn:
-        bot.send_message(chat_id, "Помилка підключення до бази даних. Спробуйте пізніше.")
-        return
-    cur = conn.cursor()
     product_id = None
     try:
-        user_info = bot.get_chat(chat_id)
-        seller_username = user_info.username if user_info.username else None
-
-        cur.execute(pg_sql.SQL('''
-            INSERT INTO products 
-            (seller_chat_id, seller_username, product_name, price, description, photos, geolocation, shipping_options, hashtags, status)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, 'pending')
-            RETURNING id;
-        '''), (
-            chat_id,
-            seller_username,
-            data['product_name'],
-            data['price'],
-            data['description'],
-            json.dumps(data['photos']) if data['photos'] else None, # Зберігаємо список фото як JSON рядок
-            json.dumps(data['geolocation']) if data['geolocation'] else None, # Зберігаємо геолокацію як JSON рядок
-            json.dumps(data['shipping_options']) if data['shipping_options'] else None, # Зберігаємо опції доставки
-            data['hashtags'], # Зберігаємо хештеги
-        ))
-        
-        product_id = cur.fetchone()[0] # Отримуємо ID щойно вставленого товару
-        conn.commit()
+        if 'hashtags_future' in data:
+            data['hashtags'] = data.pop('hashtags_future').result()
+
+        with db_conn() as conn:
+            cur = conn.cursor()
+            # Ім'я продавця береться з таблиці users (її оновлює save_user), без окремого запиту bot.get_chat
+            cur.execute('''
+                INSERT INTO products 
+                (seller_chat_id, seller_username, product_name, price, description, photos, geolocation, shipping_options, shipping_options_text, hashtags, status)
+                VALUES (%s, (SELECT username FROM users WHERE chat_id = %s), %s, %s, %s, %s, %s, %s, %s, %s, 'pending')
+                RETURNING id;
+            ''', (
+                chat_id,
+                chat_id,
+                data['product_name'],
+                data['price'],
+                data['description'],
+                extras.Json(photos) if photos else None, # Список file_id фото -> JSONB
+                extras.Json(data['geolocation']) if data['geolocation'] else None, # Геолокація -> JSONB
+                extras.Json(data['shipping_options']) if data['shipping_options'] else None, # Опції доставки -> JSONB
+                ", ".join(data['shipping_options']) if data['shipping_options'] else None, # Готовий текст доставки для модерації
+                data['hashtags'], # Зберігаємо хештеги
+            ))
+            product_id = cur.fetchone()[0] # Отримуємо ID щойно вставленого товару
         
         # Сповіщення користувача про успішне відправлення на модерацію
         bot.send_message(chat_id, 
@@ -891,8 +1175,8 @@ def confirm_and_send_for_moderation(chat_id):
             f"Ви отримаєте сповіщення після перевірки.",
             reply_markup=main_menu_markup)
         
-        # Сповіщення адміністратора про новий товар
-        send_product_for_admin_review(product_id) # Змінено: передаємо тільки product_id
+        # Сповіщення адміністратора про новий товар надсилається у фоновому пулі, не затримуючи обробку апдейту продавця
+        background_executor.submit(send_product_for_admin_review, product_id)
         
         # Очищуємо тимчасові дані користувача після завершення процесу
         del user_data[chat_id]
@@ -901,11 +1185,21 @@ def confirm_and_send_for_moderation(chat_id):
         
     except Exception as e:
         logger.error(f"Помилка збереження товару: {e}", exc_info=True)
-        conn.rollback()
         bot.send_message(chat_id, "Помилка збереження товару. Спробуйте пізніше.")
-    finally:
-        if conn:
-            conn.close()
+
+# Шаблон повідомлення для модерації; заповнюється через format_map
+REVIEW_TEMPLATE = (
+    "📦 *Новий товар на модерацію*\n\n"
+    "🆔 ID: {product_id}\n"
+    "📝 Назва: {product_name}\n"
+    "💰 Ціна: {price}\n"
+    "📄 Опис: {description}...\n" # Опис обрізається до 500 символів
+    "📸 Фото: {photos_count} шт.\n"
+    "📍 Геолокація: {geo_yn}\n"
+    "🚚 Доставка: {shipping_text}\n"
+    "🏷️ Хештеги: {hashtags}\n\n"
+    "👤 Продавець: [{seller_display}](tg://user?id={seller_chat_id})"
+)
 
 @error_handler
 def send_product_for_admin_review(product_id):
@@ -918,10 +1212,10 @@ def send_product_for_admin_review(product_id):
 
     try:
         cur = conn.cursor()
-        cur.execute(pg_sql.SQL("""
-            SELECT seller_chat_id, seller_username, product_name, price, description, photos, geolocation, shipping_options, hashtags
+        cur.execute("""
+            SELECT seller_chat_id, seller_username, product_name, price, description, photos, geolocation, shipping_options_text, hashtags
             FROM products WHERE id = %s;
-        """), (product_id,))
+        """, (product_id,))
         data = cur.fetchone()
 
         if not data:
@@ -929,24 +1223,20 @@ def send_product_for_admin_review(product_id):
             return
 
         seller_chat_id = data['seller_chat_id']
-        seller_username = data['seller_username'] if data['seller_username'] else "Не вказано"
-        photos = json.loads(data['photos']) if data['photos'] else []
-        geolocation = json.loads(data['geolocation']) if data['geolocation'] else None
-        shipping_options_text = ", ".join(json.loads(data['shipping_options'])) if data['shipping_options'] else "Не вказано"
-        hashtags = data['hashtags'] if data['hashtags'] else ""
-
-        review_text = (
-            f"📦 *Новий товар на модерацію*\n\n"
-            f"🆔 ID: {product_id}\n"
-            f"📝 Назва: {data['product_name']}\n"
-            f"💰 Ціна: {data['price']}\n"
-            f"📄 Опис: {data['description'][:500]}...\n" # Обрізаємо опис, якщо він занадто довгий
-            f"📸 Фото: {len(photos)} шт.\n"
-            f"📍 Геолокація: {'Так' if geolocation else 'Ні'}\n"
-            f"🚚 Доставка: {shipping_options_text}\n" # Додано інформацію про доставку
-            f"🏷️ Хештеги: {hashtags}\n\n"
-            f"👤 Продавець: [{'@' + seller_username if seller_username != 'Не вказано' else 'Користувач'}](tg://user?id={seller_chat_id})"
-        )
+        photos = data['photos'] or []
+
+        review_text = REVIEW_TEMPLATE.format_map({
+            'product_id': product_id,
+            'product_name': data['product_name'],
+            'price': data['price'],
+            'description': data['description'][:500],
+            'photos_count': len(photos),
+            'geo_yn': 'Так' if data['geolocation'] else 'Ні',
+            'shipping_text': data['shipping_options_text'] or "Не вказано",
+            'hashtags': data['hashtags'] or "",
+            'seller_display': '@' + data['seller_username'] if data['seller_username'] else 'Користувач',
+            'seller_chat_id': seller_chat_id,
+        })
         
         markup = types.InlineKeyboardMarkup()
         markup.add(
@@ -961,7 +1251,11 @@ def send_product_for_admin_review(product_id):
         
         try:
             admin_msg = None
-            if photos:
+            if len(photos) == 1:
+                # Одне фото може мати і підпис, і кнопки - один виклик API замість двох
+                admin_msg = bot.send_photo(ADMIN_CHAT_ID, photos[0], caption=review_text,
+                                           parse_mode='Markdown', reply_markup=markup)
+            elif photos:
                 media = [types.InputMediaPhoto(photo_id, caption=review_text if i == 0 else None, parse_mode='Markdown') 
                          for i, photo_id in enumerate(photos)]
                 
@@ -984,7 +1278,7 @@ def send_product_for_admin_review(product_id):
             
             if admin_msg:
                 # Зберігаємо message_id адмінського повідомлення
-                cur.execute(pg_sql.SQL("UPDATE products SET admin_message_id = %s WHERE id = %s;"),
+                cur.execute("UPDATE products SET admin_message_id = %s WHERE id = %s;",
                                (admin_msg.message_id, product_id))
                 conn.commit()
 
@@ -993,7 +1287,7 @@ def send_product_for_admin_review(product_id):
             conn.rollback()
     finally:
         if conn:
-            conn.close()
+            put_db_connection(conn)
 
 # --- 13. Обробники текстових повідомлень та кнопок меню ---
 @bot.message_handler(func=lambda message: True, content_types=['text', 'photo', 'location'])
@@ -1011,18 +1305,8 @@ def handle_messages(message):
         bot.send_message(chat_id, "❌ Ваш акаунт заблоковано.")
         return
     
-    # Оновлюємо останню активність користувача
-    conn = get_db_connection()
-    if conn:
-        try:
-            with conn.cursor() as cur:
-                cur.execute(pg_sql.SQL("UPDATE users SET last_activity = CURRENT_TIMESTAMP WHERE chat_id = %s"), (chat_id,))
-            conn.commit()
-        except Exception as e:
-            logger.error(f"Помилка оновлення останньої активності для користувача {chat_id}: {e}")
-            conn.rollback()
-        finally:
-            conn.close()
+    # Оновлюємо останню активність користувача (запис у БД — пакетом у фоні)
+    touch_user_activity(chat_id)
 
     # Пріоритетна обробка: якщо користувач знаходиться в багатошаговому процесі
     if chat_id in user_data and user_data[chat_id].get('flow'):
@@ -1042,21 +1326,10 @@ def handle_messages(message):
             process_new_hashtags_mod(message)
         return # Важливо, щоб не переходити до інших обробників
 
-    # Обробка кнопок головного меню за текстом
-    if user_text == "📦 Додати товар":
-        start_add_product_flow(message)
-    elif user_text == "📋 Мої товари":
-        send_my_products(message)
-    elif user_text == "⭐ Обрані": # Додано обробник для "Обрані"
-        send_favorites(message)
-    elif user_text == "❓ Допомога":
-        send_help_message(message)
-    elif user_text == "📺 Наш канал":
-        send_channel_link(message)
-    elif user_text == "🤖 AI Помічник":
-        bot.send_message(chat_id, "Привіт! Я ваш AI помічник. Задайте мені будь-яке питання про товари, продажі, або просто поспілкуйтесь!\n\n(Напишіть '❌ Скасувати' для виходу з режиму AI чату.)", reply_markup=types.ReplyKeyboardRemove())
-        # Реєструємо наступний обробник для AI чату
-        bot.register_next_step_handler(message, handle_ai_chat)
+    # Обробка кнопок головного меню за текстом (MAIN_MENU_DISPATCH)
+    handler = MAIN_MENU_DISPATCH.get(user_text)
+    if handler:
+        handler(message)
     elif message.content_type == 'text': 
         # Якщо це звичайне текстове повідомлення і воно не є командою/кнопкою меню,
         # і користувач не знаходиться в іншому потоці, передаємо його AI.
@@ -1068,6 +1341,13 @@ def handle_messages(message):
     else:
         bot.send_message(chat_id, "Я не зрозумів ваш запит. Спробуйте використати кнопки меню.")
 
+@error_handler
+def start_ai_chat(message):
+    """Вмикає режим AI чату: наступні повідомлення користувача йдуть до handle_ai_chat."""
+    bot.send_message(message.chat.id, "Привіт! Я ваш AI помічник. Задайте мені будь-яке питання про товари, продажі, або просто поспілкуйтесь!\n\n(Напишіть '❌ Скасувати' для виходу з режиму AI чату.)", reply_markup=types.ReplyKeyboardRemove())
+    # Реєструємо наступний обробник для AI чату
+    bot.register_next_step_handler(message, handle_ai_chat)
+
 @error_handler
 def handle_ai_chat(message):
     """
@@ -1215,31 +1495,24 @@ def callback_inline(call):
             go_to_next_step(chat_id)
         else:
             option = data.replace("shipping_", "")
-            current_options = user_data[chat_id]['data'].get('shipping_options', [])
-            if option in current_options:
-                current_options.remove(option)
-            else:
-                current_options.append(option)
-            user_data[chat_id]['data']['shipping_options'] = current_options
-            
-            # Оновлюємо інлайн-клавіатуру, щоб показати вибрані опції
-            inline_markup = types.InlineKeyboardMarkup(row_width=2)
-            shipping_options_list = ["Наложка Нова Пошта", "Наложка Укрпошта", "Особиста зустріч"]
-            buttons = []
-            for opt in shipping_options_list:
-                emoji = '✅ ' if opt in current_options else ''
-                buttons.append(types.InlineKeyboardButton(f"{emoji}{opt}", callback_data=f"shipping_{opt}"))
-            
-            inline_markup.add(*buttons)
-            inline_markup.add(types.InlineKeyboardButton("Далі ➡️", callback_data="shipping_next"))
-            
-            bot.edit_message_reply_markup(chat_id, message_id, reply_markup=inline_markup)
+            # Два швидкі натискання можуть оброблятися паралельно: читання-зміна-запис і редагування йдуть під замком
+            with user_data[chat_id]['lock']:
+                current_options = user_data[chat_id]['data'].get('shipping_options', [])
+                if option in current_options:
+                    current_options.remove(option)
+                else:
+                    current_options.append(option)
+                user_data[chat_id]['data']['shipping_options'] = current_options
+                
+                # Оновлюємо інлайн-клавіатуру, щоб показати вибрані опції
+                bot.edit_message_reply_markup(chat_id, message_id, reply_markup=shipping_markup_for(current_options))
             
     bot.answer_callback_query(call.id) # Важливо: завжди відповідати на callback_query
 
 
 # --- 15. Функції для "Мої товари" ---
 PRODUCT_PAGE_SIZE = 5 # Кількість товарів на сторінці
+PRODUCT_STATUS_EMOJI = {'pending': '⏳', 'approved': '✅', 'rejected': '❌', 'sold': '💰', 'expired': '🗑️'}
 
 @error_handler
 def send_my_products(message, offset=0):
@@ -1251,80 +1524,81 @@ def send_my_products(message, offset=0):
     if not conn:
         bot.send_message(chat_id, "Помилка підключення до бази даних.")
         return
+    # Дані читаються одразу, а з'єднання звільняється до надсилання повідомлень у Telegram
     try:
         cur = conn.cursor()
         # Отримуємо загальну кількість товарів користувача
-        cur.execute(pg_sql.SQL("SELECT COUNT(*) FROM products WHERE seller_chat_id = %s;"), (chat_id,))
+        cur.execute("SELECT COUNT(*) FROM products WHERE seller_chat_id = %s;", (chat_id,))
         total_products = cur.fetchone()[0]
 
-        if total_products == 0:
-            bot.send_message(chat_id, "У вас ще немає доданих товарів. 😔", reply_markup=main_menu_markup)
-            return
-
-        # Отримуємо товари для поточної сторінки
-        cur.execute(pg_sql.SQL("""
-            SELECT id, product_name, price, status, views, likes_count, created_at, last_republish_date
-            FROM products
-            WHERE seller_chat_id = %s
-            ORDER BY created_at DESC
-            LIMIT %s OFFSET %s;
-        """), (chat_id, PRODUCT_PAGE_SIZE, offset))
-        products = cur.fetchall()
-
-        products_text = "📋 *Ваші товари:*\n\n"
-        for prod in products:
-            status_emoji = {
-                'pending': '⏳', 'approved': '✅', 'rejected': '❌', 'sold': '💰', 'expired': '🗑️'
-            }.get(prod['status'], '❓')
-            
-            republish_info = ""
-            if prod['status'] == 'approved':
-                republish_info = f" | Опубліковано: {prod['republish_count']} разів."
-                if prod['last_republish_date']:
-                    time_since_republish = (date.today() - prod['last_republish_date']).days
-                    republish_info += f" (останнє {time_since_republish} дн. тому)"
-
-            products_text += (
-                f"{status_emoji} *{prod['product_name']}* (ID: `{prod['id']}`)\n"
-                f"   Ціна: `{prod['price']}`\n"
-                f"   Статус: {prod['status'].capitalize()}\n"
-                f"   Перегляди: {prod['views']} | ❤️: {prod['likes_count']}{republish_info}\n\n"
-            )
-            
-            # Додаємо кнопки дій для кожного товару
-            product_markup = types.InlineKeyboardMarkup(row_width=2)
-            product_markup.add(
-                types.InlineKeyboardButton("👁️ Деталі", callback_data=f"view_my_product_{prod['id']}"),
-                types.InlineKeyboardButton("✏️ Змінити ціну", callback_data=f"change_price_{prod['id']}")
-            )
-            if prod['status'] == 'approved':
-                product_markup.add(
-                    types.InlineKeyboardButton("♻️ Переопублікувати", callback_data=f"republish_{prod['id']}"),
-                    types.InlineKeyboardButton("✅ Продано", callback_data=f"mark_sold_{prod['id']}")
-                )
-            product_markup.add(types.InlineKeyboardButton("🗑️ Видалити", callback_data=f"delete_product_{prod['id']}"))
-            
-            bot.send_message(chat_id, products_text, parse_mode='Markdown', reply_markup=product_markup)
-            products_text = "" # Очищуємо текст для наступного товару, щоб кожен мав свою клавіатуру
-
-        # Кнопки пагінації
-        pagination_markup = types.InlineKeyboardMarkup(row_width=2)
-        if offset > 0:
-            pagination_markup.add(types.InlineKeyboardButton("⬅️ Попередні", callback_data=f"prev_product_{max(0, offset - PRODUCT_PAGE_SIZE)}"))
-        if offset + PRODUCT_PAGE_SIZE < total_products:
-            pagination_markup.add(types.InlineKeyboardButton("Наступні ➡️", callback_data=f"next_product_{offset + PRODUCT_PAGE_SIZE}"))
-        
-        if pagination_markup.keyboard: # Надсилаємо, тільки якщо є кнопки пагінації
-            bot.send_message(chat_id, f"Сторінка {offset // PRODUCT_PAGE_SIZE + 1} з {(total_products + PRODUCT_PAGE_SIZE - 1) // PRODUCT_PAGE_SIZE}", reply_markup=pagination_markup)
-
-        log_statistics('view_my_products', chat_id, details=f"offset: {offset}")
-
+        products = []
+        if total_products:
+            # Отримуємо товари для поточної сторінки
+            cur.execute("""
+                SELECT id, product_name, price, status, views, likes_count, created_at, republish_count, last_republish_date
+                FROM products
+                WHERE seller_chat_id = %s
+                ORDER BY created_at DESC
+                LIMIT %s OFFSET %s;
+            """, (chat_id, PRODUCT_PAGE_SIZE, offset))
+            products = cur.fetchall()
     except Exception as e:
         logger.error(f"Помилка при відправці моїх товарів для {chat_id}: {e}", exc_info=True)
         bot.send_message(chat_id, "Сталася помилка при завантаженні ваших товарів.")
+        return
     finally:
         if conn:
-            conn.close()
+            put_db_connection(conn)
+
+    if total_products == 0:
+        bot.send_message(chat_id, "У вас ще немає доданих товарів. 😔", reply_markup=main_menu_markup)
+        return
+
+    products_text = "📋 *Ваші товари:*\n\n"
+    for prod in products:
+        status_emoji = PRODUCT_STATUS_EMOJI.get(prod['status'], '❓')
+        
+        republish_info = ""
+        if prod['status'] == 'approved':
+            republish_info = f" | Опубліковано: {prod['republish_count']} разів."
+            if prod['last_republish_date']:
+                time_since_republish = (date.today() - prod['last_republish_date']).days
+                republish_info += f" (останнє {time_since_republish} дн. тому)"
+
+        products_text += (
+            f"{status_emoji} *{prod['product_name']}* (ID: `{prod['id']}`)\n"
+            f"   Ціна: `{prod['price']}`\n"
+            f"   Статус: {prod['status'].capitalize()}\n"
+            f"   Перегляди: {prod['views']} | ❤️: {prod['likes_count']}{republish_info}\n\n"
+        )
+        
+        # Додаємо кнопки дій для кожного товару
+        product_markup = types.InlineKeyboardMarkup(row_width=2)
+        product_markup.add(
+            types.InlineKeyboardButton("👁️ Деталі", callback_data=f"view_my_product_{prod['id']}"),
+            types.InlineKeyboardButton("✏️ Змінити ціну", callback_data=f"change_price_{prod['id']}")
+        )
+        if prod['status'] == 'approved':
+            product_markup.add(
+                types.InlineKeyboardButton("♻️ Переопублікувати", callback_data=f"republish_{prod['id']}"),
+                types.InlineKeyboardButton("✅ Продано", callback_data=f"mark_sold_{prod['id']}")
+            )
+        product_markup.add(types.InlineKeyboardButton("🗑️ Видалити", callback_data=f"delete_product_{prod['id']}"))
+        
+        bot.send_message(chat_id, products_text, parse_mode='Markdown', reply_markup=product_markup)
+        products_text = "" # Очищуємо текст для наступного товару, щоб кожен мав свою клавіатуру
+
+    # Кнопки пагінації
+    pagination_markup = types.InlineKeyboardMarkup(row_width=2)
+    if offset > 0:
+        pagination_markup.add(types.InlineKeyboardButton("⬅️ Попередні", callback_data=f"prev_product_{max(0, offset - PRODUCT_PAGE_SIZE)}"))
+    if offset + PRODUCT_PAGE_SIZE < total_products:
+        pagination_markup.add(types.InlineKeyboardButton("Наступні ➡️", callback_data=f"next_product_{offset + PRODUCT_PAGE_SIZE}"))
+    
+    if pagination_markup.keyboard: # Надсилаємо, тільки якщо є кнопки пагінації
+        bot.send_message(chat_id, f"Сторінка {offset // PRODUCT_PAGE_SIZE + 1} з {(total_products + PRODUCT_PAGE_SIZE - 1) // PRODUCT_PAGE_SIZE}", reply_markup=pagination_markup)
+
+    log_statistics('view_my_products', chat_id, details=f"offset: {offset}")
 
 @error_handler
 def send_product_details_to_seller(chat_id, product_id, message_id_to_edit=None):
@@ -1337,20 +1611,16 @@ def send_product_details_to_seller(chat_id, product_id, message_id_to_edit=None)
         return
     try:
         cur = conn.cursor()
-        cur.execute(pg_sql.SQL("""
-            SELECT id, seller_chat_id, seller_username, product_name, price, description, photos, geolocation, status,
-                   commission_amount, views, likes_count, created_at, updated_at, shipping_options, hashtags, channel_message_id, last_republish_date, republish_count
-            FROM products WHERE id = %s AND seller_chat_id = %s;
-        """), (product_id, chat_id))
+        execute_prepared(cur, 'seller_product_details', (product_id, chat_id))
         product = cur.fetchone()
 
         if not product:
             bot.send_message(chat_id, "Товар не знайдено або він не належить вам.")
             return
 
-        photos = json.loads(product['photos']) if product['photos'] else []
-        geolocation = json.loads(product['geolocation']) if product['geolocation'] else None
-        shipping_options_text = ", ".join(json.loads(product['shipping_options'])) if product['shipping_options'] else "Не вказано"
+        photos = product['photos'] or []
+        geolocation = product['geolocation']
+        shipping_options_text = ", ".join(product['shipping_options'] or []) or "Не вказано"
         hashtags = product['hashtags'] if product['hashtags'] else "Немає"
 
         details_text = (
@@ -1415,7 +1685,7 @@ def send_product_details_to_seller(chat_id, product_id, message_id_to_edit=None)
         bot.send_message(chat_id, "Сталася помилка при завантаженні деталей товару.")
     finally:
         if conn:
-            conn.close()
+            put_db_connection(conn)
 
 @error_handler
 def start_change_price_flow(chat_id, product_id, message_id_to_edit):
@@ -1449,82 +1719,63 @@ def process_new_price(message):
         bot.send_message(chat_id, "Будь ласка, введіть коректну ціну (до 50 символів). Спробуйте ще раз:")
         return
 
-    conn = get_db_connection()
-    if not conn:
-        bot.send_message(chat_id, "Помилка підключення до бази даних. Спробуйте пізніше.")
-        return
+    # Транзакція охоплює лише запис у БД; з'єднання повертається в пул до звернень до Telegram
     try:
-        cur = conn.cursor()
-        cur.execute(pg_sql.SQL("UPDATE products SET price = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s AND seller_chat_id = %s;"),
-                       (new_price, product_id, chat_id))
-        conn.commit()
-        bot.send_message(chat_id, f"✅ Ціну для товару ID `{product_id}` оновлено на `{new_price}`.", reply_markup=main_menu_markup, parse_mode='Markdown')
-        del user_data[chat_id] # Очищуємо стан після завершення
-        send_product_details_to_seller(chat_id, product_id, message_id_to_edit) # Оновлюємо відображення деталей
-        log_statistics('change_price', chat_id, product_id, details=f"new_price: {new_price}")
+        with db_conn() as conn:
+            conn.cursor().execute("UPDATE products SET price = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s AND seller_chat_id = %s;",
+                                  (new_price, product_id, chat_id))
     except Exception as e:
         logger.error(f"Помилка оновлення ціни для товару {product_id} користувача {chat_id}: {e}", exc_info=True)
-        conn.rollback()
         bot.send_message(chat_id, "Сталася помилка при оновленні ціни.")
-    finally:
-        if conn:
-            conn.close()
+        return
+
+    bot.send_message(chat_id, f"✅ Ціну для товару ID `{product_id}` оновлено на `{new_price}`.", reply_markup=main_menu_markup, parse_mode='Markdown')
+    del user_data[chat_id] # Очищуємо стан після завершення
+    send_product_details_to_seller(chat_id, product_id, message_id_to_edit) # Оновлюємо відображення деталей
+    log_statistics('change_price', chat_id, product_id, details=f"new_price: {new_price}")
 
 @error_handler
 def delete_product(chat_id, product_id, message_id_to_edit):
     """Видаляє товар з бази даних."""
-    conn = get_db_connection()
-    if not conn:
-        bot.send_message(chat_id, "Помилка підключення до бази даних.")
-        return
     try:
-        cur = conn.cursor()
-        # Отримуємо channel_message_id, щоб видалити його з каналу
-        cur.execute(pg_sql.SQL("SELECT channel_message_id FROM products WHERE id = %s AND seller_chat_id = %s;"),
-                       (product_id, chat_id))
-        product_info = cur.fetchone()
-        channel_message_id = product_info['channel_message_id'] if product_info else None
-
-        cur.execute(pg_sql.SQL("DELETE FROM products WHERE id = %s AND seller_chat_id = %s;"), (product_id, chat_id))
-        conn.commit()
-
-        # Видаляємо повідомлення з каналу, якщо воно було опубліковано
-        if channel_message_id:
-            try:
-                bot.delete_message(CHANNEL_ID, channel_message_id)
-                logger.info(f"Повідомлення {channel_message_id} видалено з каналу {CHANNEL_ID}.")
-            except Exception as e:
-                logger.warning(f"Не вдалося видалити повідомлення {channel_message_id} з каналу: {e}")
-
-        bot.edit_message_text(f"🗑️ Товар ID `{product_id}` успішно видалено.", chat_id, message_id_to_edit, parse_mode='Markdown')
-        log_statistics('delete_product', chat_id, product_id)
+        # Пошук і видалення — одна транзакція з одним комітом
+        with db_conn() as conn:
+            cur = conn.cursor()
+            # Отримуємо channel_message_id, щоб видалити його з каналу
+            execute_prepared(cur, 'seller_product_channel_message', (product_id, chat_id))
+            product_info = cur.fetchone()
+            channel_message_id = product_info['channel_message_id'] if product_info else None
+
+            cur.execute("DELETE FROM products WHERE id = %s AND seller_chat_id = %s;", (product_id, chat_id))
     except Exception as e:
         logger.error(f"Помилка видалення товару {product_id} користувача {chat_id}: {e}", exc_info=True)
-        conn.rollback()
         bot.edit_message_text(f"Сталася помилка при видаленні товару ID `{product_id}`.", chat_id, message_id_to_edit, parse_mode='Markdown')
-    finally:
-        if conn:
-            conn.close()
+        return
+
+    # Видаляємо повідомлення з каналу, якщо воно було опубліковано
+    if channel_message_id:
+        try:
+            bot.delete_message(CHANNEL_ID, channel_message_id)
+            logger.info(f"Повідомлення {channel_message_id} видалено з каналу {CHANNEL_ID}.")
+        except Exception as e:
+            logger.warning(f"Не вдалося видалити повідомлення {channel_message_id} з каналу: {e}")
+
+    bot.edit_message_text(f"🗑️ Товар ID `{product_id}` успішно видалено.", chat_id, message_id_to_edit, parse_mode='Markdown')
+    log_statistics('delete_product', chat_id, product_id)
 
 @error_handler
 def mark_product_sold(chat_id, product_id, message_id_to_edit):
     """Позначає товар як проданий."""
-    conn = get_db_connection()
-    if not conn:
-        bot.send_message(chat_id, "Помилка підключення до бази даних.")
-        return
     try:
-        cur = conn.cursor()
-        # Оновлюємо статус товару
-        cur.execute(pg_sql.SQL("""
-            UPDATE products SET status = 'sold', updated_at = CURRENT_TIMESTAMP
-            WHERE id = %s AND seller_chat_id = %s RETURNING channel_message_id;
-        """), (product_id, chat_id))
-        
-        product_info = cur.fetchone()
+        with db_conn() as conn:
+            cur = conn.cursor()
+            # Оновлюємо статус товару
+            cur.execute("""
+                UPDATE products SET status = 'sold', updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s AND seller_chat_id = %s RETURNING channel_message_id;
+            """, (product_id, chat_id))
+            product_info = cur.fetchone()
         channel_message_id = product_info['channel_message_id'] if product_info else None
-        
-        conn.commit()
 
         # Редагуємо повідомлення в каналі, додаючи мітку "ПРОДАНО"
         if channel_message_id:
@@ -1555,11 +1806,7 @@ def mark_product_sold(chat_id, product_id, message_id_to_edit):
         log_statistics('mark_sold', chat_id, product_id)
     except Exception as e:
         logger.error(f"Помилка позначення товару {product_id} як проданого для користувача {chat_id}: {e}", exc_info=True)
-        conn.rollback()
         bot.edit_message_text(f"Сталася помилка при позначенні товару ID `{product_id}` як проданого.", chat_id, message_id_to_edit, parse_mode='Markdown')
-    finally:
-        if conn:
-            conn.close()
 
 @error_handler
 def republish_product(chat_id, product_id, message_id_to_edit):
@@ -1570,10 +1817,7 @@ def republish_product(chat_id, product_id, message_id_to_edit):
         return
     try:
         cur = conn.cursor()
-        cur.execute(pg_sql.SQL("""
-            SELECT product_name, price, description, photos, geolocation, shipping_options, hashtags, status, last_republish_date, republish_count
-            FROM products WHERE id = %s AND seller_chat_id = %s;
-        """), (product_id, chat_id))
+        execute_prepared(cur, 'seller_product_for_republish', (product_id, chat_id))
         product_data = cur.fetchone()
 
         if not product_data:
@@ -1611,14 +1855,14 @@ def republish_product(chat_id, product_id, message_id_to_edit):
 
             if sent_message:
                 # Оновлюємо канал_меседж_ід, лічильник переопублікацій та дату останньої переопублікації
-                cur.execute(pg_sql.SQL("""
+                cur.execute("""
                     UPDATE products SET 
                         channel_message_id = %s, 
                         republish_count = republish_count + 1, 
                         last_republish_date = CURRENT_DATE, 
                         updated_at = CURRENT_TIMESTAMP
                     WHERE id = %s;
-                """), (sent_message.message_id, product_id))
+                """, (sent_message.message_id, product_id))
                 conn.commit()
                 bot.edit_message_text(f"✅ Товар ID `{product_id}` успішно переопубліковано в канал!", chat_id, message_id_to_edit, parse_mode='Markdown')
                 log_statistics('republish_product', chat_id, product_id)
@@ -1633,7 +1877,7 @@ def republish_product(chat_id, product_id, message_id_to_edit):
         bot.send_message(chat_id, "Сталася помилка при переопублікації товару.")
     finally:
         if conn:
-            conn.close()
+            put_db_connection(conn)
 
 # --- 16. Функції для "Обраних" товарів ---
 @error_handler
@@ -1641,85 +1885,69 @@ def toggle_favorite_product(user_chat_id, product_id, message_id, is_from_channe
     """
     Додає/видаляє товар з обраного користувача та оновлює лічильник лайків в каналі.
     """
-    conn = get_db_connection()
-    if not conn:
-        bot.answer_callback_query(message_id, "Помилка БД.")
+    try:
+        # Перемикання і лічильник — одна транзакція; з'єднання повертається в пул до звернень до Telegram
+        with db_conn() as conn:
+            cur = conn.cursor()
+            # Видалення або додавання в обране і зміна лічильника лайків — один запит:
+            # якщо DELETE нічого не знайшов, спрацьовує INSERT, а delta дає -1/+1 (0 при гонці подвійного натискання)
+            cur.execute("""
+                WITH del AS (
+                    DELETE FROM favorites WHERE user_chat_id = %s AND product_id = %s RETURNING 1
+                ), ins AS (
+                    INSERT INTO favorites (user_chat_id, product_id)
+                    SELECT %s, %s WHERE NOT EXISTS (SELECT 1 FROM del)
+                    ON CONFLICT (user_chat_id, product_id) DO NOTHING
+                    RETURNING 1
+                ), delta AS (
+                    SELECT CASE WHEN EXISTS (SELECT 1 FROM del) THEN -1
+                                WHEN EXISTS (SELECT 1 FROM ins) THEN 1
+                                ELSE 0 END AS d
+                )
+                UPDATE products SET likes_count = GREATEST(0, likes_count + (SELECT d FROM delta))
+                WHERE id = %s
+                RETURNING likes_count, (SELECT d FROM delta) AS direction;
+            """, (user_chat_id, product_id, user_chat_id, product_id, product_id))
+            result = cur.fetchone()
+            new_likes_count = result['likes_count']
+            is_favorite = result['direction'] < 0
+            action_text = "💔 Видалено з обраного" if is_favorite else "❤️ Додано в обране"
+    except Exception as e:
+        logger.error(f"Помилка перемикання обраного для користувача {user_chat_id}, товару {product_id}: {e}", exc_info=True)
+        bot.answer_callback_query(message_id, "Сталася помилка при оновленні обраного.")
         return
 
-    try:
-        cur = conn.cursor()
-        # Перевіряємо, чи товар вже в обраних
-        cur.execute(pg_sql.SQL("SELECT id FROM favorites WHERE user_chat_id = %s AND product_id = %s;"),
-                       (user_chat_id, product_id))
-        is_favorite = cur.fetchone()
-
-        if is_favorite:
-            # Видаляємо з обраних
-            cur.execute(pg_sql.SQL("DELETE FROM favorites WHERE user_chat_id = %s AND product_id = %s;"),
-                           (user_chat_id, product_id))
-            action_text = "💔 Видалено з обраного"
-            # Зменшуємо лічильник лайків
-            cur.execute(pg_sql.SQL("UPDATE products SET likes_count = GREATEST(0, likes_count - 1) WHERE id = %s RETURNING likes_count;"), (product_id,))
-        else:
-            # Додаємо в обрані
-            cur.execute(pg_sql.SQL("INSERT INTO favorites (user_chat_id, product_id) VALUES (%s, %s);"),
-                           (user_chat_id, product_id))
-            action_text = "❤️ Додано в обране"
-            # Збільшуємо лічильник лайків
-            cur.execute(pg_sql.SQL("UPDATE products SET likes_count = likes_count + 1 WHERE id = %s RETURNING likes_count;"), (product_id,))
-        
-        new_likes_count = cur.fetchone()['likes_count']
-        conn.commit()
+    bot.answer_callback_query(message_id, action_text)
+    log_statistics('toggle_favorite', user_chat_id, product_id, details=action_text)
 
-        bot.answer_callback_query(message_id, action_text)
-        log_statistics('toggle_favorite', user_chat_id, product_id, details=action_text)
-
-        # Якщо дія прийшла з каналу, оновлюємо повідомлення в каналі
-        if is_from_channel:
-            product_data = get_product_by_id(product_id)
-            if product_data and product_data['channel_message_id']:
-                channel_message_id = product_data['channel_message_id']
-                try:
-                    # Редагуємо текст повідомлення, щоб оновити лічильник лайків
-                    # або додаємо реакцію
-                    
-                    # Оновлюємо клавіатуру, щоб відобразити новий лічильник
-                    seller_chat_id = product_data['seller_chat_id']
-                    seller_username = get_username_by_chat_id(seller_chat_id)
-                    markup = types.InlineKeyboardMarkup(row_width=1)
-                    
-                    # Кнопка "Написати продавцю"
-                    seller_link = f"tg://user?id={seller_chat_id}"
-                    contact_button_text = f"✉️ Написати продавцю"
-                    markup.add(types.InlineKeyboardButton(contact_button_text, url=seller_link))
-                    
-                    # Кнопка "Додати/Видалити з обраного" з лічильником
-                    fav_emoji = "❤️" if is_favorite else "🤍"
-                    markup.add(types.InlineKeyboardButton(f"{fav_emoji} Обране ({new_likes_count})", callback_data=f"channel_fav_{product_id}"))
-
-                    # Для публікацій з фото, треба редагувати caption, а не text
-                    # Перевіряємо, чи повідомлення було з фото
-                    if product_data['photos']:
-                        # Тут потрібно отримати поточний caption, змінити його і відправити назад
-                        # Це складніше, оскільки Telebot не дозволяє просто отримати caption з об'єкта Message_id
-                        # Простіше просто оновити кнопки з новим лічильником.
-                        bot.edit_message_reply_markup(CHANNEL_ID, channel_message_id, reply_markup=markup)
-                    else:
-                        # Якщо це текстове оголошення, можна редагувати текст
-                        # Залишаємо лише оновлення клавіатури, оскільки оновлення тексту може бути складним
-                        # без повторного форматування всього оголошення.
-                        bot.edit_message_reply_markup(CHANNEL_ID, channel_message_id, reply_markup=markup)
+    # Якщо дія прийшла з каналу, оновлюємо повідомлення в каналі
+    if is_from_channel:
+        product_data = get_product_by_id(product_id)
+        if product_data and product_data['channel_message_id']:
+            channel_message_id = product_data['channel_message_id']
+            try:
+                # Редагуємо текст повідомлення, щоб оновити лічильник лайків
+                # або додаємо реакцію
+                
+                # Оновлюємо клавіатуру, щоб відобразити новий лічильник
+                seller_chat_id = product_data['seller_chat_id']
+                seller_username = get_username_by_chat_id(seller_chat_id)
+                markup = types.InlineKeyboardMarkup(row_width=1)
+                
+                # Кнопка "Написати продавцю"
+                seller_link = f"tg://user?id={seller_chat_id}"
+                contact_button_text = f"✉️ Написати продавцю"
+                markup.add(types.InlineKeyboardButton(contact_button_text, url=seller_link))
+                
+                # Кнопка "Додати/Видалити з обраного" з лічильником
+                fav_emoji = "❤️" if is_favorite else "🤍"
+                markup.add(types.InlineKeyboardButton(f"{fav_emoji} Обране ({new_likes_count})", callback_data=f"channel_fav_{product_id}"))
 
-                except Exception as e:
-                    logger.warning(f"Не вдалося оновити повідомлення в каналі {channel_message_id} для товару {product_id}: {e}")
+                # Редагуємо лише клавіатуру (і для фото, і для тексту); часті натискання зливаються в одне редагування
+                schedule_like_markup_edit(channel_message_id, markup)
 
-    except Exception as e:
-        logger.error(f"Помилка перемикання обраного для користувача {user_chat_id}, товару {product_id}: {e}", exc_info=True)
-        conn.rollback()
-        bot.answer_callback_query(message_id, "Сталася помилка при оновленні обраного.")
-    finally:
-        if conn:
-            conn.close()
+            except Exception as e:
+                logger.warning(f"Не вдалося оновити повідомлення в каналі {channel_message_id} для товару {product_id}: {e}")
 
 @error_handler
 def send_favorites(message, offset=0):
@@ -1731,66 +1959,69 @@ def send_favorites(message, offset=0):
     if not conn:
         bot.send_message(chat_id, "Помилка підключення до бази даних.")
         return
+    # Дані читаються одразу, а з'єднання звільняється до надсилання повідомлень у Telegram
     try:
         cur = conn.cursor()
         # Отримуємо загальну кількість обраних товарів користувача
-        cur.execute(pg_sql.SQL("SELECT COUNT(f.product_id) FROM favorites f JOIN products p ON f.product_id = p.id WHERE f.user_chat_id = %s AND p.status = 'approved';"), (chat_id,))
+        cur.execute("SELECT COUNT(f.product_id) FROM favorites f JOIN products p ON f.product_id = p.id WHERE f.user_chat_id = %s AND p.status = 'approved';", (chat_id,))
         total_favorites = cur.fetchone()[0]
 
-        if total_favorites == 0:
-            bot.send_message(chat_id, "У вас поки що немає обраних товарів. Додайте щось, щоб тут було цікаво! ❤️", reply_markup=main_menu_markup)
-            return
-
-        # Отримуємо обрані товари для поточної сторінки
-        cur.execute(pg_sql.SQL("""
-            SELECT p.id, p.product_name, p.price, p.seller_chat_id, p.seller_username, p.photos, p.description, p.likes_count
-            FROM favorites f
-            JOIN products p ON f.product_id = p.id
-            WHERE f.user_chat_id = %s AND p.status = 'approved'
-            ORDER BY f.id DESC -- За порядком додавання в обране
-            LIMIT %s OFFSET %s;
-        """), (chat_id, PRODUCT_PAGE_SIZE, offset))
-        favorite_products = cur.fetchall()
-
-        fav_text = "⭐ *Ваші обрані товари:*\n\n"
-        for prod in favorite_products:
-            photos = json.loads(prod['photos']) if prod['photos'] else []
-            seller_username = prod['seller_username'] if prod['seller_username'] else "Не вказано"
-
-            fav_text += (
-                f"✨ *{prod['product_name']}* (ID: `{prod['id']}`)\n"
-                f"   Ціна: `{prod['price']}`\n"
-                f"   Продавець: [{'@' + seller_username if seller_username != 'Не вказано' else 'Користувач'}](tg://user?id={prod['seller_chat_id']})\n"
-                f"   ❤️: {prod['likes_count']} | 📸: {len(photos)} шт.\n\n"
-            )
-            
-            # Додаємо кнопки дій для кожного обраного товару
-            product_markup = types.InlineKeyboardMarkup(row_width=2)
-            product_markup.add(
-                types.InlineKeyboardButton("👁️ Деталі", callback_data=f"view_fav_product_{prod['id']}"),
-                types.InlineKeyboardButton("💔 Видалити з обраного", callback_data=f"toggle_favorite_{prod['id']}")
-            )
-            bot.send_message(chat_id, fav_text, parse_mode='Markdown', reply_markup=product_markup)
-            fav_text = "" # Очищуємо текст для наступного товару
-
-        # Кнопки пагінації
-        pagination_markup = types.InlineKeyboardMarkup(row_width=2)
-        if offset > 0:
-            pagination_markup.add(types.InlineKeyboardButton("⬅️ Попередні", callback_data=f"prev_fav_product_{max(0, offset - PRODUCT_PAGE_SIZE)}"))
-        if offset + PRODUCT_PAGE_SIZE < total_favorites:
-            pagination_markup.add(types.InlineKeyboardButton("Наступні ➡️", callback_data=f"next_fav_product_{offset + PRODUCT_PAGE_SIZE}"))
-        
-        if pagination_markup.keyboard:
-            bot.send_message(chat_id, f"Сторінка {offset // PRODUCT_PAGE_SIZE + 1} з {(total_favorites + PRODUCT_PAGE_SIZE - 1) // PRODUCT_PAGE_SIZE}", reply_markup=pagination_markup)
-
-        log_statistics('view_favorites', chat_id, details=f"offset: {offset}")
-
+        favorite_products = []
+        if total_favorites:
+            # Отримуємо обрані товари для поточної сторінки
+            cur.execute("""
+                SELECT p.id, p.product_name, p.price, p.seller_chat_id, p.seller_username, p.photos, p.description, p.likes_count
+                FROM favorites f
+                JOIN products p ON f.product_id = p.id
+                WHERE f.user_chat_id = %s AND p.status = 'approved'
+                ORDER BY f.id DESC -- За порядком додавання в обране
+                LIMIT %s OFFSET %s;
+            """, (chat_id, PRODUCT_PAGE_SIZE, offset))
+            favorite_products = cur.fetchall()
     except Exception as e:
         logger.error(f"Помилка при відправці обраних товарів для {chat_id}: {e}", exc_info=True)
         bot.send_message(chat_id, "Сталася помилка при завантаженні обраних товарів.")
+        return
     finally:
         if conn:
-            conn.close()
+            put_db_connection(conn)
+
+    if total_favorites == 0:
+        bot.send_message(chat_id, "У вас поки що немає обраних товарів. Додайте щось, щоб тут було цікаво! ❤️", reply_markup=main_menu_markup)
+        return
+
+    fav_text = "⭐ *Ваші обрані товари:*\n\n"
+    for prod in favorite_products:
+        photos = prod['photos'] or []
+        seller_username = prod['seller_username'] if prod['seller_username'] else "Не вказано"
+
+        fav_text += (
+            f"✨ *{prod['product_name']}* (ID: `{prod['id']}`)\n"
+            f"   Ціна: `{prod['price']}`\n"
+            f"   Продавець: [{'@' + seller_username if seller_username != 'Не вказано' else 'Користувач'}](tg://user?id={prod['seller_chat_id']})\n"
+            f"   ❤️: {prod['likes_count']} | 📸: {len(photos)} шт.\n\n"
+        )
+        
+        # Додаємо кнопки дій для кожного обраного товару
+        product_markup = types.InlineKeyboardMarkup(row_width=2)
+        product_markup.add(
+            types.InlineKeyboardButton("👁️ Деталі", callback_data=f"view_fav_product_{prod['id']}"),
+            types.InlineKeyboardButton("💔 Видалити з обраного", callback_data=f"toggle_favorite_{prod['id']}")
+        )
+        bot.send_message(chat_id, fav_text, parse_mode='Markdown', reply_markup=product_markup)
+        fav_text = "" # Очищуємо текст для наступного товару
+
+    # Кнопки пагінації
+    pagination_markup = types.InlineKeyboardMarkup(row_width=2)
+    if offset > 0:
+        pagination_markup.add(types.InlineKeyboardButton("⬅️ Попередні", callback_data=f"prev_fav_product_{max(0, offset - PRODUCT_PAGE_SIZE)}"))
+    if offset + PRODUCT_PAGE_SIZE < total_favorites:
+        pagination_markup.add(types.InlineKeyboardButton("Наступні ➡️", callback_data=f"next_fav_product_{offset + PRODUCT_PAGE_SIZE}"))
+    
+    if pagination_markup.keyboard:
+        bot.send_message(chat_id, f"Сторінка {offset // PRODUCT_PAGE_SIZE + 1} з {(total_favorites + PRODUCT_PAGE_SIZE - 1) // PRODUCT_PAGE_SIZE}", reply_markup=pagination_markup)
+
+    log_statistics('view_favorites', chat_id, details=f"offset: {offset}")
 
 @error_handler
 def send_product_details_to_user(chat_id, product_id, message_id_to_edit=None, is_favorite_view=False):
@@ -1803,20 +2034,21 @@ def send_product_details_to_user(chat_id, product_id, message_id_to_edit=None, i
         return
     try:
         cur = conn.cursor()
-        cur.execute(pg_sql.SQL("""
+        cur.execute("""
             SELECT id, seller_chat_id, seller_username, product_name, price, description, photos, geolocation, status,
-                   views, likes_count, created_at, updated_at, shipping_options, hashtags
+                   views, likes_count, created_at, updated_at, shipping_options, hashtags,
+                   EXISTS (SELECT 1 FROM favorites f WHERE f.user_chat_id = %s AND f.product_id = products.id) AS is_user_favorite
             FROM products WHERE id = %s AND status = 'approved';
-        """), (product_id,))
+        """, (chat_id, product_id))
         product = cur.fetchone()
 
         if not product:
             bot.send_message(chat_id, "Товар не знайдено або він вже не доступний. 😟")
             return
 
-        photos = json.loads(product['photos']) if product['photos'] else []
-        geolocation = json.loads(product['geolocation']) if product['geolocation'] else None
-        shipping_options_text = ", ".join(json.loads(product['shipping_options'])) if product['shipping_options'] else "Не вказано"
+        photos = product['photos'] or []
+        geolocation = product['geolocation']
+        shipping_options_text = ", ".join(product['shipping_options'] or []) or "Не вказано"
         hashtags = product['hashtags'] if product['hashtags'] else "Немає"
         seller_username = product['seller_username'] if product['seller_username'] else "Користувач"
 
@@ -1839,11 +2071,8 @@ def send_product_details_to_user(chat_id, product_id, message_id_to_edit=None, i
         seller_link = f"tg://user?id={product['seller_chat_id']}"
         markup.add(types.InlineKeyboardButton("✉️ Написати продавцю", url=seller_link))
 
-        # Кнопка "Додати/Видалити з обраного"
-        cur.execute(pg_sql.SQL("SELECT id FROM favorites WHERE user_chat_id = %s AND product_id = %s;"),
-                       (chat_id, product_id))
-        is_user_favorite = cur.fetchone()
-        fav_button_text = "💔 Видалити з обраного" if is_user_favorite else "❤️ Додати в обране"
+        # Кнопка "Додати/Видалити з обраного" (ознака обраного прийшла разом із товаром)
+        fav_button_text = "💔 Видалити з обраного" if product['is_user_favorite'] else "❤️ Додати в обране"
         markup.add(types.InlineKeyboardButton(fav_button_text, callback_data=f"toggle_favorite_{product['id']}"))
         
         # Додаємо кнопку "Назад до обраних" для перегляду з "Обраних"
@@ -1866,7 +2095,7 @@ def send_product_details_to_user(chat_id, product_id, message_id_to_edit=None, i
                 bot.send_message(chat_id, details_text, reply_markup=markup, parse_mode='Markdown')
 
         # Збільшуємо лічильник переглядів
-        cur.execute(pg_sql.SQL("UPDATE products SET views = views + 1 WHERE id = %s;"), (product_id,))
+        cur.execute("UPDATE products SET views = views + 1 WHERE id = %s;", (product_id,))
         conn.commit()
         log_statistics('view_product_details_user', chat_id, product_id)
 
@@ -1875,36 +2104,38 @@ def send_product_details_to_user(chat_id, product_id, message_id_to_edit=None, i
         bot.send_message(chat_id, "Сталася помилка при завантаженні деталей товару.")
     finally:
         if conn:
-            conn.close()
+            put_db_connection(conn)
 
 # --- 17. Допоміжні функції ---
+# Статичний текст довідки
+HELP_TEXT = (
+    "❓ *Допомога та FAQ*\n\n"
+    "Я - SellerBot, ваш розумний помічник у світі продажів та покупок! "
+    "Ось що я вмію:\n\n"
+    "📦 *Додати товар*: Покроково допоможу вам створити нове оголошення.\n"
+    "📋 *Мої товари*: Перегляд, редагування, позначення проданих та переопублікація ваших оголошень.\n"
+    "⭐ *Обрані*: Зберігайте товари, які вам сподобались, для швидкого доступу.\n"
+    "📺 *Наш канал*: Посилання на наш основний канал з оголошеннями.\n"
+    "🤖 *AI Помічник*: Поспілкуйтесь зі мною, я відповім на ваші питання щодо функціоналу бота, "
+    "допоможу сформулювати опис товару, або просто поговорю про новітні технології! "
+    "(Я відповідаю в стилі Ілона Маска 😉).\n\n"
+    "*Як продати товар?*\n"
+    "1. Натисніть '📦 Додати товар' та слідуйте інструкціям.\n"
+    "2. Після модерації ваш товар буде опубліковано в каналі.\n"
+    "3. З вами зв'яжуться потенційні покупці.\n"
+    "4. Після продажу позначте товар як 'Проданий' у розділі 'Мої товари'.\n\n"
+    "*Як купити товар?*\n"
+    "1. Перейдіть до нашого [основного каналу](https://t.me/your_channel_link) (кнопка '📺 Наш канал').\n"
+    "2. Знайдіть оголошення, що вас цікавить.\n"
+    "3. Натисніть 'Написати продавцю', щоб зв'язатися з ним напряму.\n\n"
+    "*Є питання?*\n"
+    "Просто напишіть мені або скористайтесь '🤖 AI Помічником'!"
+)
+
 @error_handler
 def send_help_message(message):
     """Надсилає користувачеві довідкове повідомлення."""
-    help_text = (
-        "❓ *Допомога та FAQ*\n\n"
-        "Я - SellerBot, ваш розумний помічник у світі продажів та покупок! "
-        "Ось що я вмію:\n\n"
-        "📦 *Додати товар*: Покроково допоможу вам створити нове оголошення.\n"
-        "📋 *Мої товари*: Перегляд, редагування, позначення проданих та переопублікація ваших оголошень.\n"
-        "⭐ *Обрані*: Зберігайте товари, які вам сподобались, для швидкого доступу.\n"
-        "📺 *Наш канал*: Посилання на наш основний канал з оголошеннями.\n"
-        "🤖 *AI Помічник*: Поспілкуйтесь зі мною, я відповім на ваші питання щодо функціоналу бота, "
-        "допоможу сформулювати опис товару, або просто поговорю про новітні технології! "
-        "(Я відповідаю в стилі Ілона Маска 😉).\n\n"
-        "*Як продати товар?*\n"
-        "1. Натисніть '📦 Додати товар' та слідуйте інструкціям.\n"
-        "2. Після модерації ваш товар буде опубліковано в каналі.\n"
-        "3. З вами зв'яжуться потенційні покупці.\n"
-        "4. Після продажу позначте товар як 'Проданий' у розділі 'Мої товари'.\n\n"
-        "*Як купити товар?*\n"
-        "1. Перейдіть до нашого [основного каналу](https://t.me/your_channel_link) (кнопка '📺 Наш канал').\n"
-        "2. Знайдіть оголошення, що вас цікавить.\n"
-        "3. Натисніть 'Написати продавцю', щоб зв'язатися з ним напряму.\n\n"
-        "*Є питання?*\n"
-        "Просто напишіть мені або скористайтесь '🤖 AI Помічником'!"
-    )
-    bot.send_message(message.chat.id, help_text, parse_mode='Markdown', reply_markup=main_menu_markup)
+    bot.send_message(message.chat.id, HELP_TEXT, parse_mode='Markdown', reply_markup=main_menu_markup)
     log_statistics('help_message', message.chat.id)
 
 @error_handler
@@ -1915,6 +2146,16 @@ def send_channel_link(message):
     bot.send_message(message.chat.id, "📺 *Наш канал з оголошеннями:*\nТут публікуються всі схвалені товари!", reply_markup=markup, parse_mode='Markdown')
     log_statistics('channel_link', message.chat.id)
 
+# Кнопки головного меню -> обробник: один пошук у словнику замість ланцюжка порівнянь рядків у handle_messages
+MAIN_MENU_DISPATCH = {
+    "📦 Додати товар": start_add_product_flow,
+    "📋 Мої товари": send_my_products,
+    "⭐ Обрані": send_favorites,
+    "❓ Допомога": send_help_message,
+    "📺 Наш канал": send_channel_link,
+    "🤖 AI Помічник": start_ai_chat,
+}
+
 def format_product_message(product, product_id=None, seller_chat_id=None, add_sold_tag=False):
     """
     Форматує повідомлення про товар для публікації в канал або для адмін-рев'ю.
@@ -1925,9 +2166,9 @@ def format_product_message(product, product_id=None, seller_chat_id=None, add_so
     if seller_chat_id is None:
         seller_chat_id = product['seller_chat_id']
 
-    photos = json.loads(product['photos']) if product['photos'] else []
-    geolocation = json.loads(product['geolocation']) if product['geolocation'] else None
-    shipping_options_text = ", ".join(json.loads(product['shipping_options'])) if product['shipping_options'] else "Не вказано"
+    photos = product['photos'] or []
+    geolocation = product['geolocation']
+    shipping_options_text = ", ".join(product['shipping_options'] or []) or "Не вказано"
     hashtags = product['hashtags'] if product['hashtags'] else ""
     seller_username = product['seller_username'] if product['seller_username'] else "Не вказано"
     
@@ -1969,19 +2210,19 @@ def get_product_by_id(product_id):
     if not conn: return None
     try:
         cur = conn.cursor()
-        cur.execute(pg_sql.SQL("""
+        cur.execute("""
             SELECT id, seller_chat_id, seller_username, product_name, price, description, photos, geolocation, 
                    status, commission_amount, views, likes_count, created_at, updated_at, shipping_options, 
                    hashtags, channel_message_id, last_republish_date, republish_count
             FROM products WHERE id = %s;
-        """), (product_id,))
+        """, (product_id,))
         return cur.fetchone()
     except Exception as e:
         logger.error(f"Помилка отримання товару за ID {product_id}: {e}", exc_info=True)
         return None
     finally:
         if conn:
-            conn.close()
+            put_db_connection(conn)
 
 def get_username_by_chat_id(chat_id):
     """Отримує ім'я користувача за chat_id."""
@@ -1989,7 +2230,7 @@ def get_username_by_chat_id(chat_id):
     if not conn: return "Невідомий користувач"
     try:
         cur = conn.cursor()
-        cur.execute(pg_sql.SQL("SELECT username FROM users WHERE chat_id = %s;"), (chat_id,))
+        cur.execute("SELECT username FROM users WHERE chat_id = %s;", (chat_id,))
         result = cur.fetchone()
         return result['username'] if result and result['username'] else "Користувач"
     except Exception as e:
@@ -1997,311 +2238,309 @@ def get_username_by_chat_id(chat_id):
         return "Невідомий користувач"
     finally:
         if conn:
-            conn.close()
+            put_db_connection(conn)
+
+# --- Підготовлені запити для адмін-панелі та кабінету продавця ---
+# Кожен запит проходить PREPARE один раз на з'єднання з пулу, далі виконується
+# лише EXECUTE: сервер не розбирає і не планує той самий SQL при кожному кліку.
+PREPARED_STATEMENTS = {
+    'seller_product_details': """
+        SELECT id, seller_chat_id, seller_username, product_name, price, description, photos, geolocation, status,
+               commission_amount, views, likes_count, created_at, updated_at, shipping_options, hashtags, channel_message_id, last_republish_date, republish_count
+        FROM products WHERE id = $1 AND seller_chat_id = $2
+    """,
+    'seller_product_for_republish': """
+        SELECT product_name, price, description, photos, geolocation, shipping_options, hashtags, status, last_republish_date, republish_count
+        FROM products WHERE id = $1 AND seller_chat_id = $2
+    """,
+    'seller_product_channel_message': """
+        SELECT channel_message_id FROM products WHERE id = $1 AND seller_chat_id = $2
+    """,
+    'admin_pending_products': """
+        SELECT id, seller_chat_id, seller_username, product_name, price, description, photos, geolocation, shipping_options, created_at
+        FROM products
+        WHERE status = 'pending'
+        ORDER BY created_at ASC
+    """,
+    'admin_users_list': """
+        SELECT chat_id, username, first_name, last_name, is_blocked, joined_at, last_activity, referrer_id
+        FROM users ORDER BY joined_at DESC
+    """,
+    'admin_block_menu': """
+        SELECT chat_id, username, first_name, last_name, is_blocked
+        FROM users ORDER BY is_blocked DESC, joined_at DESC
+    """,
+    'admin_commission_report': """
+        SELECT
+            p.id AS product_id,
+            p.product_name,
+            p.seller_chat_id,
+            u.username AS seller_username,
+            p.price,
+            p.commission_amount,
+            p.status AS product_status,
+            ct.status AS transaction_status,
+            ct.created_at AS transaction_date,
+            ct.paid_at AS paid_date
+        FROM products p
+        LEFT JOIN commission_transactions ct ON p.id = ct.product_id
+        LEFT JOIN users u ON p.seller_chat_id = u.chat_id
+        WHERE p.status = 'sold' AND (ct.status IS NULL OR ct.status = 'pending_payment')
+        ORDER BY ct.created_at ASC
+    """,
+    'admin_ai_stats': """
+        SELECT
+            COUNT(*) AS total_messages,
+            COUNT(DISTINCT user_chat_id) AS unique_users,
+            (SELECT COUNT(*) FROM conversations WHERE sender_type = 'user') AS user_messages,
+            (SELECT COUNT(*) FROM conversations WHERE sender_type = 'ai') AS ai_messages
+        FROM conversations
+    """,
+    'admin_referral_stats': """
+        SELECT
+            referrer_id,
+            COUNT(chat_id) AS referred_count,
+            MAX(r.username) AS referrer_username,
+            MAX(r.first_name) AS referrer_first_name,
+            MAX(r.last_name) AS referrer_last_name
+        FROM users r
+        JOIN users u ON r.chat_id = u.referrer_id
+        WHERE r.referrer_id IS NOT NULL OR u.referrer_id IS NOT NULL
+        GROUP BY referrer_id
+        ORDER BY referred_count DESC
+    """,
+}
+
+def execute_prepared(cur, name, params=()):
+    """Виконує запит з PREPARED_STATEMENTS, готуючи його на цьому з'єднанні при першому використанні."""
+    conn = cur.connection
+    prepared = getattr(conn, 'prepared_statements', None)
+    if prepared is None:
+        prepared = conn.prepared_statements = set()
+    if name not in prepared:
+        cur.execute(f"PREPARE {name} AS {PREPARED_STATEMENTS[name]}")
+        prepared.add(name)
+    if params:
+        cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        cur.execute(f"EXECUTE {name}")
 
 # --- Адміністративні функції (деталізація) ---
 @error_handler
 def send_pending_products_for_moderation(call):
     """Надсилає адміністратору список товарів, що очікують модерації."""
-    conn = get_db_connection()
-    if not conn:
-        bot.edit_message_text("❌ Помилка при отриманні товарів на модерацію (помилка БД).", call.message.chat.id, call.message.message_id)
-        return
-    cur = conn.cursor()
     try:
-        cur.execute(pg_sql.SQL("""
-            SELECT id, seller_chat_id, seller_username, product_name, price, description, photos, geolocation, shipping_options, created_at
-            FROM products
-            WHERE status = 'pending'
-            ORDER BY created_at ASC;
-        """))
-        pending_products = cur.fetchall()
-
-        if not pending_products:
-            bot.edit_message_text("✅ Наразі немає товарів на модерації.", call.message.chat.id, call.message.message_id, reply_markup=admin_panel_markup())
-            return
+        with db_conn() as conn, conn.cursor() as cur:
+            execute_prepared(cur, 'admin_pending_products')
+            pending_products = cur.fetchall()
+    except Exception as e:
+        logger.error(f"Помилка в send_pending_products_for_moderation: {e}", exc_info=True)
+        bot.edit_message_text("❌ Не вдалося отримати товари на модерацію.", call.message.chat.id, call.message.message_id, reply_markup=admin_panel_markup())
+        return
 
-        for product in pending_products:
-            product_id = product['id']
-            seller_chat_id = product['seller_chat_id']
-            seller_username = product['seller_username'] if product['seller_username'] else "Не вказано"
-            photos = json.loads(product['photos']) if product['photos'] else []
-            geolocation = json.loads(product['geolocation']) if product['geolocation'] else None
-            shipping_options_text = ", ".join(json.loads(product['shipping_options'])) if product['shipping_options'] else "Не вказано"
-
-
-            review_text = (
-                f"📦 *Товар на модерацію* (ID: {product_id})\n\n"
-                f"📝 Назва: {product['product_name']}\n"
-                f"💰 Ціна: {product['price']}\n"
-                f"📄 Опис: {product['description'][:500]}...\n"
-                f"📸 Фото: {len(photos)} шт.\n"
-                f"📍 Геолокація: {'Так' if geolocation else 'Ні'}\n"
-                f"🚚 Доставка: {shipping_options_text}\n"
-                f"👤 Продавець: [{'@' + seller_username if seller_username != 'Не вказано' else 'Користувач'}](tg://user?id={seller_chat_id})"
-            )
-            
-            markup = types.InlineKeyboardMarkup()
-            markup.add(
-                types.InlineKeyboardButton("✅ Схвалити", callback_data=f"approve_{product_id}"),
-                types.InlineKeyboardButton("❌ Відхилити", callback_data=f"reject_{product_id}")
-            )
-            markup.add(
-                types.InlineKeyboardButton("✏️ Редагувати хештеги", callback_data=f"mod_edit_tags_{product_id}"),
-                types.InlineKeyboardButton("🔄 Запит на виправлення фото", callback_data=f"mod_rotate_photo_{product_id}")
-            )
+    if not pending_products:
+        bot.edit_message_text("✅ Наразі немає товарів на модерації.", call.message.chat.id, call.message.message_id, reply_markup=admin_panel_markup())
+        return
 
-            try:
-                if photos:
-                    media = [types.InputMediaPhoto(photo_id, caption=review_text if i == 0 else None, parse_mode='Markdown') 
-                             for i, photo_id in enumerate(photos)]
-                    sent_messages = bot.send_media_group(call.message.chat.id, media)
-                    if sent_messages:
-                        bot.send_message(call.message.chat.id, 
-                                         f"👆 Деталі товару ID: {product_id} (фото вище)", 
-                                         reply_markup=markup, 
-                                         parse_mode='Markdown',
-                                         reply_to_message_id=sent_messages[0].message_id)
-                else:
-                    bot.send_message(call.message.chat.id, review_text, parse_mode='Markdown', reply_markup=markup)
-            except Exception as e:
-                logger.error(f"Помилка відправки товару {product_id} на модерацію адміну: {e}", exc_info=True)
-                bot.send_message(call.message.chat.id, f"❌ Помилка відображення товару ID {product_id}.")
+    for product in pending_products:
+        product_id = product['id']
+        seller_chat_id = product['seller_chat_id']
+        seller_username = product['seller_username'] if product['seller_username'] else "Не вказано"
+        photos = product['photos'] or []
+        geolocation = product['geolocation']
+        shipping_options_text = ", ".join(product['shipping_options'] or []) or "Не вказано"
+
+
+        review_text = (
+            f"📦 *Товар на модерацію* (ID: {product_id})\n\n"
+            f"📝 Назва: {product['product_name']}\n"
+            f"💰 Ціна: {product['price']}\n"
+            f"📄 Опис: {product['description'][:500]}...\n"
+            f"📸 Фото: {len(photos)} шт.\n"
+            f"📍 Геолокація: {'Так' if geolocation else 'Ні'}\n"
+            f"🚚 Доставка: {shipping_options_text}\n"
+            f"👤 Продавець: [{'@' + seller_username if seller_username != 'Не вказано' else 'Користувач'}](tg://user?id={seller_chat_id})"
+        )
         
-        bot.send_message(call.message.chat.id, "--- Кінець списку товарів на модерації ---", reply_markup=admin_panel_markup())
+        markup = types.InlineKeyboardMarkup()
+        markup.add(
+            types.InlineKeyboardButton("✅ Схвалити", callback_data=f"approve_{product_id}"),
+            types.InlineKeyboardButton("❌ Відхилити", callback_data=f"reject_{product_id}")
+        )
+        markup.add(
+            types.InlineKeyboardButton("✏️ Редагувати хештеги", callback_data=f"mod_edit_tags_{product_id}"),
+            types.InlineKeyboardButton("🔄 Запит на виправлення фото", callback_data=f"mod_rotate_photo_{product_id}")
+        )
 
-    except Exception as e:
-        logger.error(f"Помилка в send_pending_products_for_moderation: {e}", exc_info=True)
-        bot.edit_message_text("❌ Не вдалося отримати товари на модерацію.", call.message.chat.id, call.message.message_id, reply_markup=admin_panel_markup())
-    finally:
-        if conn:
-            conn.close()
+        try:
+            if photos:
+                media = [types.InputMediaPhoto(photo_id, caption=review_text if i == 0 else None, parse_mode='Markdown') 
+                         for i, photo_id in enumerate(photos)]
+                sent_messages = bot.send_media_group(call.message.chat.id, media)
+                if sent_messages:
+                    bot.send_message(call.message.chat.id, 
+                                     f"👆 Деталі товару ID: {product_id} (фото вище)", 
+                                     reply_markup=markup, 
+                                     parse_mode='Markdown',
+                                     reply_to_message_id=sent_messages[0].message_id)
+            else:
+                bot.send_message(call.message.chat.id, review_text, parse_mode='Markdown', reply_markup=markup)
+        except Exception as e:
+            logger.error(f"Помилка відправки товару {product_id} на модерацію адміну: {e}", exc_info=True)
+            bot.send_message(call.message.chat.id, f"❌ Помилка відображення товару ID {product_id}.")
+    
+    bot.send_message(call.message.chat.id, "--- Кінець списку товарів на модерації ---", reply_markup=admin_panel_markup())
 
 @error_handler
 def send_users_list_admin(call):
     """Надсилає адміністратору список зареєстрованих користувачів."""
-    conn = get_db_connection()
-    if not conn:
-        bot.edit_message_text("❌ Помилка при отриманні списку користувачів (помилка БД).", call.message.chat.id, call.message.message_id)
-        return
-    cur = conn.cursor()
     try:
-        cur.execute(pg_sql.SQL("""
-            SELECT chat_id, username, first_name, last_name, is_blocked, joined_at, last_activity, referrer_id
-            FROM users ORDER BY joined_at DESC;
-        """))
-        users = cur.fetchall()
-
-        if not users:
-            bot.edit_message_text("Наразі немає зареєстрованих користувачів.", call.message.chat.id, call.message.message_id, reply_markup=admin_panel_markup())
-            return
-
-        response_text = "👥 *Список користувачів:*\n\n"
-        for user in users:
-            username_display = f"@{user['username']}" if user['username'] else "Н/Д"
-            blocked_status = "🚫 Заблоковано" if user['is_blocked'] else "✅ Активний"
-            response_text += (
-                f"▪️ ID: `{user['chat_id']}`\n"
-                f"   Ім'я: {user['first_name']} {user['last_name'] or ''} ({username_display})\n"
-                f"   Статус: {blocked_status}\n"
-                f"   Зареєстровано: {user['joined_at'].strftime('%Y-%m-%d %H:%M')}\n"
-                f"   Ост. активність: {user['last_activity'].strftime('%Y-%m-%d %H:%M')}\n"
-                f"   Реферер: {user['referrer_id'] or 'Немає'}\n\n"
-            )
-        
-        if len(response_text) > 4096:
-            response_text = response_text[:4000] + "...\n\n(Повний список дуже довгий, дивіться логи або запитайте конкретніше)"
-
-        bot.edit_message_text(response_text, call.message.chat.id, call.message.message_id, parse_mode='Markdown', reply_markup=admin_panel_markup())
+        with db_conn() as conn, conn.cursor() as cur:
+            execute_prepared(cur, 'admin_users_list')
+            users = cur.fetchall()
     except Exception as e:
         logger.error(f"Помилка в send_users_list_admin: {e}", exc_info=True)
         bot.edit_message_text("❌ Не вдалося отримати список користувачів.", call.message.chat.id, call.message.message_id, reply_markup=admin_panel_markup())
-    finally:
-        if conn:
-            conn.close()
+        return
+
+    if not users:
+        bot.edit_message_text("Наразі немає зареєстрованих користувачів.", call.message.chat.id, call.message.message_id, reply_markup=admin_panel_markup())
+        return
+
+    response_text = "👥 *Список користувачів:*\n\n"
+    for user in users:
+        username_display = f"@{user['username']}" if user['username'] else "Н/Д"
+        blocked_status = "🚫 Заблоковано" if user['is_blocked'] else "✅ Активний"
+        response_text += (
+            f"▪️ ID: `{user['chat_id']}`\n"
+            f"   Ім'я: {user['first_name']} {user['last_name'] or ''} ({username_display})\n"
+            f"   Статус: {blocked_status}\n"
+            f"   Зареєстровано: {user['joined_at'].strftime('%Y-%m-%d %H:%M')}\n"
+            f"   Ост. активність: {user['last_activity'].strftime('%Y-%m-%d %H:%M')}\n"
+            f"   Реферер: {user['referrer_id'] or 'Немає'}\n\n"
+        )
+    
+    if len(response_text) > 4096:
+        response_text = response_text[:4000] + "...\n\n(Повний список дуже довгий, дивіться логи або запитайте конкретніше)"
+
+    bot.edit_message_text(response_text, call.message.chat.id, call.message.message_id, parse_mode='Markdown', reply_markup=admin_panel_markup())
 
 @error_handler
 def send_block_unblock_menu(call):
     """Надсилає адміністратору меню для блокування/розблокування користувачів."""
-    conn = get_db_connection()
-    if not conn:
-        bot.edit_message_text("❌ Помилка при отриманні списку користувачів (помилка БД).", call.message.chat.id, call.message.message_id)
-        return
-    cur = conn.cursor()
     try:
-        cur.execute(pg_sql.SQL("""
-            SELECT chat_id, username, first_name, last_name, is_blocked
-            FROM users ORDER BY is_blocked DESC, joined_at DESC;
-        """))
-        users = cur.fetchall()
-
-        if not users:
-            bot.edit_message_text("Наразі немає користувачів для блокування/розблокування.", call.message.chat.id, call.message.message_id, reply_markup=admin_panel_markup())
-            return
-
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        for user in users:
-            status_text = "🚫 Заблокувати" if not user['is_blocked'] else "✅ Розблокувати"
-            button_data = f"block_user_{user['chat_id']}" if not user['is_blocked'] else f"unblock_user_{user['chat_id']}"
-            username_display = f"@{user['username']}" if user['username'] else f"ID: {user['chat_id']}"
-            markup.add(types.InlineKeyboardButton(f"{status_text} {user['first_name']} {user['last_name'] or ''} ({username_display})", callback_data=button_data))
-        
-        markup.add(types.InlineKeyboardButton("🔙 Назад до адмін-панелі", callback_data="admin_back"))
-        bot.edit_message_text("👥 *Керування користувачами (блокування/розблокування)*\n\nОберіть користувача:", 
-                              call.message.chat.id, call.message.message_id, parse_mode='Markdown', reply_markup=markup)
+        with db_conn() as conn, conn.cursor() as cur:
+            execute_prepared(cur, 'admin_block_menu')
+            users = cur.fetchall()
     except Exception as e:
         logger.error(f"Помилка в send_block_unblock_menu: {e}", exc_info=True)
         bot.edit_message_text("❌ Не вдалося завантажити меню блокування.", call.message.chat.id, call.message.message_id, reply_markup=admin_panel_markup())
-    finally:
-        if conn:
-            conn.close()
+        return
+
+    if not users:
+        bot.edit_message_text("Наразі немає користувачів для блокування/розблокування.", call.message.chat.id, call.message.message_id, reply_markup=admin_panel_markup())
+        return
+
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    for user in users:
+        status_text = "🚫 Заблокувати" if not user['is_blocked'] else "✅ Розблокувати"
+        button_data = f"block_user_{user['chat_id']}" if not user['is_blocked'] else f"unblock_user_{user['chat_id']}"
+        username_display = f"@{user['username']}" if user['username'] else f"ID: {user['chat_id']}"
+        markup.add(types.InlineKeyboardButton(f"{status_text} {user['first_name']} {user['last_name'] or ''} ({username_display})", callback_data=button_data))
+    
+    markup.add(types.InlineKeyboardButton("🔙 Назад до адмін-панелі", callback_data="admin_back"))
+    bot.edit_message_text("👥 *Керування користувачами (блокування/розблокування)*\n\nОберіть користувача:", 
+                          call.message.chat.id, call.message.message_id, parse_mode='Markdown', reply_markup=markup)
 
 @error_handler
 def send_commission_report(call):
     """Надсилає адміністратору звіт про комісії."""
-    conn = get_db_connection()
-    if not conn:
-        bot.edit_message_text("❌ Помилка при отриманні звіту по комісіях (помилка БД).", call.message.chat.id, call.message.message_id)
-        return
-    cur = conn.cursor()
     try:
-        cur.execute(pg_sql.SQL("""
-            SELECT 
-                p.id AS product_id,
-                p.product_name,
-                p.seller_chat_id,
-                u.username AS seller_username,
-                p.price,
-                p.commission_amount,
-                p.status AS product_status,
-                ct.status AS transaction_status,
-                ct.created_at AS transaction_date,
-                ct.paid_at AS paid_date
-            FROM products p
-            LEFT JOIN commission_transactions ct ON p.id = ct.product_id
-            LEFT JOIN users u ON p.seller_chat_id = u.chat_id
-            WHERE p.status = 'sold' AND (ct.status IS NULL OR ct.status = 'pending_payment')
-            ORDER BY ct.created_at ASC;
-        """))
-        pending_commissions = cur.fetchall()
-
-        total_due = 0.0
-        report_text = "💰 *Звіт по комісіях (очікуються до сплати):*\n\n"
-        if not pending_commissions:
-            report_text += "Наразі немає очікуваних комісій до сплати."
-        else:
-            for item in pending_commissions:
-                commission = item['commission_amount'] if item['commission_amount'] is not None else 0.0
-                total_due += commission
-                seller_username_display = f"@{item['seller_username']}" if item['seller_username'] else f"ID: {item['seller_chat_id']}"
-                report_text += (
-                    f"▪️ Товар ID `{item['product_id']}`: *{item['product_name'][:50]}*\n"
-                    f"   Продавець: [{seller_username_display}](tg://user?id={item['seller_chat_id']})\n"
-                    f"   Ціна: {item['price']}\n"
-                    f"   Комісія: `{commission:.2f}`\n"
-                    f"   Статус (товар): `{item['product_status']}`\n"
-                    f"   Статус (транзакція): `{item['transaction_status'] or 'немає'}`\n"
-                    f"   Дата продажу: {item['transaction_date'].strftime('%Y-%m-%d') if item['transaction_date'] else 'Н/Д'}\n\n"
-                )
-            report_text += f"\n*Загальна сума до сплати: {total_due:.2f} UAH*\n\n"
-            report_text += f"Номер картки Monobank для платежів: `{MONOBANK_CARD_NUMBER}`"
-
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("🔙 Назад до адмін-панелі", callback_data="admin_back"))
-        bot.edit_message_text(report_text, call.message.chat.id, call.message.message_id, parse_mode='Markdown', reply_markup=markup)
-
+        with db_conn() as conn, conn.cursor() as cur:
+            execute_prepared(cur, 'admin_commission_report')
+            pending_commissions = cur.fetchall()
     except Exception as e:
         logger.error(f"Помилка в send_commission_report: {e}", exc_info=True)
         bot.edit_message_text("❌ Не вдалося отримати звіт по комісіях.", call.message.chat.id, call.message.message_id, reply_markup=admin_panel_markup())
-    finally:
-        if conn:
-            conn.close()
+        return
+
+    total_due = 0.0
+    report_text = "💰 *Звіт по комісіях (очікуються до сплати):*\n\n"
+    if not pending_commissions:
+        report_text += "Наразі немає очікуваних комісій до сплати."
+    else:
+        for item in pending_commissions:
+            commission = item['commission_amount'] if item['commission_amount'] is not None else 0.0
+            total_due += commission
+            seller_username_display = f"@{item['seller_username']}" if item['seller_username'] else f"ID: {item['seller_chat_id']}"
+            report_text += (
+                f"▪️ Товар ID `{item['product_id']}`: *{item['product_name'][:50]}*\n"
+                f"   Продавець: [{seller_username_display}](tg://user?id={item['seller_chat_id']})\n"
+                f"   Ціна: {item['price']}\n"
+                f"   Комісія: `{commission:.2f}`\n"
+                f"   Статус (товар): `{item['product_status']}`\n"
+                f"   Статус (транзакція): `{item['transaction_status'] or 'немає'}`\n"
+                f"   Дата продажу: {item['transaction_date'].strftime('%Y-%m-%d') if item['transaction_date'] else 'Н/Д'}\n\n"
+            )
+        report_text += f"\n*Загальна сума до сплати: {total_due:.2f} UAH*\n\n"
+        report_text += f"Номер картки Monobank для платежів: `{MONOBANK_CARD_NUMBER}`"
+
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("🔙 Назад до адмін-панелі", callback_data="admin_back"))
+    bot.edit_message_text(report_text, call.message.chat.id, call.message.message_id, parse_mode='Markdown', reply_markup=markup)
 
 @error_handler
 def send_ai_statistics(call):
     """Надсилає адміністратору статистику використання AI помічника."""
-    conn = get_db_connection()
-    if not conn:
-        bot.edit_message_text("❌ Помилка при отриманні AI статистики (помилка БД).", call.message.chat.id, call.message.message_id)
-        return
-    cur = conn.cursor()
     try:
-        cur.execute(pg_sql.SQL("""
-            SELECT 
-                COUNT(*) AS total_messages,
-                COUNT(DISTINCT user_chat_id) AS unique_users,
-                (SELECT COUNT(*) FROM conversations WHERE sender_type = 'user') AS user_messages,
-                (SELECT COUNT(*) FROM conversations WHERE sender_type = 'ai') AS ai_messages
-            FROM conversations;
-        """))
-        stats = cur.fetchone()
-
-        report_text = "🤖 *Статистика AI Помічника:*\n\n"
-        if stats:
-            report_text += f"▪️ Загальна кількість повідомлень: `{stats['total_messages']}`\n"
-            report_text += f"▪️ Унікальних користувачів: `{stats['unique_users']}`\n"
-            report_text += f"▪️ Повідомлень від користувачів: `{stats['user_messages']}`\n"
-            report_text += f"▪️ Повідомлень від AI: `{stats['ai_messages']}`\n"
-        else:
-            report_text += "Дані про використання AI відсутні."
-
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("🔙 Назад до адмін-панелі", callback_data="admin_back"))
-        bot.edit_message_text(report_text, call.message.chat.id, call.message.message_id, parse_mode='Markdown', reply_markup=markup)
-
+        with db_conn() as conn, conn.cursor() as cur:
+            execute_prepared(cur, 'admin_ai_stats')
+            stats = cur.fetchone()
     except Exception as e:
         logger.error(f"Помилка в send_ai_statistics: {e}", exc_info=True)
         bot.edit_message_text("❌ Не вдалося отримати AI статистику.", call.message.chat.id, call.message.message_id, reply_markup=admin_panel_markup())
-    finally:
-        if conn:
-            conn.close()
+        return
+
+    report_text = "🤖 *Статистика AI Помічника:*\n\n"
+    if stats:
+        report_text += f"▪️ Загальна кількість повідомлень: `{stats['total_messages']}`\n"
+        report_text += f"▪️ Унікальних користувачів: `{stats['unique_users']}`\n"
+        report_text += f"▪️ Повідомлень від користувачів: `{stats['user_messages']}`\n"
+        report_text += f"▪️ Повідомлень від AI: `{stats['ai_messages']}`\n"
+    else:
+        report_text += "Дані про використання AI відсутні."
+
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("🔙 Назад до адмін-панелі", callback_data="admin_back"))
+    bot.edit_message_text(report_text, call.message.chat.id, call.message.message_id, parse_mode='Markdown', reply_markup=markup)
 
 @error_handler
 def send_referral_statistics(call):
     """Надсилає адміністратору статистику рефералів."""
-    conn = get_db_connection()
-    if not conn:
-        bot.edit_message_text("❌ Помилка при отриманні реферальної статистики (помилка БД).", call.message.chat.id, call.message.message_id)
-        return
-    cur = conn.cursor()
     try:
-        cur.execute(pg_sql.SQL("""
-            SELECT 
-                referrer_id, 
-                COUNT(chat_id) AS referred_count,
-                MAX(r.username) AS referrer_username,
-                MAX(r.first_name) AS referrer_first_name,
-                MAX(r.last_name) AS referrer_last_name
-            FROM users r
-            JOIN users u ON r.chat_id = u.referrer_id
-            WHERE r.referrer_id IS NOT NULL OR u.referrer_id IS NOT NULL -- Для уникнення випадків, коли реферер ще не в таблиці users
-            GROUP BY referrer_id
-            ORDER BY referred_count DESC;
-        """))
-        referrals = cur.fetchall()
-
-        report_text = "🏆 *Реферальна статистика:*\n\n"
-        if not referrals:
-            report_text += "Наразі немає даних по рефералах."
-        else:
-            for ref in referrals:
-                referrer_username_display = f"@{ref['referrer_username']}" if ref['referrer_username'] else "Н/Д"
-                report_text += (
-                    f"▪️ Реферер ID: `{ref['referrer_id']}`\n"
-                    f"   Ім'я: {ref['referrer_first_name']} {ref['referrer_last_name'] or ''} ({referrer_username_display})\n"
-                    f"   Запрошених користувачів: `{ref['referred_count']}`\n\n"
-                )
-
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("🔙 Назад до адмін-панелі", callback_data="admin_back"))
-        bot.edit_message_text(report_text, call.message.chat.id, call.message.message_id, parse_mode='Markdown', reply_markup=markup)
-
+        with db_conn() as conn, conn.cursor() as cur:
+            execute_prepared(cur, 'admin_referral_stats')
+            referrals = cur.fetchall()
     except Exception as e:
         logger.error(f"Помилка в send_referral_statistics: {e}", exc_info=True)
         bot.edit_message_text("❌ Не вдалося отримати реферальну статистику.", call.message.chat.id, call.message.message_id, reply_markup=admin_panel_markup())
-    finally:
-        if conn:
-            conn.close()
+        return
+
+    report_text = "🏆 *Реферальна статистика:*\n\n"
+    if not referrals:
+        report_text += "Наразі немає даних по рефералах."
+    else:
+        for ref in referrals:
+            referrer_username_display = f"@{ref['referrer_username']}" if ref['referrer_username'] else "Н/Д"
+            report_text += (
+                f"▪️ Реферер ID: `{ref['referrer_id']}`\n"
+                f"   Ім'я: {ref['referrer_first_name']} {ref['referrer_last_name'] or ''} ({referrer_username_display})\n"
+                f"   Запрошених користувачів: `{ref['referred_count']}`\n\n"
+            )
+
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("🔙 Назад до адмін-панелі", callback_data="admin_back"))
+    bot.edit_message_text(report_text, call.message.chat.id, call.message.message_id, parse_mode='Markdown', reply_markup=markup)
 
 # --- 16. Запуск Бота ---
 if __name__ == '__main__':
@@ -2312,7 +2551,9 @@ if __name__ == '__main__':
     try:
         bot.remove_webhook() # Видаляємо старий вебхук, якщо є
         time.sleep(0.1) # Коротка пауза для впевненості, що вебхук видалено
-        bot.set_webhook(url=WEBHOOK_URL + TOKEN)
+        # Лише ті типи оновлень, які бот обробляє; до 100 паралельних з'єднань від Telegram
+        bot.set_webhook(url=WEBHOOK_URL + TOKEN, max_connections=100,
+                        allowed_updates=["message", "callback_query"])
         logger.info(f"Webhook встановлено на: {WEBHOOK_URL + TOKEN}")
     except Exception as e:
         logger.critical(f"Помилка встановлення вебхука: {e}")
@@ -2326,10 +2567,12 @@ if __name__ == '__main__':
         Парсить JSON-оновлення та передає їх telebot для обробки.
         """
         if request.headers.get('content-type') == 'application/json':
-            json_string = request.get_data().decode('utf-8')
-            update = telebot.types.Update.de_json(json_string)
-            bot.process_new_updates([update]) # Обробка вхідних оновлень
-            return '!', 200 # Повертаємо 200 OK Telegramу
+            # de_json приймає вже розібраний dict, тож тіло запиту парситься один раз
+            update = telebot.types.Update.de_json(request.get_json(cache=False))
+            if not submit_update(update):
+                logger.warning("Черга оновлень переповнена, апдейт відхилено з 503.")
+                return 'Service Unavailable', 503
+            return '!', 200 # Повертаємо 200 OK Telegramу, обробка йде у фоні
         else:
             logger.warning("Отримано запит до вебхука без правильного Content-Type (application/json).")
             return 'Content-Type must be application/json', 403 # Відхиляємо некоректні запити
@@ -0,0 +1,54 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+for module in ('telebot', 'asyncpg', 'aiohttp', 'psycopg2', 'cachetools', 'dotenv'):
+    pytest.importorskip(module)
+
+# bot.py validates its environment on import
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:TEST')
+os.environ.setdefault('WEBHOOK_URL', 'https://example.invalid')
+os.environ.setdefault('DATABASE_URL', 'postgresql://localhost/test')
+os.environ.setdefault('ADMIN_CHAT_ID', '1')
+os.environ.setdefault('CHANNEL_ID', '-1001')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot as bot_module
+from telebot import asyncio_helper
+
+
+def api_error(error_code, **extra):
+    result_json = {'ok': False, 'error_code': error_code, 'description': 'test error', **extra}
+    return asyncio_helper.ApiTelegramException('sendMessage', None, result_json)
+
+
+class FakeBot:
+    """Stands in for AsyncTeleBot: raises the queued errors first, then succeeds."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'sent'
+
+
+def test_429_is_retried_once():
+    fake = FakeBot(api_error(429, parameters={'retry_after': 0}))
+    result = asyncio.run(bot_module.RateLimitedBot(fake).send_message(1, 'hi'))
+    assert result == 'sent'
+    assert fake.calls == 2
+
+
+def test_other_api_errors_are_reraised_unchanged():
+    error = api_error(400)
+    fake = FakeBot(error)
+    with pytest.raises(asyncio_helper.ApiTelegramException) as excinfo:
+        asyncio.run(bot_module.RateLimitedBot(fake).send_message(1, 'hi'))
+    assert excinfo.value is error
+    assert fake.calls == 1